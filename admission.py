@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+admission.py -- Conference Central admission control for write endpoints
+
+$Id$
+
+Each user gets a token bucket per endpoint, sized by settings.RATE_LIMITS;
+registrations also draw from a bucket shared by everyone registering for
+the same conference (settings.CONFERENCE_RATE_LIMIT), so a hot conference
+admits a fair, bounded stream instead of a pile-up of transactions on its
+entity group. A request finding its bucket empty is refused with
+TooManyRequestsException (HTTP 503) before it reaches the datastore or
+task queue. A registration refused by the conference's bucket gets its
+user token back.
+
+Buckets live in memcache and are updated with gets/cas. If memcache is
+unavailable requests are admitted; a bucket that stays contended for
+every retry counts as empty, as only a burst can cause that.
+
+"""
+
+import functools
+import time
+
+import endpoints
+
+from google.appengine.api import memcache
+
+from models import TooManyRequestsException
+from settings import CONFERENCE_RATE_LIMIT
+from settings import RATE_LIMITS
+from utils import getUserId
+
+MEMCACHE_PREFIX = 'admission-'
+CAS_RETRIES = 5
+# switched off by benchmarks comparing runs without admission control
+ENABLED = True
+
+
+def _take(client, name, rate, burst):
+    """Take a token from a bucket; returns 0 if admitted, otherwise the
+    seconds until a token is available.
+    """
+    # idle buckets are full anyway; let memcache drop them
+    ttl = int(burst / rate) + 60
+    seen = False
+    for _ in xrange(CAS_RETRIES):
+        now = time.time()
+        state = client.gets(name)
+        if state is None:
+            if client.add(name, (burst - 1.0, now), time=ttl):
+                return 0
+            continue
+        seen = True
+        tokens, stamp = state
+        tokens = min(float(burst), tokens + (now - stamp) * rate)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        if client.cas(name, (tokens - 1, now), time=ttl):
+            return 0
+    # fail open only when memcache never answered
+    return 1.0 / rate if seen else 0
+
+
+def _refund(client, name, rate, burst):
+    """Put back a token taken from a bucket; best effort."""
+    for _ in xrange(CAS_RETRIES):
+        state = client.gets(name)
+        if state is None:
+            return
+        tokens, stamp = state
+        if client.cas(name, (min(float(burst), tokens + 1), stamp),
+                      time=int(burst / rate) + 60):
+            return
+
+
+def rateLimited(conferenceField=None):
+    """Decorate a write endpoint with its per-user token bucket, plus the
+    shared bucket of the conference named by request.<conferenceField>.
+    """
+    def decorator(method):
+        name = method.__name__
+        rate, burst = RATE_LIMITS[name]
+
+        @functools.wraps(method)
+        def wrapper(self, request):
+            user = endpoints.get_current_user()
+            if ENABLED and user:
+                client = memcache.Client()
+                userBucket = '%suser-%s-%s' % (
+                    MEMCACHE_PREFIX, name, getUserId(user))
+                wait = _take(client, userBucket, rate, burst)
+                if not wait and conferenceField:
+                    wait = _take(client, '%sconference-%s' % (
+                        MEMCACHE_PREFIX, getattr(request, conferenceField)),
+                        *CONFERENCE_RATE_LIMIT)
+                    if wait:
+                        _refund(client, userBucket, rate, burst)
+                if wait:
+                    raise TooManyRequestsException(
+                        'Too many requests; retry in %.1f seconds' % wait)
+            return method(self, request)
+        return wrapper
+    return decorator
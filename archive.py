@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+archive.py -- Conference Central archive of past conferences
+
+$Id$
+
+Conferences ARCHIVE_AFTER past their end date move to the
+ARCHIVE_NAMESPACE namespace, under the same key paths, with their
+sessions and attendee index. Queries in the default namespace, and the
+index rows they scan, then only cover live conferences; queryConferences
+and getConferencesCreated take includeArchived to search the archive
+too, and getMulti() finds an archived entity by its live key.
+
+A weekly cron enqueues a task per conference due. The task copies the
+conference's entity group into the archive and moves the wishlist items
+of its sessions, found by their indexed sessionKey. It then deletes the
+originals, the conference last: a retried task copies again until the
+conference is gone. The conference is deleted in a transaction that
+also takes it out of the facet counts, the search index and the
+getConferencesCreated() stamps, so these happen exactly once. Waitlists,
+the materialized agenda and session recommendations are dropped instead
+of archived. The
+deletions leave sync tombstones.
+
+The archive_wishlists mapper job (see jobs.py) moves the wishlist items
+of sessions archived before the archive task moved them itself; run it
+once after deploying, after the reindex_SessionWishlistItem job has
+indexed the sessionKey of older items.
+
+"""
+
+from datetime import date
+from datetime import timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import etags
+import facets
+import search
+import tasks
+from models import Conference
+from models import ConferenceAgenda
+from models import SessionRecommendation
+from models import SessionWishlistItem
+
+ARCHIVE_NAMESPACE = 'archive'
+# grace period after a conference's end date
+ARCHIVE_AFTER = timedelta(days=7)
+TASK_URL = '/tasks/archive_conference'
+# wishlist items moved per batch
+BATCH = 200
+# kinds moved to the archive; other descendants of a conference are dropped
+ARCHIVED_KINDS = ('Conference', 'ConferenceSession', 'ConferenceAttendee')
+
+
+def archivedKey(key):
+    """Return the archive counterpart of a live key."""
+    return ndb.Key(pairs=key.pairs(), namespace=ARCHIVE_NAMESPACE)
+
+
+def getMulti(keys):
+    """Like ndb.get_multi, but look up missing entities in the archive."""
+    entities = ndb.get_multi(keys)
+    missing = [i for i, entity in enumerate(entities) if entity is None]
+    for i, entity in zip(missing, ndb.get_multi(
+            [archivedKey(keys[i]) for i in missing])):
+        entities[i] = entity
+    return entities
+
+
+def due(today=None):
+    """Return the keys of the live conferences due for the archive."""
+    cutoff = (today or date.today()) - ARCHIVE_AFTER
+    # endDate isn't indexed, but a conference can't end before it starts
+    confs = Conference.query(Conference.startDate < cutoff)
+    return [conf.key for conf in confs
+            if (conf.endDate or conf.startDate) < cutoff]
+
+
+def archiveLater(today=None):
+    """Enqueue an archive task per conference due; run by the cron.
+    Returns the number of conferences enqueued.
+    """
+    keys = due(today)
+    for c_key in keys:
+        taskqueue.add(params={'websafeConferenceKey': c_key.urlsafe()},
+                      url=TASK_URL)
+    return len(keys)
+
+
+def archiveConference(wsck):
+    """Move a conference and its entity group to the archive; run by
+    the archive task."""
+    c_key = ndb.Key(urlsafe=wsck)
+    conf = c_key.get()
+    if not conf:
+        return
+    # kindless ancestor query: the conference and all its descendants
+    entities = ndb.Query(ancestor=c_key).fetch()
+    keys = [entity.key for entity in entities]
+    copies = [entity for entity in entities
+              if entity.key.kind() in ARCHIVED_KINDS]
+    for entity in copies:
+        entity.key = archivedKey(entity.key)
+    ndb.put_multi(copies)
+    wssks = [key.urlsafe() for key in keys
+             if key.kind() == 'ConferenceSession']
+    for wssk in wssks:
+        _moveWishlists(wssk)
+    ndb.delete_multi([key for key in keys if key != c_key] +
+                     [ndb.Key(ConferenceAgenda, wsck)] +
+                     [ndb.Key(SessionRecommendation, wssk) for wssk in wssks])
+    _dropConference(c_key)
+
+
+def _moveWishlists(wssk):
+    """Move the wishlist items of a session to the archive."""
+    query = SessionWishlistItem.query(SessionWishlistItem.sessionKey == wssk)
+    cursor, more = None, True
+    while more:
+        items, cursor, more = query.fetch_page(BATCH, start_cursor=cursor)
+        # the users' wishlist sizes are recounted by their next change
+        deletes = [wl.key for wl in items] + list(set(
+            tasks.wishlistSizeKey(wl.userId) for wl in items))
+        for wl in items:
+            wl.key = archivedKey(wl.key)
+        ndb.put_multi(items)
+        ndb.delete_multi(deletes)
+
+
+@ndb.transactional
+def _dropConference(c_key):
+    """Delete a live conference and take it out of the derived data;
+    does nothing once done."""
+    conf = c_key.get()
+    if not conf:
+        return
+    c_key.delete()
+    facets.adjust(facets.cell(conf), None)
+    search.indexLater(c_key.urlsafe())
+    # getConferencesCreated() lists changed for both modes
+    p_key = c_key.parent().urlsafe()
+    etags.bumpStamp('conferences-' + p_key)
+    etags.bumpStamp('archived-conferences-' + p_key)
+
+
+def archiveWishlists(items):
+    """Mapper job function: move wishlist items of archived sessions;
+    a one-off for items the archive task didn't find."""
+    c_keys = list(set(ndb.Key(urlsafe=wl.sessionKey).parent()
+                      for wl in items))
+    gone = [c_key for c_key, conf in zip(c_keys, ndb.get_multi(c_keys))
+            if not conf]
+    archived = set(c_key for c_key, conf in zip(gone, ndb.get_multi(
+        [archivedKey(c_key) for c_key in gone])) if conf)
+
+    moved = [wl for wl in items
+             if ndb.Key(urlsafe=wl.sessionKey).parent() in archived]
+    deletes = [wl.key for wl in moved] + list(set(
+        tasks.wishlistSizeKey(wl.userId) for wl in moved))
+    for wl in moved:
+        wl.key = archivedKey(wl.key)
+    return moved, deletes
@@ -0,0 +1 @@
+"""Benchmarks for the Conference Central API, run on App Engine testbed stubs."""
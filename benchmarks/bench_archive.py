@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+bench_archive.py -- queryConferences before and after archiving past
+    conferences, on testbed stubs
+
+$Id$
+
+Usage:
+    python -m benchmarks.bench_archive [--today YYYY-MM-DD]
+        [--iterations N] [--seed S] [--conferences N] [--sessions N]
+        [--profiles N] [--wishlist N]
+
+Generates a seeded data set, times queryConferences, then runs the
+archive cron as if it were --today (the generated conferences start
+between 2015 and 2016) and drains the task queue, which also moves the
+wishlists. queryConferences is timed again, live only and
+with includeArchived. The report gives latency and result counts per
+run plus the checks, which also get an archived conference by its live
+key; the exit status is 1 if a check fails.
+
+"""
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime
+
+from benchmarks.harness import Harness
+
+from google.appengine.ext import ndb
+
+import archive
+from benchmarks import datagen
+from benchmarks.bench_endpoints import percentile
+from models import Conference
+from models import ConferenceQueryForm
+from models import ConferenceSession
+from models import Profile
+from models import SessionWishlistItem
+
+
+def _measure(h, iterations, seed, includeArchived=False):
+    """Time queryConferences; return (p50 ms, mean conferences)."""
+    rng = random.Random(seed)
+    latencies = []
+    found = 0
+    for _ in xrange(iterations):
+        filters = [ConferenceQueryForm(field='CITY', operator='EQ',
+                                       value=rng.choice(datagen.CITIES))]
+        started = time.time()
+        forms = h.call('queryConferences', filters=filters,
+                       includeArchived=includeArchived)
+        latencies.append((time.time() - started) * 1000)
+        found += len(forms.items)
+    return percentile(latencies, 50), found / float(iterations)
+
+
+def _count(model, namespace=None):
+    return model.query(namespace=namespace).count(keys_only=True)
+
+
+def _getArchived(h):
+    """Tell whether getConference serves an archived conference, with
+    its organizer, by its live key."""
+    conf = Conference.query(namespace=archive.ARCHIVE_NAMESPACE).get()
+    if not conf:
+        return False
+    form = h.call('getConference', websafeConferenceKey=ndb.Key(
+        pairs=conf.key.pairs()).urlsafe())
+    return (form.name == conf.name and
+            form.organizerDisplayName == ndb.Key(
+                Profile, conf.organizerUserId).get().displayName)
+
+
+def _checks(h, before, cutoff):
+    """Return the (description, passed) checks of the archive."""
+    live = Conference.query().fetch()
+    liveKeys = set(conf.key for conf in live)
+    return [
+        ('conferences kept', before[0] == len(live) + _count(
+            Conference, archive.ARCHIVE_NAMESPACE)),
+        ('sessions kept', before[1] == _count(ConferenceSession) + _count(
+            ConferenceSession, archive.ARCHIVE_NAMESPACE)),
+        ('wishlists kept', before[2] == _count(SessionWishlistItem) +
+         _count(SessionWishlistItem, archive.ARCHIVE_NAMESPACE)),
+        ('none due left', not any(
+            (conf.endDate or conf.startDate) < cutoff for conf in live)),
+        ('no live wishlist items of archived sessions', all(
+            ndb.Key(urlsafe=wl.sessionKey).parent() in liveKeys
+            for wl in SessionWishlistItem.query())),
+        ('getConference of an archived conference', _getArchived(h)),
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--today', default='2016-01-01',
+                        help='date the archive cron runs as')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--conferences', type=int, default=2000)
+    parser.add_argument('--sessions', type=int, default=20000)
+    parser.add_argument('--profiles', type=int, default=5000)
+    parser.add_argument('--wishlist', type=int, default=20000)
+    args = parser.parse_args(argv)
+    today = datetime.strptime(args.today, '%Y-%m-%d').date()
+
+    h = Harness()
+    try:
+        datagen.generate(
+            conferences=args.conferences, sessions=args.sessions,
+            profiles=args.profiles, wishlistItems=args.wishlist,
+            seed=args.seed)
+        before = (_count(Conference), _count(ConferenceSession),
+                  _count(SessionWishlistItem))
+        runs = [('live, before', _measure(h, args.iterations, args.seed))]
+
+        started = time.time()
+        enqueued = archive.archiveLater(today)
+        tasks = h.drainTasks()
+        elapsed = time.time() - started
+
+        runs.append(('live, after',
+                     _measure(h, args.iterations, args.seed)))
+        runs.append(('includeArchived, after',
+                     _measure(h, args.iterations, args.seed, True)))
+        checks = _checks(h, before, today - archive.ARCHIVE_AFTER)
+    finally:
+        h.close()
+
+    print 'archived %d conferences in %.2fs, %d task runs' % (
+        enqueued, elapsed, tasks)
+    print '%-26s %9s %12s' % ('queryConferences', 'p50 ms', 'conferences')
+    for name, (p50, found) in runs:
+        print '%-26s %9.2f %12.1f' % (name, p50, found)
+    for description, passed in checks:
+        print '%s %s' % (description, 'ok' if passed else 'FAILED')
+    return 0 if all(passed for _, passed in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
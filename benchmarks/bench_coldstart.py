@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+bench_coldstart.py -- cold start benchmark of the Conference Central
+    modules: import time and first request latency of a fresh process
+
+$Id$
+
+Usage:
+    python -m benchmarks.bench_coldstart [--runs N] [--seed S]
+        [--conferences N] [--sessions N] [--profiles N] [--wishlist N]
+
+Generates a seeded data set into a datastore file, then starts a fresh
+Python process per run, as App Engine starts a new instance. Each one
+imports main, imports conference and sends two getConference calls to
+the Endpoints SPI. The 'warm' runs send /_ah/warmup first, as App
+Engine does before routing traffic to a new instance. The report gives
+p50/p90 per step and the total a user waits for on a new instance.
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.harness import Harness
+from benchmarks.harness import ROOT
+
+import webapp2
+
+MODES = ('cold', 'warm')
+STEPS = ('importMain', 'warmup', 'importApi', 'firstRequest',
+         'secondRequest')
+
+
+def _ms(started):
+    return (time.time() - started) * 1000
+
+
+def _child(mode, datastoreFile, conferenceKey):
+    """Run one cold start in this process; prints its timings as JSON."""
+    h = Harness(datastoreFile=datastoreFile, importApp=False)
+    timings = {}
+    try:
+        started = time.time()
+        import main
+        timings['importMain'] = _ms(started)
+
+        if mode == 'warm':
+            started = time.time()
+            webapp2.Request.blank('/_ah/warmup').get_response(main.app)
+            timings['warmup'] = _ms(started)
+
+        started = time.time()
+        import conference
+        timings['importApi'] = _ms(started)
+
+        for step in ('firstRequest', 'secondRequest'):
+            h.newRequest()
+            request = webapp2.Request.blank(
+                '/_ah/spi/ConferenceApi.getConference', method='POST',
+                body=json.dumps({'websafeConferenceKey': conferenceKey}),
+                headers={'Content-Type': 'application/json',
+                         'X-AppEngine-Peer': 'apiserving'})
+            started = time.time()
+            request.get_response(conference.api)
+            timings[step] = _ms(started)
+    finally:
+        h.close()
+    print json.dumps(timings)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--profiles', type=int, default=500)
+    parser.add_argument('--wishlist', type=int, default=1000)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument('--datastore', help=argparse.SUPPRESS)
+    parser.add_argument('--conference', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        _child(args.child, args.datastore, args.conference)
+        return 0
+
+    # imported here: children must load the app modules themselves
+    from benchmarks import datagen
+    from benchmarks.bench_endpoints import percentile
+
+    tmpdir = tempfile.mkdtemp(prefix='coldstart-')
+    path = os.path.join(tmpdir, 'datastore')
+    try:
+        h = Harness(datastoreFile=path, saveChanges=True)
+        try:
+            data = datagen.generate(conferences=args.conferences,
+                                    sessions=args.sessions,
+                                    profiles=args.profiles,
+                                    wishlistItems=args.wishlist,
+                                    seed=args.seed)
+        finally:
+            h.close()
+
+        results = dict((mode, []) for mode in MODES)
+        for run in xrange(args.runs):
+            for mode in MODES:
+                output = subprocess.check_output(
+                    [sys.executable, '-m', 'benchmarks.bench_coldstart',
+                     '--child', mode, '--datastore', path, '--conference',
+                     data.conferenceKeys[run % len(data.conferenceKeys)]],
+                    cwd=ROOT)
+                results[mode].append(json.loads(output.splitlines()[-1]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print '%-6s %-14s %9s %9s' % ('mode', 'step', 'p50 ms', 'p90 ms')
+    for mode in MODES:
+        for step in STEPS + ('userWait',):
+            if step == 'userWait':
+                # what the first user request waits for on a new instance
+                values = [r['importApi'] + r['firstRequest']
+                          for r in results[mode]]
+            else:
+                values = [r[step] for r in results[mode] if step in r]
+            if values:
+                print '%-6s %-14s %9.2f %9.2f' % (
+                    mode, step, percentile(values, 50),
+                    percentile(values, 90))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
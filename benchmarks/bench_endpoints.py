@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+"""
+bench_endpoints.py -- latency & RPC benchmark of every ConferenceApi
+    endpoint and main.py handler on testbed stubs
+
+$Id$
+
+Usage:
+    python -m benchmarks.bench_endpoints [--iterations N] [--seed S]
+        [--conferences N] [--sessions N] [--profiles N] [--wishlist N]
+        [--baseline FILE] [--save-baseline] [--tolerance PCT]
+
+Generates a seeded data set, calls each endpoint and handler repeatedly
+with inputs drawn from it, and reports p50/p90/p99 latency and RPCs per
+call as recorded by rpcstats. Results are compared against the stored
+baseline; a p50 regression beyond --tolerance or any increase in RPCs
+per call exits non-zero.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+from datetime import timedelta
+
+from benchmarks.harness import Harness
+from benchmarks.harness import ROOT
+
+import rpcstats
+from benchmarks import datagen
+from models import ConferenceQueryForm
+from models import ConferenceSessionType
+
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+
+def _user(d, r):
+    return r.choice(d.userIds)
+
+
+def _halves(items):
+    return items[:len(items) // 2], items[len(items) // 2:]
+
+
+def _export(d, r):
+    wsck = _confWithSessions(d, r)
+    name = r.choice(['agenda.csv', 'agenda.ics', 'attendees.csv'])
+    return '/exports/%s/%s' % (wsck, name), d.organizerOf[wsck]
+
+
+def _conf(d, r):
+    return r.choice(d.conferenceKeys)
+
+
+def _confWithSessions(d, r):
+    wsck = _conf(d, r)
+    while not d.sessionsOf[wsck]:
+        wsck = _conf(d, r)
+    return wsck
+
+
+def _session(d, r):
+    return r.choice(d.sessionKeys)
+
+
+def _createConference(d, r):
+    return _user(d, r), dict(name='Bench %d' % r.randint(0, 10 ** 9),
+                             city='London', topics=['Web Technologies'],
+                             startDate='2016-06-01', endDate='2016-06-03',
+                             maxAttendees=100)
+
+
+def _updateConference(d, r):
+    wsck = _conf(d, r)
+    # about half the calls repeat the current description: no-op updates
+    return d.organizerOf[wsck], dict(websafeConferenceKey=wsck,
+                                     description='Updated %d' % r.randint(0, 1))
+
+
+def _createSession(d, r):
+    wsck = _conf(d, r)
+    return d.organizerOf[wsck], dict(
+        conferenceKey=wsck, name='Bench session', speaker=r.choice(
+            d.speakers), duration=60,
+        typeOfSession=ConferenceSessionType.LECTURE, date='2016-06-01',
+        startTime='%02d:00' % r.randint(8, 19),
+        # some calls replay an earlier request
+        idempotencyKey='bench-%d' % r.randint(0, 9))
+
+
+def _attendees(d, r):
+    wsck = _conf(d, r)
+    return d.organizerOf[wsck], dict(websafeConferenceKey=wsck)
+
+
+# endpoint name -> function(dataset, rng) returning (user, request fields)
+ENDPOINT_SCENARIOS = {
+    'getConferencesWithWishlistedSessions': lambda d, r: (_user(d, r), {}),
+    'createConference': _createConference,
+    'updateConference': _updateConference,
+    'getConference': lambda d, r: (
+        None, dict(websafeConferenceKey=_conf(d, r))),
+    'getConferencesByKeys': lambda d, r: (None, dict(
+        websafeConferenceKeys=r.sample(d.conferenceKeys, 20))),
+    'getConferencesCreated': lambda d, r: (
+        d.organizerOf[_conf(d, r)], {}),
+    'queryConferences': lambda d, r: (None, dict(filters=[
+        ConferenceQueryForm(field='CITY', operator='EQ',
+                            value=r.choice(datagen.CITIES)),
+        ConferenceQueryForm(field='MONTH', operator='GT',
+                            value=str(r.randint(1, 11)))])),
+    'searchConferences': lambda d, r: (None, dict(
+        query=' '.join(r.sample(datagen.WORDS, 2)))),
+    'getConferenceFacets': lambda d, r: (None, dict(filters=[
+        ConferenceQueryForm(field='TOPIC', operator='EQ',
+                            value=r.choice(datagen.TOPICS))])),
+    'getDashboard': lambda d, r: (_user(d, r), {}),
+    'getProfile': lambda d, r: (_user(d, r), {}),
+    'saveProfile': lambda d, r: (
+        _user(d, r), dict(displayName='Renamed %d' % r.randint(0, 99))),
+    'getAnnouncement': lambda d, r: (None, {}),
+    'getConferenceSpeakers': lambda d, r: (
+        None, dict(conferenceKey=_confWithSessions(d, r))),
+    'getFeaturedSpeaker': lambda d, r: (
+        None, dict(conferenceKey=_conf(d, r))),
+    'getWaitlistPosition': lambda d, r: (
+        _user(d, r), dict(websafeConferenceKey=_conf(d, r))),
+    'getConferenceAttendees': _attendees,
+    'getConferencesToAttend': lambda d, r: (_user(d, r), {}),
+    'registerForConference': lambda d, r: (
+        _user(d, r), dict(websafeConferenceKey=_conf(d, r))),
+    'unregisterFromConference': lambda d, r: (
+        _user(d, r), dict(websafeConferenceKey=_conf(d, r))),
+    'filterPlayground': lambda d, r: (None, {}),
+    'createSession': _createSession,
+    'getSessionsBySpeaker': lambda d, r: (
+        None, dict(speaker=r.choice(d.speakers))),
+    'getConferenceSessionsByType': lambda d, r: (None, dict(
+        conferenceKey=_confWithSessions(d, r),
+        typeOfSession=ConferenceSessionType.WORKSHOP)),
+    'getConferenceSessionsByConfId': lambda d, r: (
+        None, dict(conferenceKey=_confWithSessions(d, r))),
+    'getConferenceSchedule': lambda d, r: (None, dict(
+        conferenceKey=_confWithSessions(d, r), startsBefore='19:00',
+        excludeTypes=[ConferenceSessionType.WORKSHOP])),
+    'addSessionToWishlist': lambda d, r: (
+        _user(d, r), dict(sessionKey=_session(d, r))),
+    'modifyWishlist': lambda d, r: (_user(d, r), dict(
+        zip(('add', 'remove'), _halves(r.sample(d.sessionKeys, 10))))),
+    'getSessionsInWishlist': lambda d, r: (_user(d, r), {}),
+    'getWishlistConflicts': lambda d, r: (_user(d, r), {}),
+    'getRecommendedSessions': lambda d, r: (
+        None, dict(sessionKey=_session(d, r))),
+    'syncChanges': lambda d, r: (_user(d, r), dict(
+        since=(datetime.utcnow() - timedelta(minutes=r.randint(1, 30))
+               ).strftime('%Y-%m-%dT%H:%M:%S.%f'))),
+}
+
+# (name, url or function(dataset, rng) returning (url, user), method,
+#  function(dataset, rng) returning params)
+HANDLER_SCENARIOS = [
+    ('WarmupHandler.get', '/_ah/warmup', 'GET', lambda d, r: {}),
+    ('SetAnnouncementHandler.get', '/crons/set_announcement', 'GET',
+     lambda d, r: {}),
+    ('SendConfirmationEmailHandler.post', '/tasks/send_confirmation_email',
+     'POST', lambda d, r: {'email': _user(d, r), 'conferenceInfo': 'Bench'}),
+    ('UpdateFeaturedSpeakerHandler.post', '/tasks/update_featured_speaker',
+     'POST', lambda d, r: {'speaker': r.choice(d.speakers),
+                           'conferenceKey': _conf(d, r)}),
+    ('RebuildAgendaHandler.post', '/tasks/rebuild_agenda', 'POST',
+     lambda d, r: {'conferenceKey': _confWithSessions(d, r)}),
+    ('PromoteWaitlistHandler.post', '/tasks/promote_waitlist', 'POST',
+     lambda d, r: {'websafeConferenceKey': _conf(d, r)}),
+    ('MapperStatusHandler.get', '/mapper/status', 'GET', lambda d, r: {}),
+    ('ProfilesHandler.get', '/admin/profiles', 'GET', lambda d, r: {}),
+    ('PurgeTombstonesHandler.get', '/crons/purge_tombstones', 'GET',
+     lambda d, r: {}),
+    ('PurgeIdempotencyRecordsHandler.get', '/crons/purge_idempotency_records',
+     'GET', lambda d, r: {}),
+    ('UpdateRecommendationsHandler.post', '/tasks/update_recommendations',
+     'POST', lambda d, r: {'userId': _user(d, r),
+                           'sessionKey': _session(d, r)}),
+    ('RebuildRecommendationsHandler.get', '/crons/rebuild_recommendations',
+     'GET', lambda d, r: {}),
+    ('IndexConferenceHandler.post', '/tasks/index_conference', 'POST',
+     lambda d, r: {'websafeConferenceKey': _confWithSessions(d, r)}),
+    ('RebuildFacetsHandler.get', '/crons/rebuild_facets', 'GET',
+     lambda d, r: {}),
+    ('ExportHandler.get', _export, 'GET', lambda d, r: {}),
+    ('BuildExportHandler.post', '/tasks/build_export', 'POST',
+     lambda d, r: {'websafeConferenceKey': _confWithSessions(d, r),
+                   'name': r.choice(['agenda.csv', 'attendees.csv'])}),
+]
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of values (nearest rank)."""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def _measure(h, name, run, iterations):
+    """Run one scenario repeatedly; return its latency & RPC summary."""
+    latencies = []
+    rpcs = []
+    errors = 0
+    for _ in xrange(iterations):
+        rpcstats.reset()
+        started = time.time()
+        try:
+            run()
+        except Exception:
+            # expected for e.g. registering twice; still a measured call
+            errors += 1
+        latencies.append((time.time() - started) * 1000)
+        total = rpcstats.totals().get(name, {'rpcs': {}})
+        rpcs.append(sum(r['count'] for r in total['rpcs'].values()))
+        h.drainTasks()
+    return {
+        'p50': round(percentile(latencies, 50), 3),
+        'p90': round(percentile(latencies, 90), 3),
+        'p99': round(percentile(latencies, 99), 3),
+        'rpcs': round(sum(rpcs) / float(len(rpcs)), 2),
+        'errors': errors,
+    }
+
+
+def runAll(h, data, iterations, seed):
+    """Benchmark every endpoint and handler; returns {name: summary}."""
+    results = {}
+    api_class = type(h.api)
+    for method in sorted(api_class.all_remote_methods()):
+        scenario = ENDPOINT_SCENARIOS.get(method)
+        if scenario is None:
+            print >> sys.stderr, 'no scenario for endpoint %s' % method
+            continue
+        rng = random.Random('%s-%s' % (seed, method))
+
+        def run(method=method, scenario=scenario, rng=rng):
+            user, fields = scenario(data, rng)
+            h.call(method, user, **fields)
+        results['ConferenceApi.' + method] = _measure(
+            h, 'ConferenceApi.' + method, run, iterations)
+
+    for name, url, verb, params in HANDLER_SCENARIOS:
+        rng = random.Random('%s-%s' % (seed, name))
+
+        def run(url=url, verb=verb, params=params, rng=rng):
+            target, user = url(data, rng) if callable(url) else (url, None)
+            h.handle(target, verb, params(data, rng), user)
+        results[name] = _measure(h, name, run, iterations)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return a list of regressions of results against baseline."""
+    regressions = []
+    for name, now in sorted(results.items()):
+        then = baseline.get(name)
+        if not then:
+            continue
+        if now['rpcs'] > then['rpcs']:
+            regressions.append('%s: %.2f RPCs/call, baseline %.2f' % (
+                name, now['rpcs'], then['rpcs']))
+        if then['p50'] and now['p50'] > then['p50'] * (1 + tolerance / 100.0):
+            regressions.append('%s: p50 %.2fms, baseline %.2fms' % (
+                name, now['p50'], then['p50']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--conferences', type=int, default=2000)
+    parser.add_argument('--sessions', type=int, default=20000)
+    parser.add_argument('--profiles', type=int, default=5000)
+    parser.add_argument('--wishlist', type=int, default=20000)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=25.0,
+                        help='allowed p50 slowdown in percent')
+    args = parser.parse_args(argv)
+
+    h = Harness()
+    try:
+        data = datagen.generate(conferences=args.conferences,
+                                sessions=args.sessions,
+                                profiles=args.profiles,
+                                wishlistItems=args.wishlist,
+                                seed=args.seed)
+        results = runAll(h, data, args.iterations, args.seed)
+    finally:
+        h.close()
+
+    print '%-55s %9s %9s %9s %7s %6s' % (
+        'endpoint', 'p50 ms', 'p90 ms', 'p99 ms', 'rpcs', 'errors')
+    for name, r in sorted(results.items()):
+        print '%-55s %9.2f %9.2f %9.2f %7.2f %6d' % (
+            name, r['p50'], r['p90'], r['p99'], r['rpcs'], r['errors'])
+    # a baseline without RPCs could never catch an RPC regression
+    if not any(r['rpcs'] for r in results.values()):
+        print 'no RPCs recorded; are the rpcstats hooks installed?'
+        return 1
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'baseline written to %s' % args.baseline
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print 'no baseline at %s; run with --save-baseline' % args.baseline
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for line in regressions:
+        print 'REGRESSION %s' % line
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+"""
+bench_mapper.py -- end-to-end run of the mapper.py jobs on testbed stubs
+
+$Id$
+
+Usage:
+    python -m benchmarks.bench_mapper [--shards N] [--fail-rate P]
+        [--seed S] [--conferences N] [--sessions N] [--profiles N]
+        [--wishlist N]
+
+Generates a seeded data set and turns part of it back into the legacy
+layouts: urlsafe attendance strings without ConferenceAttendee entries,
+and wishlist items with generated ids. It then starts migrate_attendance,
+migrate_wishlists and reindex_ConferenceSession through /mapper/start,
+runs the task queue dry and checks the data. Batches fail at random with
+--fail-rate, so shards have to resume from their checkpoints. The report
+gives time, task runs, entities processed and the checks per job; the
+exit status is 1 if a check fails.
+
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from benchmarks.harness import Harness
+
+from google.appengine.ext import ndb
+
+import jobs
+import mapper
+from benchmarks import datagen
+from models import ConferenceAttendee
+from models import Profile
+from models import SessionWishlistItem
+
+
+def _legacy(rng):
+    """Put a third of the attendance and wishlists in the old layouts."""
+    profiles = [p for p in Profile.query() if p.conferencesToAttend]
+    legacy = rng.sample(profiles, len(profiles) // 3)
+    for prof in legacy:
+        ndb.delete_multi([ndb.Key(ConferenceAttendee, prof.key.id(),
+                                  parent=c_key)
+                          for c_key in prof.conferencesToAttend])
+        prof.conferenceKeysToAttend = [
+            c_key.urlsafe() for c_key in prof.conferencesToAttend]
+        prof.conferencesToAttend = []
+    ndb.put_multi(legacy)
+
+    items = SessionWishlistItem.query().fetch()
+    items = rng.sample(items, len(items) // 3)
+    ndb.delete_multi([wl.key for wl in items])
+    ndb.put_multi([SessionWishlistItem(userId=wl.userId,
+                                       sessionKey=wl.sessionKey)
+                   for wl in items])
+
+
+def _flaky(function, rate, rng):
+    """Wrap a job function to fail a share of its batches."""
+    def wrapper(entities):
+        if rng.random() < rate:
+            raise RuntimeError('injected batch failure')
+        return function(entities)
+    return wrapper
+
+
+def _checks(name, model, status):
+    """Return the (description, passed) checks of a finished job."""
+    checks = [('status done', status['status'] == 'done')]
+    if name.startswith('reindex_'):
+        # migrations add and remove entities as they go
+        checks.append(('all processed',
+                       status['processed'] == model.query().count()))
+    return checks + _migrationChecks(name)
+
+
+def _migrationChecks(name):
+    if name == 'migrate_attendance':
+        profiles = Profile.query().fetch()
+        attendees = ConferenceAttendee.query().count()
+        return [
+            ('no legacy attendance',
+             not any(p.conferenceKeysToAttend for p in profiles)),
+            ('attendee index complete',
+             attendees == sum(len(p.conferencesToAttend) for p in profiles)),
+        ]
+    if name == 'migrate_wishlists':
+        items = SessionWishlistItem.query().fetch()
+        return [
+            ('no legacy items', all(wl.key.parent() for wl in items)),
+            ('no duplicates', len(items) == len(set(
+                (wl.userId, wl.sessionKey) for wl in items))),
+        ]
+    return []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shards', type=int, default=mapper.DEFAULT_SHARDS)
+    parser.add_argument('--fail-rate', type=float, default=0.1,
+                        help='share of batches failing once or more')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--profiles', type=int, default=2000)
+    parser.add_argument('--wishlist', type=int, default=4000)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    h = Harness()
+    ok = True
+    try:
+        datagen.generate(
+            conferences=args.conferences, sessions=args.sessions,
+            profiles=args.profiles, wishlistItems=args.wishlist,
+            seed=args.seed)
+        _legacy(rng)
+
+        print '%-26s %8s %7s %10s %8s  %s' % (
+            'job', 'seconds', 'tasks', 'processed', 'retries', 'checks')
+        for name in ('migrate_attendance', 'migrate_wishlists',
+                     'reindex_ConferenceSession'):
+            job = mapper.JOBS[name]
+            model, function = job[:2]
+            mapper.JOBS[name] = (
+                (model, _flaky(function, args.fail_rate, rng)) + job[2:])
+            started = time.time()
+            job_id = h.handle('/mapper/start', 'POST', {
+                'job': name, 'shards': args.shards}).body
+            tasks = h.drainTasks()
+            elapsed = time.time() - started
+            mapper.JOBS[name] = job
+
+            status = json.loads(h.handle(
+                '/mapper/status', 'GET', {'id': job_id}).body)
+            checks = _checks(name, model, status)
+            ok = ok and all(passed for _, passed in checks)
+            print '%-26s %8.2f %7d %10d %8d  %s' % (
+                name, elapsed, tasks, status['processed'],
+                sum(s['retries'] for s in status['shards']),
+                ', '.join('%s %s' % (c, 'ok' if passed else 'FAILED')
+                          for c, passed in checks))
+    finally:
+        h.close()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
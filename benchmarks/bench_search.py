@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+bench_search.py -- searchConferences on words with many longer terms
+    sharing their prefix, on testbed stubs
+
+$Id$
+
+Usage:
+    python -m benchmarks.bench_search [--iterations N] [--terms N]
+
+Indexes one conference named after a word and --terms conferences named
+after longer words starting with it, more than search.PREFIX_EXPANSION
+by default, then times searchConferences for the word and for one of the
+longer words. The checks make sure each search finds the conference
+named exactly after its word; the exit status is 1 if a check fails.
+
+"""
+
+import argparse
+import itertools
+import sys
+import time
+
+from benchmarks.harness import Harness
+
+from google.appengine.ext import ndb
+
+import search
+from benchmarks.bench_endpoints import percentile
+from models import Conference
+from models import Profile
+
+WORD = u'con'
+# no suffix search.stem() strips, no doubled letter
+LETTERS = u'abcfghkmpqtvwx'
+
+
+def _generate(terms):
+    """Index the conferences; return {word: websafe key}."""
+    organizer = ndb.Key(Profile, 'organizer@example.com')
+    words = [WORD] + [WORD + u''.join(pair) for pair in itertools.islice(
+        itertools.permutations(LETTERS, 2), terms)]
+    confs = [Conference(parent=organizer, name=word,
+                        organizerUserId=organizer.id()) for word in words]
+    ndb.put_multi(confs)
+    search.rebuild()
+    return dict((word, conf.key.urlsafe()) for word, conf in zip(words, confs))
+
+
+def _measure(h, query, iterations):
+    """Time searchConferences; return p50 ms."""
+    latencies = []
+    for _ in xrange(iterations):
+        started = time.time()
+        h.call('searchConferences', query=query)
+        latencies.append((time.time() - started) * 1000)
+    return percentile(latencies, 50)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--terms', type=int,
+                        default=search.PREFIX_EXPANSION + 5)
+    args = parser.parse_args(argv)
+
+    h = Harness()
+    try:
+        keys = _generate(args.terms)
+        longer = sorted(keys)[-1]
+        runs = [(query, _measure(h, query, args.iterations))
+                for query in (WORD, longer)]
+        checks = [('%s finds its own conference' % query,
+                   keys[query] in search.search(query))
+                  for query in (WORD, longer)]
+    finally:
+        h.close()
+
+    print '%-26s %9s' % ('searchConferences', 'p50 ms')
+    for query, p50 in runs:
+        print '%-26s %9.2f' % (query, p50)
+    for description, passed in checks:
+        print '%s %s' % (description, 'ok' if passed else 'FAILED')
+    return 0 if all(passed for _, passed in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
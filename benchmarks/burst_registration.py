@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+burst_registration.py -- registration burst on one conference, with and
+    without admission control, on testbed stubs
+
+$Id$
+
+Usage:
+    python -m benchmarks.burst_registration [--threads N] [--requests N]
+        [--seed S]
+
+Every thread acts as its own user and fires registerForConference at
+the same conference as fast as it can, as a retrying or misbehaving
+client would. The burst runs once with admission.py switched off and
+once with it on, each against a fresh conference. The report gives the
+status codes, latency of the admitted calls, and the datastore commits
+and commit retries on the conference's entity group.
+
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+from benchmarks.harness import Harness
+
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.ext import ndb
+
+import admission
+import rpcstats
+from benchmarks import loadgen
+from benchmarks.bench_endpoints import percentile
+from models import Conference
+from models import Profile
+
+
+def _hotConference(rng):
+    """Create a conference with a seat for every burst user."""
+    organizer = 'organizer@example.com'
+    Profile(key=ndb.Key(Profile, organizer), displayName='Organizer',
+            mainEmail=organizer).put()
+    c_key = ndb.Key(Conference, rng.randint(1, 10 ** 9),
+                    parent=ndb.Key(Profile, organizer))
+    Conference(key=c_key, name='Hot conference', organizerUserId=organizer,
+               maxAttendees=100000, seatsAvailable=100000).put()
+    return c_key.urlsafe()
+
+
+def _burst(h, wsck, threads, requests):
+    """Run one burst; returns ([(ms, status)], rpcstats totals)."""
+    calls = []
+    lock = threading.Lock()
+    start = threading.Event()
+
+    def worker(i):
+        loadgen._local.user = users.User(email='burst%04d@example.com' % i)
+        start.wait()
+        for _ in xrange(requests):
+            started = time.time()
+            try:
+                status = loadgen._callSpi(
+                    h, 'registerForConference', {'websafeConferenceKey': wsck})
+            except Exception:
+                status = 'exception'
+            with lock:
+                calls.append(((time.time() - started) * 1000, status))
+
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in xrange(threads)]
+    for t in workers:
+        t.start()
+    rpcstats.reset()
+    start.set()
+    for t in workers:
+        t.join()
+    return calls, rpcstats.totals()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=20,
+                        help='registrations fired by each thread')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    h = Harness()
+    endpoints.get_current_user = loadgen._threadUser
+    print '%-9s %7s %9s %9s %8s %8s  %s' % (
+        'admission', 'calls', 'p50 ms', 'p99 ms', 'commits', 'retries',
+        'statuses')
+    try:
+        for enabled in (False, True):
+            admission.ENABLED = enabled
+            memcache.flush_all()
+            calls, totals = _burst(
+                h, _hotConference(rng), args.threads, args.requests)
+
+            # latency of the calls that got through admission
+            ms = [latency for latency, status in calls if status != 503]
+            statuses = {}
+            for _, status in calls:
+                statuses[status] = statuses.get(status, 0) + 1
+            commit = totals.get(
+                'ConferenceApi.registerForConference', {'rpcs': {}})[
+                'rpcs'].get('datastore_v3.Commit', {})
+            print '%-9s %7d %9.2f %9.2f %8d %8d  %s' % (
+                'on' if enabled else 'off',
+                sum(statuses.values()), percentile(ms, 50),
+                percentile(ms, 99), commit.get('count', 0),
+                commit.get('errors', 0), json.dumps(statuses, sort_keys=True))
+    finally:
+        admission.ENABLED = True
+        h.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+datagen.py -- seeded synthetic data for the Conference Central benchmarks
+
+$Id$
+
+Writes Profiles, Conferences, ConferenceSessions, attendance and
+SessionWishlistItems straight through ndb in batches, then derives the
+session recommendations, conference facet counts and search index. The
+same seed always produces the same data set, so benchmark runs are
+comparable.
+
+"""
+
+import calendar
+import random
+import time
+from datetime import date
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.ext import ndb
+
+import facets
+import recommendations
+import search
+from models import Conference
+from models import ConferenceAttendee
+from models import ConferenceSession
+from models import ConferenceSessionType
+from models import Profile
+from models import SessionWishlistItem
+from models import TeeShirtSize
+
+BATCH = 500
+
+CITIES = ['Chicago', 'London', 'Paris', 'San Francisco', 'Tokyo',
+          'Berlin', 'New York', 'Sydney']
+TOPICS = ['Medical Innovations', 'Programming Languages',
+          'Web Technologies', 'Movie Making', 'Health and Nutrition']
+WORDS = ['cloud', 'scale', 'python', 'data', 'mobile', 'design', 'health',
+         'future', 'open', 'systems', 'learning', 'security', 'film',
+         'nutrition', 'web', 'performance', 'summit', 'forum', 'camp']
+SESSION_TYPES = ConferenceSessionType.names()
+
+
+class Dataset(object):
+
+    """Dataset -- keys of the generated entities, for picking inputs"""
+
+    def __init__(self):
+        self.userIds = []
+        self.conferenceKeys = []
+        self.organizerOf = {}
+        self.sessionKeys = []
+        self.sessionsOf = {}
+        self.speakers = []
+        self.wishlists = {}
+
+
+def _putInBatches(entities):
+    for i in xrange(0, len(entities), BATCH):
+        ndb.put_multi(entities[i:i + BATCH])
+
+
+def _phrase(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in xrange(n)).title()
+
+
+def generate(conferences=2000, sessions=20000, profiles=5000,
+             wishlistItems=20000, seed=42):
+    """Populate the datastore and return the resulting Dataset."""
+    rng = random.Random(seed)
+    data = Dataset()
+    now = int(calendar.timegm(time.gmtime()))
+
+    # profiles; key ids are emails, as getUserId() returns
+    profileEntities = []
+    for i in xrange(profiles):
+        email = 'user%05d@example.com' % i
+        data.userIds.append(email)
+        profileEntities.append(Profile(
+            key=ndb.Key(Profile, email),
+            displayName='User %d' % i,
+            mainEmail=email,
+            teeShirtSize=rng.choice(TeeShirtSize.names())))
+
+    # conferences, organized by a tenth of the users
+    organizers = data.userIds[:max(1, profiles // 10)]
+    # reserve ids so later createConference/createSession calls can't
+    # collide with generated entities
+    firstConfId = Conference.allocate_ids(size=conferences)[0]
+    firstSessionId = ConferenceSession.allocate_ids(size=sessions)[0]
+    conferenceEntities = []
+    for i in xrange(conferences):
+        organizer = rng.choice(organizers)
+        start = date(2015, 1, 1) + timedelta(days=rng.randint(0, 730))
+        maxAttendees = rng.choice([0, 50, 100, 200, 500, 1000])
+        c_key = ndb.Key(Conference, firstConfId + i,
+                        parent=ndb.Key(Profile, organizer))
+        conferenceEntities.append(Conference(
+            key=c_key,
+            name='%s %d' % (_phrase(rng, 2), i),
+            description=_phrase(rng, 12),
+            organizerUserId=organizer,
+            topics=rng.sample(TOPICS, rng.randint(1, 3)),
+            city=rng.choice(CITIES),
+            startDate=start,
+            month=start.month,
+            endDate=start + timedelta(days=rng.randint(0, 4)),
+            maxAttendees=maxAttendees,
+            seatsAvailable=maxAttendees))
+        wsck = c_key.urlsafe()
+        data.conferenceKeys.append(wsck)
+        data.organizerOf[wsck] = organizer
+        data.sessionsOf[wsck] = []
+
+    # sessions, spread unevenly so some agendas are large
+    data.speakers = ['Speaker %d' % i for i in xrange(max(1, sessions // 8))]
+    sessionEntities = []
+    for i in xrange(sessions):
+        conf = conferenceEntities[
+            int(rng.paretovariate(1.5) * 7) % len(conferenceEntities)]
+        day = conf.startDate + timedelta(
+            days=rng.randint(0, (conf.endDate - conf.startDate).days))
+        minute = rng.randrange(8 * 60, 20 * 60, 15)
+        duration = rng.choice([30, 45, 60, 90, 120])
+        start = datetime.combine(day, datetime.min.time()) + timedelta(
+            minutes=minute)
+        cs = ConferenceSession(
+            key=ndb.Key(ConferenceSession, firstSessionId + i,
+                        parent=conf.key),
+            name=_phrase(rng, 3),
+            highlights=_phrase(rng, 8),
+            speaker=rng.choice(data.speakers),
+            duration=duration,
+            typeOfSession=rng.choice(SESSION_TYPES),
+            date=day,
+            startTime='%02d:%02d' % divmod(minute, 60),
+            createdTime=now - rng.randint(0, 10 ** 6),
+            startDateTime=start,
+            endDateTime=start + timedelta(minutes=duration),
+            startMinute=minute)
+        sessionEntities.append(cs)
+        data.sessionKeys.append(cs.key.urlsafe())
+        data.sessionsOf[conf.key.urlsafe()].append(cs.key.urlsafe())
+
+    # attendance; seats are only taken where the conference has them
+    attendees = []
+    for prof in profileEntities:
+        for conf in rng.sample(conferenceEntities,
+                               min(len(conferenceEntities),
+                                   rng.randint(0, 4))):
+            if conf.seatsAvailable > 0:
+                conf.seatsAvailable -= 1
+                prof.conferencesToAttend.append(conf.key)
+                attendees.append(ConferenceAttendee(
+                    key=ndb.Key(ConferenceAttendee, prof.key.id(),
+                                parent=conf.key),
+                    userId=prof.key.id()))
+
+    # wishlists
+    wishlistEntities = []
+    for i in xrange(wishlistItems):
+        user = rng.choice(data.userIds)
+        sessionKey = rng.choice(data.sessionKeys)
+        wishlist = data.wishlists.setdefault(user, set())
+        if sessionKey in wishlist:
+            continue
+        wishlist.add(sessionKey)
+        wishlistEntities.append(SessionWishlistItem(
+            key=ndb.Key(Profile, user, SessionWishlistItem, sessionKey),
+            userId=user, sessionKey=sessionKey))
+
+    for entities in (profileEntities, conferenceEntities, sessionEntities,
+                     attendees, wishlistEntities):
+        _putInBatches(entities)
+    recommendations.rebuild()
+    facets.rebuild()
+    search.rebuild()
+    return data
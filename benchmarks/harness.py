@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+harness.py -- App Engine testbed environment shared by the benchmarks
+
+$Id$
+
+Sets up in-process datastore, memcache, taskqueue, mail and user stubs,
+with the rpcstats hooks on their API proxy, lets a benchmark act as a signed in Endpoints user, call ConferenceApi
+methods directly, send requests to main.app or the Endpoints SPI and
+drain queued tasks.
+
+The App Engine SDK must be importable; point APPENGINE_SDK at the
+google_appengine directory if it isn't already on sys.path.
+
+"""
+
+import os
+import sys
+import urllib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fixSysPath():
+    """Put the SDK, its bundled libraries and the app on sys.path."""
+    sdk = os.environ.get('APPENGINE_SDK')
+    if sdk and sdk not in sys.path:
+        sys.path.insert(0, sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+fixSysPath()
+
+import webapp2
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+AUTH_DOMAIN = 'gmail.com'
+
+
+class Harness(object):
+
+    """Harness -- activated testbed plus helpers to drive the app"""
+
+    def __init__(self, datastoreFile=None, saveChanges=False,
+                 importApp=True):
+        """Activate the stubs; datastoreFile backs the datastore with a
+        file, kept across runs when saveChanges is set. Without importApp
+        the app modules are left for loadApp().
+        """
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='conference-bench',
+                               auth_domain=AUTH_DOMAIN,
+                               overwrite=True)
+        # strongly consistent queries keep runs repeatable
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy,
+                                            datastore_file=datastoreFile,
+                                            save_changes=saveChanges)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_urlfetch_stub()
+        self.taskqueue = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        # activate() replaced the proxy app modules hooked on import
+        import rpcstats
+        rpcstats.install()
+
+        self.api = self.spi = self.app = None
+        if importApp:
+            self.loadApp()
+
+    def loadApp(self):
+        """Import the app; only once the stubs are in place."""
+        import conference
+        import main
+        self.api = conference.ConferenceApi()
+        self.spi = conference.api
+        self.app = main.app
+
+    def close(self):
+        self.testbed.deactivate()
+
+    def login(self, email):
+        """Act as the given Endpoints user; None signs out."""
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email or ''
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = AUTH_DOMAIN
+
+    def newRequest(self):
+        """Start a fresh request: forget ndb's in-context cache."""
+        ndb.get_context().clear_cache()
+
+    def requestType(self, name):
+        """Return the protorpc request message class of an endpoint."""
+        return getattr(type(self.api), name).remote.request_type
+
+    def call(self, name, email=None, **fields):
+        """Invoke a ConferenceApi method as the given user."""
+        self.login(email)
+        self.newRequest()
+        request = self.requestType(name)(**fields)
+        return getattr(self.api, name)(request)
+
+    def handle(self, url, method='GET', params=None, email=None):
+        """Send a request to main.app, signed in as the given user, and
+        return the webapp2 response."""
+        os.environ['USER_EMAIL'] = email or ''
+        self.newRequest()
+        if method == 'GET':
+            query = urllib.urlencode(params or {})
+            request = webapp2.Request.blank(
+                '%s?%s' % (url, query) if query else url)
+        else:
+            request = webapp2.Request.blank(url, POST=params or {})
+        response = request.get_response(self.app)
+        # run streamed bodies to the end
+        response.body
+        return response
+
+    def pendingTasks(self):
+        return self.taskqueue.get_filtered_tasks()
+
+    def drainTasks(self, limit=10000):
+        """Run queued tasks against main.app, including tasks they enqueue
+        and, as the task queue does, retries of failed tasks; returns the
+        number of task runs.
+        """
+        ran = 0
+        failed = []
+        while ran < limit:
+            tasks = self.taskqueue.get_filtered_tasks()
+            # delete task by task, so tasks queued meanwhile by other
+            # threads survive until the next pass
+            for task in tasks:
+                self.taskqueue.DeleteTask(task.queue_name, task.name)
+            tasks, failed = tasks + failed, []
+            if not tasks:
+                break
+            for task in tasks:
+                self.newRequest()
+                request = webapp2.Request.blank(
+                    task.url, method=task.method, body=task.payload,
+                    headers=dict(task.headers))
+                if request.get_response(self.app).status_int >= 500:
+                    failed.append(task)
+                ran += 1
+        return ran
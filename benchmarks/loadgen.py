@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+"""
+loadgen.py -- mixed-workload load generator for the Conference Central
+    WSGI apps on testbed stubs
+
+$Id$
+
+Usage:
+    python -m benchmarks.loadgen [--threads N] [--duration SECS]
+        [--mix name=weight,...] [--skew S] [--seed S]
+        [--conferences N] [--sessions N] [--profiles N] [--wishlist N]
+
+Worker threads send a weighted mix of API calls to the Endpoints SPI
+(conference.api) as JSON requests, with conference keys drawn from a
+Zipf distribution so a few hot conferences take most of the traffic.
+A background thread runs the tasks the calls enqueue through main.app,
+as the task queue would. The report gives throughput, latency
+percentiles and status codes per call, and the datastore commit retry
+and contention rates seen by rpcstats.
+
+"""
+
+import argparse
+import bisect
+import json
+import random
+import sys
+import threading
+import time
+
+from benchmarks.harness import Harness
+
+import endpoints
+import webapp2
+from google.appengine.api import users
+
+import rpcstats
+from benchmarks import datagen
+from benchmarks.bench_endpoints import percentile
+
+# the read-heavy mix of static/js/controllers.js plus session and
+# wishlist writes; unregistering keeps seats from running out
+DEFAULT_MIX = {
+    'getConference': 30,
+    'queryConferences': 15,
+    'getConferencesToAttend': 12,
+    'getProfile': 10,
+    'registerForConference': 10,
+    'unregisterFromConference': 6,
+    'getConferenceSessions': 8,
+    'createSession': 2,
+    'addSessionToWishlist': 7,
+}
+
+_local = threading.local()
+
+
+def _threadUser():
+    """Stand-in for endpoints.get_current_user(): the Endpoints library
+    reads the user from os.environ, which threads would share.
+    """
+    return getattr(_local, 'user', None)
+
+
+class Workload(object):
+
+    """Workload -- builds SPI request bodies from the generated data"""
+
+    def __init__(self, data, skew, seed):
+        self.data = data
+        # Zipf weights over conferences, hottest first
+        weights = [1.0 / (i + 1) ** skew
+                   for i in xrange(len(data.conferenceKeys))]
+        total = 0.0
+        self.cumulative = []
+        for w in weights:
+            total += w
+            self.cumulative.append(total)
+        self.seed = seed
+
+    def conference(self, rng):
+        point = rng.random() * self.cumulative[-1]
+        return self.data.conferenceKeys[
+            bisect.bisect_left(self.cumulative, point)]
+
+    def request(self, name, rng):
+        """Return (user, SPI method name, JSON body) for one call."""
+        d = self.data
+        user = rng.choice(d.userIds)
+        if name in ('getConference', 'registerForConference',
+                    'unregisterFromConference'):
+            return user, name, {'websafeConferenceKey': self.conference(rng)}
+        if name == 'queryConferences':
+            return user, name, {'filters': [
+                {'field': 'CITY', 'operator': 'EQ',
+                 'value': rng.choice(datagen.CITIES)}]}
+        if name == 'getConferenceSessions':
+            return (user, 'getConferenceSessionsByConfId',
+                    {'conferenceKey': self.conference(rng)})
+        if name == 'createSession':
+            wsck = self.conference(rng)
+            return d.organizerOf[wsck], name, {
+                'conferenceKey': wsck, 'name': 'Load session',
+                'speaker': rng.choice(d.speakers), 'duration': 60,
+                'typeOfSession': 'LECTURE', 'date': '2016-06-01',
+                'startTime': '%02d:00' % rng.randint(8, 19)}
+        if name == 'addSessionToWishlist':
+            return user, name, {'sessionKey': rng.choice(d.sessionKeys)}
+        return user, name, {}
+
+
+class Results(object):
+
+    """Results -- thread-safe per-call latencies and status codes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+
+    def add(self, name, ms, status):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(ms)
+            codes = self.statuses.setdefault(name, {})
+            codes[status] = codes.get(status, 0) + 1
+
+
+def _callSpi(h, method, body):
+    """POST one SPI request to conference.api; returns the HTTP status."""
+    request = webapp2.Request.blank(
+        '/_ah/spi/ConferenceApi.%s' % method, method='POST',
+        body=json.dumps(body),
+        headers={'Content-Type': 'application/json',
+                 'X-AppEngine-Peer': 'apiserving'})
+    h.newRequest()
+    return request.get_response(h.spi).status_int
+
+
+def _worker(h, workload, mix, deadline, results, seed):
+    rng = random.Random(seed)
+    names = sorted(mix)
+    cumulative = []
+    total = 0
+    for name in names:
+        total += mix[name]
+        cumulative.append(total)
+
+    while time.time() < deadline:
+        name = names[bisect.bisect_right(cumulative,
+                                         rng.random() * total)]
+        user, method, body = workload.request(name, rng)
+        _local.user = users.User(email=user)
+        started = time.time()
+        try:
+            status = _callSpi(h, method, body)
+        except Exception:
+            status = 'exception'
+        results.add(name, (time.time() - started) * 1000, status)
+
+
+def _taskRunner(h, deadline):
+    while time.time() < deadline:
+        if not h.drainTasks(limit=50):
+            time.sleep(0.05)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--mix', default='',
+                        help='comma separated name=weight overrides')
+    parser.add_argument('--skew', type=float, default=1.1,
+                        help='Zipf exponent of conference popularity')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--conferences', type=int, default=500)
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--profiles', type=int, default=2000)
+    parser.add_argument('--wishlist', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    mix = dict(DEFAULT_MIX)
+    for item in filter(None, args.mix.split(',')):
+        name, weight = item.split('=')
+        mix[name.strip()] = int(weight)
+    mix = dict((k, v) for k, v in mix.items() if v > 0)
+
+    h = Harness()
+    endpoints.get_current_user = _threadUser
+    try:
+        data = datagen.generate(conferences=args.conferences,
+                                sessions=args.sessions,
+                                profiles=args.profiles,
+                                wishlistItems=args.wishlist,
+                                seed=args.seed)
+        workload = Workload(data, args.skew, args.seed)
+        results = Results()
+        rpcstats.reset()
+
+        started = time.time()
+        deadline = started + args.duration
+        threads = [threading.Thread(
+            target=_worker,
+            args=(h, workload, mix, deadline, results, args.seed + i))
+            for i in xrange(args.threads)]
+        threads.append(threading.Thread(target=_taskRunner,
+                                        args=(h, deadline)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - started
+        totals = rpcstats.totals()
+    finally:
+        h.close()
+
+    calls = sum(len(v) for v in results.latencies.values())
+    print 'threads=%d duration=%.1fs calls=%d throughput=%.1f req/s' % (
+        args.threads, elapsed, calls, calls / elapsed)
+    print '%-28s %7s %9s %9s %9s  %s' % (
+        'call', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'statuses')
+    for name in sorted(results.latencies):
+        ms = results.latencies[name]
+        print '%-28s %7d %9.2f %9.2f %9.2f  %s' % (
+            name, len(ms), percentile(ms, 50), percentile(ms, 95),
+            percentile(ms, 99), json.dumps(results.statuses[name],
+                                           sort_keys=True))
+
+    # ndb retries a transaction when its commit hits contention
+    commits = failed = 0
+    for total in totals.values():
+        commit = total['rpcs'].get('datastore_v3.Commit')
+        if commit:
+            commits += commit['count']
+            failed += commit['errors']
+    # calls whose transaction still failed after ndb's retries
+    contended = sum(codes.get(500, 0)
+                    for codes in results.statuses.values())
+    print 'commits=%d commit retries=%d (%.2f%%) contended calls=%d ' \
+          '(%.2f%%)' % (commits, failed, 100.0 * failed / max(commits, 1),
+                        contended, 100.0 * contended / max(calls, 1))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
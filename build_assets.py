@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""
+build_assets.py -- Conference Central offline static asset pipeline
+
+$Id$
+
+Usage:
+    python build_assets.py
+
+Reads templates/index.html and bundles the local stylesheets and scripts
+it references, in page order, into one minified CSS and one minified JS
+file. The static/partials templates are inlined into the JS bundle as an
+Angular $templateCache run block, so routes need no further requests.
+Bundles, images and fonts are written to static/dist under content-hashed
+names, and every reference to them is rewritten accordingly.
+
+Outputs (all generated, not checked in):
+    static/dist/            fingerprinted bundles & assets
+    templates/index.dist.html
+    app.dist.yaml           app.yaml serving the above; /dist is cached
+                            for a year, index.dist.html is always
+                            revalidated
+
+Deploy with the generated config:
+    python build_assets.py && appcfg.py update app.dist.yaml
+
+The dev server keeps serving the unbundled sources through app.yaml.
+
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DIST_DIR = os.path.join('static', 'dist')
+DIST_URL = '/dist/'
+INDEX_SRC = os.path.join('templates', 'index.html')
+INDEX_OUT = os.path.join('templates', 'index.dist.html')
+APP_YAML_SRC = 'app.yaml'
+APP_YAML_OUT = 'app.dist.yaml'
+ANGULAR_MODULE = 'conferenceApp'
+
+# url prefix -> directory, as mapped by the static_dir handlers in app.yaml
+STATIC_DIRS = {
+    '/css/': os.path.join('static', 'bootstrap', 'css'),
+    '/js/': os.path.join('static', 'js'),
+    '/img/': os.path.join('static', 'img'),
+    '/fonts/': os.path.join('static', 'fonts'),
+    '/partials/': os.path.join('static', 'partials'),
+}
+# binary assets copied under fingerprinted names
+ASSET_PREFIXES = ('/img/', '/fonts/')
+# CDN stylesheets made redundant by the local bundle; bootstrap-cosmo.css
+# is a complete Bootstrap 3.1.1 build
+REDUNDANT_STYLESHEETS = (
+    '//netdna.bootstrapcdn.com/bootstrap/3.1.1/css/bootstrap.min.css',
+)
+
+DIST_HANDLER = '''- url: /dist
+  static_dir: static/dist
+  expiration: "365d"
+  http_headers:
+    Cache-Control: public, max-age=31536000, immutable
+
+'''
+INDEX_HANDLER_SRC = '''  static_files: templates/index.html
+  upload: templates/index\\.html
+'''
+INDEX_HANDLER_OUT = '''  static_files: templates/index.dist.html
+  upload: templates/index\\.dist\\.html
+  http_headers:
+    Cache-Control: no-cache
+'''
+
+STYLESHEET_RE = re.compile(
+    r'[ \t]*<link rel="stylesheet" href="([^"]+)">[ \t]*\n')
+SCRIPT_RE = re.compile(r'[ \t]*<script src="([^"]+)"></script>[ \t]*\n')
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+ASSET_REF_RE = re.compile(r'''(["'(])(/(?:img|fonts)/[^"')?#]+)''')
+
+
+def _read(path):
+    with open(os.path.join(ROOT, path), 'rb') as f:
+        return f.read()
+
+
+def _write(path, data):
+    with open(os.path.join(ROOT, path), 'wb') as f:
+        f.write(data)
+
+
+def _localPath(url):
+    """Return the source file served at a local static url, or None."""
+    for prefix, directory in STATIC_DIRS.items():
+        if url.startswith(prefix):
+            return os.path.join(directory, url[len(prefix):])
+    return None
+
+
+def fingerprint(name, data):
+    """Return name with a hash of data inserted before its extension."""
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, hashlib.sha1(data).hexdigest()[:10], ext)
+
+
+def _emit(name, data):
+    """Write data to static/dist under a fingerprinted name; return its url."""
+    hashed = fingerprint(name, data)
+    _write(os.path.join(DIST_DIR, hashed), data)
+    return DIST_URL + hashed
+
+
+# - - - minification - - - - - - - - - - - - - - - - - - - - - - - -
+
+def minifyCss(css):
+    """Strip comments and redundant whitespace from a stylesheet."""
+    out = []
+    i, n = 0, len(css)
+    while i < n:
+        c = css[i]
+        if c in '"\'':
+            end = i + 1
+            while end < n and css[end] != c:
+                end += 2 if css[end] == '\\' else 1
+            out.append(css[i:end + 1])
+            i = end + 1
+        elif css.startswith('/*', i):
+            end = css.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+        else:
+            out.append(c)
+            i += 1
+    css = ''.join(out)
+    css = re.sub(r'\s+', ' ', css)
+    # ':' is left alone, a space before it is a descendant selector
+    css = re.sub(r' ?([{};,>]) ?', r'\1', css)
+    css = css.replace(';}', '}')
+    return css.strip() + '\n'
+
+
+# a '/' after one of these starts a regular expression, not a division
+_REGEX_AFTER_CHARS = '(,=:[!&|?{};+-*%<>~^'
+_REGEX_AFTER_WORDS = ('return', 'typeof', 'case', 'in', 'of', 'delete',
+                      'void', 'throw', 'new', 'else', 'do')
+
+
+def _regexAllowed(out):
+    text = ''.join(out[-40:]).rstrip()
+    if not text:
+        return True
+    if text[-1] in _REGEX_AFTER_CHARS:
+        return True
+    word = re.search(r'[A-Za-z_$][\w$]*$', text)
+    return bool(word) and word.group() in _REGEX_AFTER_WORDS
+
+
+def minifyJs(js):
+    """Strip comments, indentation and blank lines from a script.
+    Line breaks are kept, so automatic semicolon insertion still sees
+    the statements exactly as written.
+    """
+    out = []
+    i, n = 0, len(js)
+    while i < n:
+        c = js[i]
+        if c in '"\'':
+            end = i + 1
+            while end < n and js[end] != c:
+                end += 2 if js[end] == '\\' else 1
+            out.append(js[i:end + 1])
+            i = end + 1
+        elif js.startswith('//', i):
+            end = js.find('\n', i)
+            i = n if end < 0 else end
+        elif js.startswith('/*', i):
+            end = js.find('*/', i + 2)
+            # a comment spanning lines still separates statements
+            out.append('\n' if '\n' in js[i:end] else ' ')
+            i = n if end < 0 else end + 2
+        elif c == '/' and _regexAllowed(out):
+            end, inClass = i + 1, False
+            while end < n and (js[end] != '/' or inClass):
+                if js[end] == '\\':
+                    end += 1
+                elif js[end] == '[':
+                    inClass = True
+                elif js[end] == ']':
+                    inClass = False
+                end += 1
+            out.append(js[i:end + 1])
+            i = end + 1
+        else:
+            out.append(c)
+            i += 1
+    lines = [line.strip() for line in ''.join(out).split('\n')]
+    return '\n'.join(line for line in lines if line) + '\n'
+
+
+# - - - reference rewriting - - - - - - - - - - - - - - - - - - - -
+
+def buildAssets():
+    """Copy images and fonts to static/dist; return {url: hashed url}."""
+    assets = {}
+    for prefix in ASSET_PREFIXES:
+        directory = STATIC_DIRS[prefix]
+        for name in sorted(os.listdir(os.path.join(ROOT, directory))):
+            assets[prefix + name] = _emit(
+                name, _read(os.path.join(directory, name)))
+    return assets
+
+
+def rewriteCssUrls(css, url, assets):
+    """Point url() references of the stylesheet served at url to assets."""
+    base = posixpath.dirname(url)
+
+    def replace(match):
+        ref = match.group(2)
+        if ref.startswith(('data:', 'http:', 'https:', '//')):
+            return match.group(0)
+        path, suffix = re.match(r'([^?#]*)(.*)', ref).groups()
+        absolute = posixpath.normpath(posixpath.join(base, path))
+        if absolute not in assets:
+            return match.group(0)
+        return "url('%s%s')" % (assets[absolute], suffix)
+    return CSS_URL_RE.sub(replace, css)
+
+
+def rewriteAssetRefs(text, assets):
+    """Point quoted /img/ and /fonts/ references to assets."""
+    return ASSET_REF_RE.sub(
+        lambda m: m.group(1) + assets.get(m.group(2), m.group(2)), text)
+
+
+def templateCache(assets):
+    """Return a script putting every partial into Angular's $templateCache."""
+    lines = ["angular.module('%s').run(['$templateCache', "
+             "function ($templateCache) {" % ANGULAR_MODULE]
+    directory = STATIC_DIRS['/partials/']
+    for name in sorted(os.listdir(os.path.join(ROOT, directory))):
+        html = rewriteAssetRefs(_read(os.path.join(directory, name)), assets)
+        lines.append('$templateCache.put(%s, %s);' % (
+            json.dumps('/partials/' + name), json.dumps(html.decode('utf-8'))))
+    lines.append('}]);')
+    return '\n'.join(lines) + '\n'
+
+
+# - - - build - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _bundle(index, pattern, build, tag):
+    """Replace the local references matched by pattern with a single tag
+    for the bundle build(urls) returns; other references are kept.
+    """
+    urls = [m.group(1) for m in pattern.finditer(index)
+            if _localPath(m.group(1))]
+    if not urls:
+        return index
+    bundleUrl = build(urls)
+    state = {'placed': False}
+
+    def replace(match):
+        url = match.group(1)
+        if url in REDUNDANT_STYLESHEETS:
+            return ''
+        if not _localPath(url):
+            return match.group(0)
+        if state['placed']:
+            return ''
+        state['placed'] = True
+        indent = re.match(r'[ \t]*', match.group(0)).group()
+        return indent + tag % bundleUrl + '\n'
+    return pattern.sub(replace, index)
+
+
+def build():
+    """Run the pipeline; returns {bundle name: url}."""
+    dist = os.path.join(ROOT, DIST_DIR)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    os.makedirs(dist)
+
+    assets = buildAssets()
+    bundles = {}
+
+    def buildCss(urls):
+        css = ''.join(
+            rewriteCssUrls(_read(_localPath(url)), url, assets) + '\n'
+            for url in urls)
+        bundles['css'] = _emit('app.css', minifyCss(css))
+        return bundles['css']
+
+    def buildJs(urls):
+        js = ''.join(rewriteAssetRefs(_read(_localPath(url)), assets) + '\n'
+                     for url in urls)
+        js += templateCache(assets)
+        bundles['js'] = _emit('app.js', minifyJs(js))
+        return bundles['js']
+
+    index = _read(INDEX_SRC)
+    index = _bundle(index, STYLESHEET_RE, buildCss,
+                    '<link rel="stylesheet" href="%s">')
+    index = _bundle(index, SCRIPT_RE, buildJs, '<script src="%s"></script>')
+    index = rewriteAssetRefs(index, assets)
+    _write(INDEX_OUT, index)
+
+    config = _read(APP_YAML_SRC)
+    if INDEX_HANDLER_SRC not in config or '- url: /js\n' not in config:
+        raise ValueError('%s handlers changed; update build_assets.py' %
+                         APP_YAML_SRC)
+    config = config.replace(INDEX_HANDLER_SRC, INDEX_HANDLER_OUT)
+    config = config.replace('- url: /js\n', DIST_HANDLER + '- url: /js\n', 1)
+    _write(APP_YAML_OUT, config)
+    return bundles
+
+
+def main():
+    bundles = build()
+    for name, url in sorted(bundles.items()):
+        print '%-4s %s' % (name, url)
+    print 'wrote %s and %s' % (INDEX_OUT, APP_YAML_OUT)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,8 +13,10 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 import calendar
+import heapq
 import time
 from datetime import datetime
+from datetime import timedelta
 
 import logging
 
@@ -30,16 +32,21 @@ from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
 from models import ConflictException
+from models import PreconditionFailedException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
 from models import StringMessage
 from models import BooleanMessage
+from models import IntegerMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceFacetsForm
+from models import DashboardForm
+from models import FacetCountForm
 from models import TeeShirtSize
 from models import ConferenceSession
 from models import ConferenceSessionForm
@@ -51,19 +58,59 @@ from models import GetFeaturedSpeakerResponse
 from models import GetConferenceSpeakersResponse
 from models import ConferenceWithWishlistSession
 from models import ConferencesWithWishlistSessionResponse
+from models import WaitlistEntry
+from models import WaitlistPositionForm
+from models import ConferenceAttendee
+from models import AttendeeForm
+from models import AttendeeForms
+from models import SessionConflictForm
+from models import SessionConflictForms
+from models import ConferenceAgenda
+from models import Tombstone
+from models import TombstoneForm
+from models import WishlistItemForm
+from models import WishlistSize
+from models import SyncChangesForm
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
+import archive
+import etags
+import facets
+import profiler
+import search
+import recommendations
+import rpcstats
+import tasks
+from admission import rateLimited
+from idempotency import idempotent
+from rpcstats import instrumented
 from utils import getUserId
 
+rpcstats.install()
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
-                    'are nearly sold out: %s')
+ATTENDEES_PAGE_SIZE = 100
+# sessions one modifyWishlist call may add and remove
+WISHLIST_CHANGE_LIMIT = 100
+SYNC_PAGE_SIZE = 200
+SEARCH_PAGE_SIZE = 20
+# websafe keys one getConferencesByKeys call may look up
+CONFERENCES_BY_KEYS_LIMIT = 100
+# writes stamped just before a checkpoint may reach the updated-time
+# indexes after it; every sync re-sends this much history
+SYNC_OVERLAP = timedelta(seconds=60)
+SYNC_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# ConferenceForm fields updateConference() may change; month and
+# seatsAvailable follow from them
+CONFERENCE_UPDATE_FIELDS = ('name', 'description', 'topics', 'city',
+                            'startDate', 'endDate', 'maxAttendees')
+# fields whose change the search index must see
+SEARCH_FIELDS = ('name', 'description')
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -94,9 +141,32 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_GET_COND_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+COND_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
+CONFS_CREATED_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+    includeArchived=messages.BooleanField(2),
+)
+
+CONFS_BY_KEYS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKeys=messages.StringField(1, repeated=True),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
-    websafeConferenceKey=messages.StringField(1)
+    websafeConferenceKey=messages.StringField(1),
+    ifMatch=messages.StringField(2),
 )
 
 CREATE_CSESSION_REQ = endpoints.ResourceContainer(
@@ -108,10 +178,19 @@ CREATE_CSESSION_REQ = endpoints.ResourceContainer(
     date=messages.StringField(6, required=True),
     startTime=messages.StringField(7, required=True),
     conferenceKey=messages.StringField(8, required=True),
+    idempotencyKey=messages.StringField(9),
+)
+
+ATTENDEES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
 )
 
 GET_CSESSION_BY_CID_REQ = endpoints.ResourceContainer(
-    conferenceKey=messages.StringField(1, required=True)
+    conferenceKey=messages.StringField(1, required=True),
+    ifNoneMatch=messages.StringField(2),
 )
 
 GET_CSESSION_BY_TYPE_REQ = endpoints.ResourceContainer(
@@ -119,6 +198,14 @@ GET_CSESSION_BY_TYPE_REQ = endpoints.ResourceContainer(
     typeOfSession=messages.EnumField(ConferenceSessionType, 2, required=True)
 )
 
+GET_SCHEDULE_REQ = endpoints.ResourceContainer(
+    conferenceKey=messages.StringField(1, required=True),
+    date=messages.StringField(2),
+    startsAfter=messages.StringField(3),
+    startsBefore=messages.StringField(4),
+    excludeTypes=messages.EnumField(ConferenceSessionType, 5, repeated=True),
+)
+
 GET_CSESSION_BY_SPEAKER_REQ = endpoints.ResourceContainer(
     speaker=messages.StringField(1, required=True),
 )
@@ -127,6 +214,16 @@ CREATE_WISHLIST_ITEM_REQ = endpoints.ResourceContainer(
     sessionKey=messages.StringField(1, required=True)
 )
 
+MODIFY_WISHLIST_REQ = endpoints.ResourceContainer(
+    add=messages.StringField(1, repeated=True),
+    remove=messages.StringField(2, repeated=True),
+)
+
+GET_RECOMMENDED_SESSIONS_REQ = endpoints.ResourceContainer(
+    sessionKey=messages.StringField(1, required=True),
+    limit=messages.IntegerField(2),
+)
+
 GET_FEATURED_SPEAKER_REQ = endpoints.ResourceContainer(
     conferenceKey=messages.StringField(1, required=True)
 )
@@ -135,6 +232,19 @@ GET_CONF_SPEAKERS_REQ = endpoints.ResourceContainer(
     conferenceKey=messages.StringField(1, required=True)
 )
 
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    query=messages.StringField(1, required=True),
+    limit=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+SYNC_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    since=messages.StringField(1),
+    pageToken=messages.StringField(2),
+)
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
@@ -190,6 +300,9 @@ class ConferenceApi(remote.Service):
                 field.name) for field in request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
+        del data['idempotencyKey']
 
         # add default values for those missing (both data model & outbound
         # Message)
@@ -227,62 +340,151 @@ class ConferenceApi(remote.Service):
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        conf = Conference(**data)
+        conf.put()
+        facets.adjust(None, facets.cell(conf))
+        search.indexLater(c_key.urlsafe())
         taskqueue.add(params={'email': user.email(),
                               'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
+                      url='/tasks/send_confirmation_email',
+                      transactional=ndb.in_transaction()
                       )
         return request
 
-    @ndb.transactional()
-    def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {
-            field.name: getattr(
-                request,
-                field.name) for field in request.all_fields()}
+    @staticmethod
+    def _conferenceChanges(request):
+        """Return {field: value} of the fields an update request sets,
+        parsed; empty fields are left unchanged."""
+        changes = {}
+        for name in CONFERENCE_UPDATE_FIELDS:
+            value = getattr(request, name)
+            if value in (None, []):
+                continue
+            if name in ('startDate', 'endDate'):
+                try:
+                    value = datetime.strptime(value[:10], "%Y-%m-%d").date()
+                except ValueError:
+                    raise endpoints.BadRequestException(
+                        'Invalid %s: %s' % (name, value))
+            elif name == 'maxAttendees' and value < 0:
+                raise endpoints.BadRequestException(
+                    'maxAttendees must not be negative')
+            changes[name] = value
+        return changes
 
-        # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        # check that conference exists
+    @staticmethod
+    def _checkConferenceUpdate(conf, user_id, version):
+        """Raise unless the user may update conf, at version if given."""
         if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' %
-                request.websafeConferenceKey)
-
-        # check that user is owner
+            raise endpoints.NotFoundException('No conference found')
         if user_id != conf.organizerUserId:
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
+        if version is not None and conf.version != version:
+            # the client's ETag may come from a stale mirror
+            etags.repairVersion(conf.key, conf.version)
+            raise PreconditionFailedException(
+                'The conference was changed since version %d' % version)
 
-        # Not getting all the fields, so don't create a new object; just
-        # copy relevant fields from ConferenceForm to Conference object
-        for field in request.all_fields():
-            data = getattr(request, field.name)
-            # only copy fields where we get data
-            if data not in (None, []):
-                # special handling for dates (convert string to Date)
-                if field.name in ('startDate', 'endDate'):
-                    data = datetime.strptime(data, "%Y-%m-%d").date()
-                    if field.name == 'startDate':
-                        conf.month = data.month
-                # write to Conference object
-                setattr(conf, field.name, data)
+    @staticmethod
+    @ndb.transactional
+    def _writeConferenceChanges(c_key, user_id, version, changes):
+        """Apply changes to a conference and recompute its derived fields;
+        writes only if a field actually changed."""
+        conf = c_key.get()
+        ConferenceApi._checkConferenceUpdate(conf, user_id, version)
+        changed = [name for name, value in changes.items()
+                   if getattr(conf, name) != value]
+        if not changed:
+            return conf
+
+        old_cell = facets.cell(conf)
+        old_seats = conf.seatsAvailable or 0
+        if 'maxAttendees' in changed:
+            # registered attendees keep their seats
+            seats = old_seats + changes['maxAttendees'] - (
+                conf.maxAttendees or 0)
+            if seats < 0:
+                raise ConflictException(
+                    'maxAttendees is below the %d registered attendees' % (
+                        (conf.maxAttendees or 0) - old_seats))
+            conf.seatsAvailable = seats
+        for name in changed:
+            setattr(conf, name, changes[name])
+        if 'startDate' in changed:
+            conf.month = conf.startDate.month
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
+
+        # the etags version and the organizer's stamp follow from put()
+        facets.adjust(old_cell, facets.cell(conf))
+        if set(changed) & set(SEARCH_FIELDS):
+            search.indexLater(c_key.urlsafe())
+        if conf.seatsAvailable > old_seats and conf.waitlistCount:
+            taskqueue.add(params={'websafeConferenceKey': c_key.urlsafe()},
+                          url='/tasks/promote_waitlist', transactional=True)
+        # the announcement lists nearly sold out conferences by name
+        if ('name' in changed or conf.seatsAvailable != old_seats) and (
+                0 < old_seats <= 5 or 0 < conf.seatsAvailable <= 5):
+            ndb.get_context().call_on_commit(tasks.cacheAnnouncement)
+        return conf
+
+    def _updateConferenceObject(self, request):
+        """Update the fields set in the request; with an ifMatch ETag or
+        version, only if the conference is still at that version. An
+        update changing nothing costs one batched get and no transaction.
+        """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        changes = self._conferenceChanges(request)
+        version = None
+        etag = self._ifMatch(request)
+        if etag:
+            version = etags.leadingVersion(etag)
+            if version is None:
+                raise endpoints.BadRequestException(
+                    'Invalid ifMatch: %s' % etag)
+
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf, prof = ndb.get_multi([c_key, ndb.Key(Profile, user_id)])
+        self._checkConferenceUpdate(conf, user_id, version)
+        if any(getattr(conf, name) != value
+               for name, value in changes.items()):
+            conf = self._writeConferenceChanges(
+                c_key, user_id, version, changes)
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
+    def _ifMatch(self, request):
+        """Return the precondition ETag of an update, from the request's
+        ifMatch field or its If-Match header.
+        """
+        etag = getattr(request, 'ifMatch', None)
+        if not etag:
+            state = getattr(self, 'request_state', None)
+            headers = getattr(state, 'headers', None)
+            etag = headers and headers.get('If-Match')
+        return etag
+
+    def _ifNoneMatch(self, request):
+        """Return the ETag the client already holds, from the request's
+        ifNoneMatch field or its If-None-Match header.
+        """
+        etag = getattr(request, 'ifNoneMatch', None)
+        if not etag:
+            state = getattr(self, 'request_state', None)
+            headers = getattr(state, 'headers', None)
+            etag = headers and headers.get('If-None-Match')
+        return etag
+
     @endpoints.method(
         message_types.VoidMessage,
         ConferencesWithWishlistSessionResponse,
         path='getConferencesWithWishlistedSessions',
         http_method='GET',
         name='getConferencesWithWishlistedSessions')
+    @instrumented
     def getConferencesWithWishlistedSessions(self, request):
         """Returns conferences which have sessions the user has wishlisted."""
         user = endpoints.get_current_user()
@@ -316,6 +518,8 @@ class ConferenceApi(remote.Service):
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
+    @instrumented
+    @idempotent(ConferenceForm)
     def createConference(self, request):
         """Create new conference."""
         return self._createConferenceObject(request)
@@ -323,28 +527,71 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_POST_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='PUT', name='updateConference')
+    @instrumented
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_GET_COND_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
+    @instrumented
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # the organizer's displayName is part of the form
+        etag = etags.compute(keys=[c_key, c_key.parent()])
+        if etag and etag == self._ifNoneMatch(request):
+            return ConferenceForm(etag=etag, notModified=True)
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = archive.getMulti([c_key])[0]
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' %
                 request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        # the key of an archived conference has the archive namespace
+        prof = ndb.Key(Profile, conf.organizerUserId).get()
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf,
+                                        getattr(prof, 'displayName', None))
+        cf.etag = etag
+        return cf
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(CONFS_BY_KEYS_REQUEST, ConferenceForms,
+                      path='getConferencesByKeys',
+                      http_method='POST', name='getConferencesByKeys')
+    @instrumented
+    def getConferencesByKeys(self, request):
+        """Return the conferences of up to CONFERENCES_BY_KEYS_LIMIT
+        websafe keys, in request order; unknown keys are skipped."""
+        if len(request.websafeConferenceKeys) > CONFERENCES_BY_KEYS_LIMIT:
+            raise endpoints.BadRequestException(
+                'At most %d keys per call' % CONFERENCES_BY_KEYS_LIMIT)
+        c_keys = []
+        for wsck in request.websafeConferenceKeys:
+            try:
+                c_key = ndb.Key(urlsafe=wsck)
+            except Exception:
+                continue
+            if c_key.kind() == 'Conference' and c_key.parent():
+                c_keys.append(c_key)
+
+        confs = [conf for conf in archive.getMulti(c_keys) if conf]
+        # one batch of organizer profiles; profiles stay live, so an
+        # archived conference's parent key won't find its organizer
+        p_keys = list(set(ndb.Key(Profile, conf.organizerUserId)
+                          for conf in confs))
+        names = dict((p_key.id(), getattr(prof, 'displayName', None))
+                     for p_key, prof in zip(p_keys, ndb.get_multi(p_keys)))
+        return ConferenceForms(items=[
+            self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+            for conf in confs])
+
+    @endpoints.method(CONFS_CREATED_REQUEST, ConferenceForms,
                       path='getConferencesCreated',
                       http_method='POST', name='getConferencesCreated')
+    @instrumented
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
@@ -352,10 +599,21 @@ class ConferenceApi(remote.Service):
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
+        p_key = ndb.Key(Profile, user_id)
+
+        stamps = ['conferences-' + p_key.urlsafe()]
+        if request.includeArchived:
+            stamps.append('archived-conferences-' + p_key.urlsafe())
+        etag = etags.compute(keys=[p_key], stamps=stamps)
+        if etag and etag == self._ifNoneMatch(request):
+            return ConferenceForms(etag=etag, notModified=True)
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = Conference.query(ancestor=p_key).fetch()
+        if request.includeArchived:
+            confs += Conference.query(
+                ancestor=archive.archivedKey(p_key)).fetch()
+        prof = p_key.get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[
@@ -363,11 +621,12 @@ class ConferenceApi(remote.Service):
                     conf,
                     getattr(
                         prof,
-                        'displayName')) for conf in confs])
+                        'displayName')) for conf in confs],
+            etag=etag)
 
-    def _getQuery(self, request):
+    def _getQuery(self, request, namespace=None):
         """Return formatted query from the submitted filters."""
-        q = Conference.query()
+        q = Conference.query(namespace=namespace)
         inequality_filter, filters = self._formatFilters(request.filters)
 
         # If exists, sort on inequality filter first
@@ -378,8 +637,6 @@ class ConferenceApi(remote.Service):
             q = q.order(Conference.name)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(
                 filtr["field"],
                 filtr["operator"],
@@ -404,6 +661,8 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
+            if filtr["field"] in ["month", "maxAttendees"]:
+                filtr["value"] = int(filtr["value"])
 
             # Every operation except "=" is an inequality
             if filtr["operator"] != "=":
@@ -424,9 +683,19 @@ class ConferenceApi(remote.Service):
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
+    @instrumented
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
+        conferences = self._getQuery(request).fetch()
+        if request.includeArchived:
+            # merge in the archive, keeping the order of the query
+            inequality_field, _ = self._formatFilters(request.filters)
+            conferences = sorted(
+                conferences + self._getQuery(
+                    request, archive.ARCHIVE_NAMESPACE).fetch(),
+                key=lambda conf: (
+                    getattr(conf, inequality_field) if inequality_field
+                    else None, conf.name))
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
@@ -447,6 +716,59 @@ class ConferenceApi(remote.Service):
                     names[
                         conf.organizerUserId]) for conf in conferences])
 
+    @endpoints.method(ConferenceQueryForms, ConferenceFacetsForm,
+                      path='getConferenceFacets',
+                      http_method='POST',
+                      name='getConferenceFacets')
+    @instrumented
+    def getConferenceFacets(self, request):
+        """Count the conferences matching a query per city, topic and
+        month, from the precomputed facet counts where they suffice."""
+        _, filters = self._formatFilters(request.filters)
+        result = facets.counts(filters)
+        if result is None:
+            # a maxAttendees filter splits a bucket of the precomputed
+            # counts; count the matching conferences instead
+            result = facets.tally(self._getQuery(request))
+        total, cities, topics, months = result
+
+        def forms(counts):
+            return [FacetCountForm(value=unicode(value), count=count)
+                    for value, count in sorted(
+                        counts.iteritems(), key=lambda e: (-e[1], e[0]))]
+        return ConferenceFacetsForm(
+            total=total, cities=forms(cities), topics=forms(topics),
+            months=forms(months))
+
+    @endpoints.method(SEARCH_REQUEST, ConferenceForms,
+                      path='searchConferences',
+                      http_method='GET',
+                      name='searchConferences')
+    @instrumented
+    def searchConferences(self, request):
+        """Search conference and session text; best matches first."""
+        limit = min(request.limit or SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE)
+        try:
+            offset = int(request.pageToken or 0)
+            if offset < 0:
+                raise ValueError(offset)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid pageToken')
+        matches = search.search(request.query)
+        page = matches[offset:offset + limit]
+
+        # the index lags deletions; skip conferences that are gone
+        confs = [c for c in ndb.get_multi(
+            [ndb.Key(urlsafe=wsck) for wsck in page]) if c]
+        profiles = ndb.get_multi(
+            [ndb.Key(Profile, c.organizerUserId) for c in confs])
+        names = dict((p.key.id(), p.displayName) for p in profiles if p)
+        return ConferenceForms(
+            items=[self._copyConferenceToForm(
+                conf, names.get(conf.organizerUserId)) for conf in confs],
+            nextPageToken=str(offset + limit)
+            if offset + limit < len(matches) else None)
+
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
@@ -466,6 +788,9 @@ class ConferenceApi(remote.Service):
                             getattr(
                                 prof,
                                 field.name)))
+                elif field.name == 'conferenceKeysToAttend':
+                    pf.conferenceKeysToAttend = [
+                        k.urlsafe() for k in prof.conferencesToAttend]
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
         pf.check_initialized()
@@ -491,6 +816,10 @@ class ConferenceApi(remote.Service):
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
             profile.put()
+        elif profile.conferenceKeysToAttend:
+            # written back at once; a caller writing it later may hold
+            # it past a concurrent change
+            profile = tasks.upgradeStoredProfile(p_key)
 
         return profile      # return Profile
 
@@ -515,76 +844,103 @@ class ConferenceApi(remote.Service):
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @endpoints.method(COND_GET_REQUEST, ProfileForm,
                       path='profile', http_method='GET', name='getProfile')
+    @instrumented
     def getProfile(self, request):
         """Return user profile."""
-        return self._doProfile()
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        p_key = ndb.Key(Profile, getUserId(user))
+
+        etag = etags.compute(keys=[p_key])
+        if etag and etag == self._ifNoneMatch(request):
+            return ProfileForm(etag=etag, notModified=True)
+
+        pf = self._doProfile()
+        # a first visit has just created the Profile
+        pf.etag = etag or etags.compute(keys=[p_key])
+        return pf
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
                       path='profile', http_method='POST', name='saveProfile')
+    @instrumented
+    @rateLimited()
     def saveProfile(self, request):
         """Update & return user profile."""
         return self._doProfile(request)
 
+# - - - Dashboard - - - - - - - - - - - - - - - - - - - - - -
 
-# - - - Announcements - - - - - - - - - - - - - - - - - - - -
+    @endpoints.method(message_types.VoidMessage, DashboardForm,
+                      path='dashboard', http_method='GET',
+                      name='getDashboard')
+    @instrumented
+    def getDashboard(self, request):
+        """Return the user's profile, conferences to attend and created,
+        the announcement and the wishlist size in one call."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+        p_key = ndb.Key(Profile, user_id)
 
-    @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+        # start every read that doesn't depend on the profile at once
+        prof_future = p_key.get_async()
+        created_future = Conference.query(ancestor=p_key).fetch_async()
+        wishlist_future = SessionWishlistItem.query(
+            ancestor=p_key).count_async(keys_only=True)
+        announcement_future = ndb.get_context().memcache_get(
+            tasks.MEMCACHE_ANNOUNCEMENTS_KEY)
+
+        prof = prof_future.get_result()
+        if prof:
+            tasks.upgradeProfile(prof)
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            prof = self._getProfileFromUser()
+        # archived conferences are left out, as in getConferencesToAttend()
+        attending = [conf for conf in ndb.get_multi(prof.conferencesToAttend)
+                     if conf]
+        created = created_future.get_result()
+
+        # one batch of organizer profiles for both lists
+        names = {user_id: prof.displayName}
+        o_keys = list(set(conf.key.parent() for conf in attending
+                          if conf.organizerUserId not in names))
+        for o_key, organizer in zip(o_keys, ndb.get_multi(o_keys)):
+            names[o_key.id()] = getattr(organizer, 'displayName', None)
+
+        return DashboardForm(
+            profile=self._copyProfileToForm(prof),
+            conferencesToAttend=[
+                self._copyConferenceToForm(
+                    conf, names.get(conf.organizerUserId))
+                for conf in attending],
+            conferencesCreated=[
+                self._copyConferenceToForm(conf, prof.displayName)
+                for conf in created],
+            announcement=announcement_future.get_result() or "",
+            wishlistCount=wishlist_future.get_result())
 
-        return announcement
+
+# - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
+    @instrumented
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
         return StringMessage(
-            data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+            data=memcache.get(tasks.MEMCACHE_ANNOUNCEMENTS_KEY) or "")
 
 # - - - Speakers - - - - - - - - - - - - - - - - - - - -
 
-    @staticmethod
-    def _updateFeaturedSpeaker(speaker, conferenceKey):
-        """Updates the featured speaker in memcache."""
-
-        conf = ndb.Key(urlsafe=conferenceKey)
-        if conf.kind() != "Conference" or not conf.get():
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % conferenceKey)
-
-        q = ConferenceSession.query(ancestor=ndb.Key(
-                                        urlsafe=conferenceKey))
-
-        q = q.filter(ConferenceSession.speaker == speaker)
-
-        if q.count() > 1:
-            fskey = 'featuredSpeaker-' + conferenceKey
-            memcache.set(fskey, (speaker, [qi.name for qi in q]))
-
     @endpoints.method(GET_CONF_SPEAKERS_REQ, GetConferenceSpeakersResponse,
                       path='getConferenceSpeakers',
                       http_method='GET', name='getConferenceSpeakers')
+    @instrumented
     def getConferenceSpeakers(self, request):
         """Gets all speakers at the desired conference."""
 
@@ -606,6 +962,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(GET_FEATURED_SPEAKER_REQ, GetFeaturedSpeakerResponse,
                       path='getFeaturedSpeaker',
                       http_method='GET', name='getFeaturedSpeaker')
+    @instrumented
     def getFeaturedSpeaker(self, request):
         """Gets the featured speaker for the desired conference."""
 
@@ -615,7 +972,7 @@ class ConferenceApi(remote.Service):
                 'No conference found with key: %s' % request.conferenceKey)
 
         cachedSpeaker = memcache.get(
-            'featuredSpeaker-' +
+            tasks.FEATURED_SPEAKER_PREFIX +
             request.conferenceKey)
 
         response = GetFeaturedSpeakerResponse()
@@ -629,7 +986,12 @@ class ConferenceApi(remote.Service):
 
     @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+        """Register or unregister user for selected conference.
+
+        When the conference is sold out, or others are still waiting for
+        a seat, the user is put on its waitlist instead and False is
+        returned.
+        """
         retval = None
         prof = self._getProfileFromUser()  # get user Profile
 
@@ -641,31 +1003,54 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        wl_key = ndb.Key(WaitlistEntry, prof.key.id(), parent=conf.key)
+        attendee_key = ndb.Key(ConferenceAttendee, prof.key.id(),
+                               parent=conf.key)
+
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if conf.key in prof.conferencesToAttend:
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
+            # no seats left, or seats freed for the waitlist before the
+            # promote task ran; queue the user up once instead of failing
+            if conf.seatsAvailable <= 0 or conf.waitlistCount > 0:
+                if not wl_key.get():
+                    conf.waitlistSequence += 1
+                    conf.waitlistCount += 1
+                    WaitlistEntry(key=wl_key, userId=prof.key.id(),
+                                  sequence=conf.waitlistSequence).put()
+                    conf.put()
+                return BooleanMessage(data=False)
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
+            prof.conferencesToAttend.append(conf.key)
             conf.seatsAvailable -= 1
+            ConferenceAttendee(key=attendee_key, userId=prof.key.id()).put()
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if conf.key in prof.conferencesToAttend:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
+                prof.conferencesToAttend.remove(conf.key)
                 conf.seatsAvailable += 1
+                attendee_key.delete()
+                retval = True
+
+                # hand the freed seat to the head of the waitlist
+                if conf.waitlistCount > 0:
+                    taskqueue.add(params={'websafeConferenceKey': wsck},
+                                  url='/tasks/promote_waitlist',
+                                  transactional=True)
+            elif wl_key.get():
+                # leave the waitlist
+                wl_key.delete()
+                conf.waitlistCount -= 1
                 retval = True
             else:
                 retval = False
@@ -675,15 +1060,45 @@ class ConferenceApi(remote.Service):
         conf.put()
         return BooleanMessage(data=retval)
 
+    @endpoints.method(CONF_GET_REQUEST, WaitlistPositionForm,
+                      path='conference/{websafeConferenceKey}/waitlist',
+                      http_method='GET', name='getWaitlistPosition')
+    @instrumented
+    def getWaitlistPosition(self, request):
+        """Return the user's position on the conference waitlist."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf, entry = ndb.get_multi(
+            [c_key, ndb.Key(WaitlistEntry, user_id, parent=c_key)])
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' %
+                request.websafeConferenceKey)
+
+        position = 0
+        if entry:
+            # keys-only count of the entries queued ahead of this one
+            position = WaitlistEntry.query(
+                WaitlistEntry.sequence < entry.sequence,
+                ancestor=c_key).count(keys_only=True) + 1
+
+        return WaitlistPositionForm(
+            position=position, waitlistSize=conf.waitlistCount)
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
+    @instrumented
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser()  # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck)
-                     for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        # archived conferences are left out
+        conferences = [conf for conf in
+                       ndb.get_multi(prof.conferencesToAttend) if conf]
 
         # get organizers
         organisers = [ndb.Key(Profile, conf.organizerUserId)
@@ -703,9 +1118,49 @@ class ConferenceApi(remote.Service):
                     names[
                         conf.organizerUserId]) for conf in conferences])
 
+    @endpoints.method(ATTENDEES_GET_REQUEST, AttendeeForms,
+                      path='conference/{websafeConferenceKey}/attendees',
+                      http_method='GET', name='getConferenceAttendees')
+    @instrumented
+    def getConferenceAttendees(self, request):
+        """Return a page of the conference's attendees (organizer only)."""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf = c_key.get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' %
+                request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the conference attendees.')
+
+        # page through the attendee index; key ids are the user ids
+        limit = min(request.limit or ATTENDEES_PAGE_SIZE, ATTENDEES_PAGE_SIZE)
+        cursor = None
+        if request.pageToken:
+            cursor = ndb.Cursor(urlsafe=request.pageToken)
+        a_keys, next_cursor, more = ConferenceAttendee.query(
+            ancestor=c_key).fetch_page(
+            limit, start_cursor=cursor, keys_only=True)
+        profiles = ndb.get_multi(
+            [ndb.Key(Profile, k.id()) for k in a_keys])
+
+        return AttendeeForms(
+            items=[AttendeeForm(displayName=p.displayName,
+                                mainEmail=p.mainEmail)
+                   for p in profiles if p],
+            nextPageToken=next_cursor.urlsafe() if more else None)
+
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='POST', name='registerForConference')
+    @instrumented
+    @rateLimited(conferenceField='websafeConferenceKey')
     def registerForConference(self, request):
         """Register user for selected conference."""
         return self._conferenceRegistration(request)
@@ -713,6 +1168,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
                       http_method='DELETE', name='unregisterFromConference')
+    @instrumented
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
         return self._conferenceRegistration(request, reg=False)
@@ -720,6 +1176,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='filterPlayground',
                       http_method='GET', name='filterPlayground')
+    @instrumented
     def filterPlayground(self, request):
         """Filter Playground"""
         q = Conference.query()
@@ -736,6 +1193,9 @@ class ConferenceApi(remote.Service):
     @endpoints.method(CREATE_CSESSION_REQ, ConferenceSessionForm,
                       path='createSession',
                       http_method='POST', name='createSession')
+    @instrumented
+    @rateLimited()
+    @idempotent(ConferenceSessionForm)
     def createSession(self, request):
         """Create new conference session."""
         return self._createConferenceSessionObject(request)
@@ -754,6 +1214,7 @@ class ConferenceApi(remote.Service):
                 request,
                 field.name) for field in request.all_fields()}
         del data['conferenceKey']
+        del data['idempotencyKey']
 
         # check that conference exists
         confKey = ndb.Key(urlsafe=request.conferenceKey)
@@ -768,146 +1229,233 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can add sessions to a conference.')
 
-        # convert dates from strings to Date objects; set month based on
-        # start_date
+        # convert dates from strings to Date objects; derive the
+        # normalized schedule fields from date, startTime & duration
         data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
         data['typeOfSession'] = str(data['typeOfSession'])
+        if data['duration'] <= 0:
+            raise endpoints.BadRequestException(
+                "Session 'duration' must be a positive number of minutes")
+        data['startMinute'] = tasks.parseTimeOfDay(data['startTime'])
+        data['startTime'] = '%02d:%02d' % divmod(data['startMinute'], 60)
+        data['startDateTime'] = datetime.combine(
+            data['date'], datetime.min.time()) + timedelta(
+            minutes=data['startMinute'])
+        data['endDateTime'] = data['startDateTime'] + timedelta(
+            minutes=data['duration'])
 
         cs_id = ConferenceSession.allocate_ids(size=1, parent=confKey)[0]
         cs_key = ndb.Key(ConferenceSession, cs_id, parent=confKey)
         data['key'] = cs_key
         data['createdTime'] = int(calendar.timegm(time.gmtime()))
 
-        cs = ConferenceSession(**data).put()
+        cs = ConferenceSession(**data)
+        cs.put()
+
+        # drop the stale agenda and have it rebuilt in the background;
+        # tasks are transactional when run through @idempotent
+        ndb.Key(ConferenceAgenda, request.conferenceKey).delete()
+        etags.bumpStamp('agenda-' + request.conferenceKey)
+        taskqueue.add(params={'conferenceKey': request.conferenceKey},
+                      url='/tasks/rebuild_agenda',
+                      transactional=ndb.in_transaction())
 
         # add a task to update the featured speaker
         taskqueue.add(
             params={
                 'speaker': request.speaker,
                 'conferenceKey': request.conferenceKey},
-            url='/tasks/update_featured_speaker')
+            url='/tasks/update_featured_speaker',
+            transactional=ndb.in_transaction())
+        search.indexLater(request.conferenceKey)
 
-        return self._copyConferenceSessionToForm(cs.get())
+        return tasks.copyConferenceSessionToForm(cs)
 
     @endpoints.method(GET_CSESSION_BY_SPEAKER_REQ, ConferenceSessionForms,
                       path='getSessionsBySpeaker',
                       http_method='GET',
                       name='getSessionsBySpeaker')
+    @instrumented
     def getSessionsBySpeaker(self, request):
         """Retrieves sessions matching the request query"""
         q = ConferenceSession.query(
             ConferenceSession.speaker == request.speaker)
 
         return ConferenceSessionForms(
-            items=[self._copyConferenceSessionToForm(cs) for cs in q]
+            items=[tasks.copyConferenceSessionToForm(cs) for cs in q]
         )
 
     @endpoints.method(GET_CSESSION_BY_TYPE_REQ, ConferenceSessionForms,
                       path='getConferenceSessionsByType',
                       http_method='GET',
                       name='getConferenceSessionsByType')
+    @instrumented
     def getConferenceSessionsByType(self, request):
         """Retrieves sessions matching the request query"""
-        q = ConferenceSession.query(ancestor=ndb.Key(
-            urlsafe=request.conferenceKey))
-
-        q = q.filter(
-            ConferenceSession.typeOfSession == str(
-                request.typeOfSession))
+        agenda = tasks.getAgenda(request.conferenceKey)
 
         return ConferenceSessionForms(
-            items=[self._copyConferenceSessionToForm(cs) for cs in q]
+            items=[csf for csf in agenda.items
+                   if csf.typeOfSession == request.typeOfSession]
         )
 
     @endpoints.method(GET_CSESSION_BY_CID_REQ, ConferenceSessionForms,
                       path='getConferenceSessions',
                       http_method='GET',
                       name='getConferenceSessions')
+    @instrumented
     def getConferenceSessionsByConfId(self, request):
         """Retrieves sessions matching the request query"""
-
+        # read the stamp before the agenda, so a concurrent rebuild can
+        # only pair an older ETag with newer content
+        etag = etags.compute(stamps=['agenda-' + request.conferenceKey])
+        if etag == self._ifNoneMatch(request):
+            return ConferenceSessionForms(etag=etag, notModified=True)
+
+        forms = tasks.getAgenda(request.conferenceKey)
+        forms.etag = etag
+        return forms
+
+    @endpoints.method(GET_SCHEDULE_REQ, ConferenceSessionForms,
+                      path='getConferenceSchedule',
+                      http_method='GET',
+                      name='getConferenceSchedule')
+    @instrumented
+    def getConferenceSchedule(self, request):
+        """Retrieves sessions by time of day, excluding session types."""
+        # sessions stored before startMinute existed only show up once
+        # the migrate_schedule mapper job has filled it in
         q = ConferenceSession.query(ancestor=ndb.Key(
             urlsafe=request.conferenceKey))
-
+        if request.date:
+            q = q.filter(ConferenceSession.date == datetime.strptime(
+                request.date[:10], "%Y-%m-%d").date())
+
+        # the datastore allows a single inequality, so it gets the time
+        # range; type exclusions are applied in memory over a projection
+        if request.startsAfter:
+            q = q.filter(ConferenceSession.startMinute >=
+                         tasks.parseTimeOfDay(request.startsAfter))
+        if request.startsBefore:
+            q = q.filter(ConferenceSession.startMinute <
+                         tasks.parseTimeOfDay(request.startsBefore))
+        q = q.order(ConferenceSession.startMinute)
+
+        excluded = set(str(t) for t in request.excludeTypes)
+        keys = [cs.key for cs in q.fetch(
+            projection=[ConferenceSession.startMinute,
+                        ConferenceSession.typeOfSession])
+                if cs.typeOfSession not in excluded]
+
+        sessions = sorted((cs for cs in ndb.get_multi(keys) if cs),
+                          key=operator.attrgetter('startDateTime'))
         return ConferenceSessionForms(
-            items=[self._copyConferenceSessionToForm(cs) for cs in q]
+            items=[tasks.copyConferenceSessionToForm(cs) for cs in sessions]
         )
 
-    def _copyConferenceSessionToForm(self, confSession):
-        """
-        Copy relevant fields from ConferenceSession to ConferenceSessionForm.
-        """
-
-        csf = ConferenceSessionForm()
-        for field in csf.all_fields():
-            if hasattr(confSession, field.name):
-                if field.name == "date":
-                    setattr(
-                        csf, field.name, str(
-                            getattr(
-                                confSession, field.name)))
-                elif field.name == "typeOfSession":
-                    setattr(
-                        csf,
-                        field.name,
-                        getattr(
-                            ConferenceSessionType,
-                            getattr(
-                                confSession,
-                                field.name)))
-                else:
-                    setattr(csf, field.name, getattr(confSession, field.name))
-            elif field.name == "sessionKey":
-                setattr(csf, field.name, confSession.key.urlsafe())
-
-        csf.check_initialized()
-        return csf
-
 # - - - Sessions Wishlists - - - - - - - - - - - - - - - - - - - -
 
     @endpoints.method(CREATE_WISHLIST_ITEM_REQ, BooleanMessage,
                       path='addSessionToWishlist',
                       http_method='POST', name='addSessionToWishlist')
+    @instrumented
+    @rateLimited()
     def addSessionToWishlist(self, request):
         """Create new conference session."""
         return self._createSessionWishlistObject(request)
 
     def _createSessionWishlistObject(self, request):
         """Wishlists a session for the current user."""
+        self._modifyWishlist([request.sessionKey], [])
+        return BooleanMessage(data=True)
 
+    @endpoints.method(MODIFY_WISHLIST_REQ, IntegerMessage,
+                      path='modifyWishlist',
+                      http_method='POST', name='modifyWishlist')
+    @instrumented
+    @rateLimited()
+    def modifyWishlist(self, request):
+        """Add and remove wishlisted sessions; returns the wishlist size."""
+        return IntegerMessage(
+            data=self._modifyWishlist(request.add, request.remove))
+
+    def _modifyWishlist(self, add, remove):
+        """Validate and apply wishlist changes of the current user."""
         user = endpoints.get_current_user()
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         user_id = getUserId(user)
 
-        # check that session exists
-        sessionKey = ndb.Key(urlsafe=request.sessionKey)
-        if sessionKey.kind() != "ConferenceSession" or not sessionKey.get():
-            raise endpoints.NotFoundException(
-                'No session found with key: %s' % request.sessionKey)
-
-        csession = sessionKey.get()
-
-        q = SessionWishlistItem.query()
-        q = q.filter(SessionWishlistItem.userId == user_id)
-        q = q.filter(SessionWishlistItem.sessionKey == request.sessionKey)
+        add, remove = sorted(set(add)), sorted(set(remove))
+        if len(add) + len(remove) > WISHLIST_CHANGE_LIMIT:
+            raise endpoints.BadRequestException(
+                'At most %d sessions can be changed at once'
+                % WISHLIST_CHANGE_LIMIT)
+        if set(add) & set(remove):
+            raise endpoints.BadRequestException(
+                'Sessions both added and removed: %s'
+                % ', '.join(sorted(set(add) & set(remove))))
 
-        # if session has already been wishlisted by this user, simply return
-        # success
-        if q.count() > 0:
-            return BooleanMessage(data=True)
+        # removed sessions may be gone already; added ones must exist
+        session_keys = []
+        for wssk in add + remove:
+            try:
+                s_key = ndb.Key(urlsafe=wssk)
+            except Exception:
+                s_key = None
+            if not s_key or s_key.kind() != 'ConferenceSession':
+                raise endpoints.BadRequestException(
+                    'Invalid session key: %s' % wssk)
+            session_keys.append(s_key)
+        missing = [wssk for wssk, cs in zip(
+            add, ndb.get_multi(session_keys[:len(add)])) if not cs]
+        if missing:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % ', '.join(missing))
 
-        wlItem = SessionWishlistItem()
-        wlItem.userId = user_id
-        wlItem.sessionKey = request.sessionKey
-        wlItem.put()
+        # no size yet: the user's first change, or items moved since;
+        # legacy items must be under the Profile before it is counted
+        if not tasks.wishlistSizeKey(user_id).get():
+            tasks.migrateUserWishlist(user_id)
+        return self._applyWishlistChanges(user_id, add, remove)
 
-        return BooleanMessage(data=True)
+    @staticmethod
+    @ndb.transactional
+    def _applyWishlistChanges(user_id, add, remove):
+        """Write wishlist changes in the user's entity group; returns the
+        resulting wishlist size.
+        """
+        size = tasks.wishlistSizeKey(user_id).get()
+        if not size:
+            size = WishlistSize(
+                key=tasks.wishlistSizeKey(user_id),
+                size=SessionWishlistItem.query(
+                    ancestor=ndb.Key(Profile, user_id)).count(keys_only=True))
+        item_keys = [tasks.wishlistItemKey(user_id, wssk)
+                     for wssk in add + remove]
+        existing = ndb.get_multi(item_keys)
+
+        added = [SessionWishlistItem(key=k, userId=user_id, sessionKey=wssk)
+                 for wssk, k, item in zip(add, item_keys, existing) if not item]
+        removed = [item.key for item in existing[len(add):] if item]
+        size.size += len(added) - len(removed)
+        ndb.put_multi(added + [size])
+        ndb.delete_multi(removed)
+
+        if added:
+            # count the pairs they form with the user's other sessions
+            taskqueue.add(params={'userId': user_id,
+                                  'sessionKey': [wl.sessionKey
+                                                 for wl in added]},
+                          url='/tasks/update_recommendations',
+                          transactional=True)
+        return size.size
 
     @endpoints.method(message_types.VoidMessage, ConferenceSessionForms,
                       path='getSessionsInWishlist',
                       http_method='GET',
                       name='getSessionsInWishlist')
+    @instrumented
     def getSessionsInWishlist(self, request):
         """Gets all sessions the current user has wishlisted"""
 
@@ -921,8 +1469,191 @@ class ConferenceApi(remote.Service):
                 SessionWishlistItem.userId == user_id)]
         wl_sessions = [ndb.Key(urlsafe=k).get() for k in session_keys]
 
+        # sessions archived since the last wishlist sweep are left out
         return ConferenceSessionForms(
-            items=[self._copyConferenceSessionToForm(cs) for cs in wl_sessions]
+            items=[tasks.copyConferenceSessionToForm(cs)
+                   for cs in wl_sessions if cs]
         )
 
-api = endpoints.api_server([ConferenceApi])  # register API
\ No newline at end of file
+    @endpoints.method(message_types.VoidMessage, SessionConflictForms,
+                      path='getWishlistConflicts',
+                      http_method='GET',
+                      name='getWishlistConflicts')
+    @instrumented
+    def getWishlistConflicts(self, request):
+        """Gets pairs of overlapping sessions in the user's wishlist"""
+
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        session_keys = [
+            ndb.Key(urlsafe=wl.sessionKey) for wl in SessionWishlistItem.query(
+                SessionWishlistItem.userId == user_id)]
+        spans = []
+        for cs in ndb.get_multi(session_keys):
+            span = cs and tasks.sessionSpan(cs)
+            if span:
+                spans.append(span + (cs,))
+        spans.sort(key=operator.itemgetter(0))
+
+        # sweep in start order over the sessions still running, kept in a
+        # heap by end time; a session overlaps every one left running
+        conflicts = []
+        forms = {}
+        running = []
+        for i, (start, end, cs) in enumerate(spans):
+            while running and running[0][0] <= start:
+                heapq.heappop(running)
+            for _, j, other in sorted(running, key=operator.itemgetter(1)):
+                for k, s in ((i, cs), (j, other)):
+                    if k not in forms:
+                        forms[k] = tasks.copyConferenceSessionToForm(s)
+                conflicts.append(SessionConflictForm(first=forms[j],
+                                                     second=forms[i]))
+            heapq.heappush(running, (end, i, cs))
+
+        return SessionConflictForms(items=conflicts)
+
+    @endpoints.method(GET_RECOMMENDED_SESSIONS_REQ, ConferenceSessionForms,
+                      path='getRecommendedSessions',
+                      http_method='GET',
+                      name='getRecommendedSessions')
+    @instrumented
+    def getRecommendedSessions(self, request):
+        """Gets the sessions most often wishlisted together with a session"""
+        limit = min(request.limit or recommendations.RECOMMENDATIONS,
+                    recommendations.CANDIDATES)
+        session_keys = [ndb.Key(urlsafe=k) for k in
+                        recommendations.topSessions(request.sessionKey, limit)]
+        # deleted sessions linger in the neighbors until the next rebuild
+        return ConferenceSessionForms(items=[
+            tasks.copyConferenceSessionToForm(cs)
+            for cs in ndb.get_multi(session_keys) if cs])
+
+# - - - Mobile sync - - - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _syncPhases(user_id, since):
+        """Return the (name, query) phases of a sync in delivery order.
+        Without a since time this is a full sync, in key order so that
+        entities written before the updated property existed are included.
+        """
+        if since is None:
+            return [
+                ('conferences', Conference.query()),
+                ('sessions', ConferenceSession.query()),
+                ('wishlist', SessionWishlistItem.query(
+                    SessionWishlistItem.userId == user_id)),
+            ]
+        # deletions go first, so an entity re-created after its deletion
+        # is still present on the client at the end
+        return [
+            ('deleted', Tombstone.query(
+                Tombstone.owner == '',
+                Tombstone.deleted > since).order(Tombstone.deleted)),
+            ('deleted', Tombstone.query(
+                Tombstone.owner == user_id,
+                Tombstone.deleted > since).order(Tombstone.deleted)),
+            ('conferences', Conference.query(
+                Conference.updated > since).order(Conference.updated)),
+            ('sessions', ConferenceSession.query(
+                ConferenceSession.updated > since).order(
+                ConferenceSession.updated)),
+            ('wishlist', SessionWishlistItem.query(
+                SessionWishlistItem.userId == user_id,
+                SessionWishlistItem.updated > since).order(
+                SessionWishlistItem.updated)),
+        ]
+
+    @staticmethod
+    def _parseSyncTime(value):
+        """Parse a checkpoint returned by an earlier syncChanges()."""
+        try:
+            return datetime.strptime(value, SYNC_TIME_FORMAT)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                'Invalid sync checkpoint: %s' % value)
+
+    @endpoints.method(SYNC_REQUEST, SyncChangesForm,
+                      path='syncChanges',
+                      http_method='GET',
+                      name='syncChanges')
+    @instrumented
+    def syncChanges(self, request):
+        """Return a page of the conferences, sessions and wishlist entries
+        changed since a checkpoint; deleted ones come as tombstones"""
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        # pageToken is phase|checkpoint|since|cursor; all pages of a sync
+        # share the since time and the checkpoint for the next sync
+        if request.pageToken:
+            try:
+                phase, checkpoint, since, cursor = \
+                    request.pageToken.split('|')
+                phase = int(phase)
+                cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+            except Exception:
+                raise endpoints.BadRequestException(
+                    'Invalid pageToken: %s' % request.pageToken)
+            since = self._parseSyncTime(since) if since else None
+        else:
+            now = datetime.utcnow()
+            phase, cursor = 0, None
+            checkpoint = (now - SYNC_OVERLAP).strftime(SYNC_TIME_FORMAT)
+            since = None
+            if request.since:
+                since = self._parseSyncTime(request.since)
+                # deletions that old may be purged; start over
+                if since < now - tasks.TOMBSTONE_RETENTION:
+                    since = None
+
+        form = SyncChangesForm(checkpoint=checkpoint, fullSync=since is None)
+        phases = self._syncPhases(user_id, since)
+        conferences = []
+        room = SYNC_PAGE_SIZE
+        while phase < len(phases) and room > 0:
+            name, query = phases[phase]
+            results, next_cursor, more = query.fetch_page(
+                room, start_cursor=cursor)
+            room -= len(results)
+            if name == 'deleted':
+                form.deleted.extend([
+                    TombstoneForm(kind=t.entityKind, websafeKey=t.key.id())
+                    for t in results])
+            elif name == 'conferences':
+                conferences.extend(results)
+            elif name == 'sessions':
+                form.sessions.extend([
+                    tasks.copyConferenceSessionToForm(cs) for cs in results])
+            else:
+                form.wishlist.extend([
+                    WishlistItemForm(websafeKey=wl.key.urlsafe(),
+                                     sessionKey=wl.sessionKey)
+                    for wl in results])
+            if more and next_cursor:
+                cursor = next_cursor
+                break
+            phase, cursor = phase + 1, None
+
+        # organizer display names, fetched with a single get_multi
+        profiles = ndb.get_multi(
+            [ndb.Key(Profile, conf.organizerUserId) for conf in conferences])
+        names = dict((p.key.id(), p.displayName) for p in profiles if p)
+        form.conferences.extend([
+            self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+            for conf in conferences])
+
+        if phase < len(phases):
+            form.nextPageToken = '|'.join([
+                str(phase), checkpoint,
+                since.strftime(SYNC_TIME_FORMAT) if since else '',
+                cursor.urlsafe() if cursor else ''])
+        return form
+
+api = profiler.middleware(
+    endpoints.api_server([ConferenceApi]))  # register API
\ No newline at end of file
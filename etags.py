@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+etags.py -- Conference Central version stamps & ETags for conditional GETs
+
+$Id$
+
+Entities derived from VersionedModel carry a durable version that is
+bumped on every put and mirrored in memcache once the write commits,
+and whose mirror is dropped once a deletion commits.
+Collections without an entity of their own (a conference's sessions,
+an organizer's conferences) get a stamp: a random token kept only in
+memcache and replaced whenever the collection changes. A lost stamp is
+simply regenerated, which costs clients one full download.
+
+Mirrors are best effort: a memcache.set that fails after its write has
+committed leaves an old version behind until it is evicted. Conditional
+GETs then answer "not modified" to clients holding that old version,
+and If-Match updates (updateConference) fail with 412 against it; the
+412 path calls repairVersion() so the next GET hands out the right one.
+
+ETags are computed from these values with a single memcache get_multi,
+so a read endpoint can answer "not modified" before loading entities.
+
+"""
+
+import uuid
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+VERSION_PREFIX = 'version-'
+STAMP_PREFIX = 'stamp-'
+CAS_RETRIES = 3
+
+
+def versionKey(key):
+    """Return the memcache key of an entity's version."""
+    return VERSION_PREFIX + key.urlsafe()
+
+
+def stampKey(name):
+    """Return the memcache key of a collection stamp."""
+    return STAMP_PREFIX + name
+
+
+def publishVersion(key, version):
+    """Mirror an entity version in memcache once the write commits."""
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(versionKey(key), version))
+
+
+def forgetVersion(key):
+    """Drop an entity's version mirror once its deletion commits."""
+    ndb.get_context().call_on_commit(
+        lambda: memcache.delete(versionKey(key)))
+
+
+def repairVersion(key, version):
+    """Raise a version mirror found behind the datastore, as after a
+    memcache.set that failed once its write had committed."""
+    client = memcache.Client()
+    for _ in xrange(CAS_RETRIES):
+        mirrored = client.gets(versionKey(key))
+        if mirrored is None or mirrored >= version:
+            return
+        if client.cas(versionKey(key), version):
+            return
+
+
+def bumpStamp(name):
+    """Replace a collection stamp once the current write commits."""
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(stampKey(name), uuid.uuid4().hex[:12]))
+
+
+def leadingVersion(etag):
+    """Return the version of the first entity an ETag was computed for,
+    or None if it doesn't parse; a bare version number works as well.
+    """
+    try:
+        return int(etag.strip().strip('"').split('-')[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+def compute(keys=(), stamps=()):
+    """Return the ETag for the given entity keys and collection stamps,
+    or None if one of the entities doesn't exist.
+    """
+    names = [versionKey(k) for k in keys] + [stampKey(s) for s in stamps]
+    values = memcache.get_multi(names)
+
+    # fill in versions from the datastore and fresh stamps; add() keeps
+    # values published by a concurrent write
+    missing = [k for k in keys if versionKey(k) not in values]
+    fill = {}
+    for key, entity in zip(missing, ndb.get_multi(missing)):
+        if not entity:
+            return None
+        fill[versionKey(key)] = entity.version
+    for s in stamps:
+        if stampKey(s) not in values:
+            fill[stampKey(s)] = uuid.uuid4().hex[:12]
+    if fill:
+        memcache.add_multi(fill)
+        values.update(fill)
+
+    return '"%s"' % '-'.join(str(values[n]) for n in names)
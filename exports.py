@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+"""
+exports.py -- Conference Central agenda and attendee list exports
+
+$Id$
+
+Organizers download a conference's agenda as CSV or iCalendar and its
+attendee list as CSV. The files are produced by generators over batched
+ancestor queries, one batch of rows at a time, and handed to the
+response as its app_iter, so an export is never held in memory whole.
+
+Conferences with more than STREAM_LIMIT rows are exported by a task
+instead: it writes the same generator's output into ExportChunk
+entities under an ExportFile, and the download answers 202 until the
+file is built, then streams the chunks. Every build writes a new
+generation of chunks and the ExportFile switches to it once it is
+complete; a stale file is served while its next build runs, and the
+chunks of a generation are deleted only when the one after it is
+replaced, so a download in flight never loses its chunks. Deployed instances buffer each
+response (up to 32MB), which is what keeps large exports off the
+request path.
+
+"""
+
+import csv
+import StringIO
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import tasks
+from models import ConferenceAttendee
+from models import ConferenceSession
+from models import ExportChunk
+from models import ExportFile
+from models import Profile
+
+BATCH = 200
+# rows exported by the request itself; bigger exports go to the task
+STREAM_LIMIT = 2000
+# raw bytes per ExportChunk, well under the 1MB entity size limit
+CHUNK_SIZE = 512 * 1024
+# a built file is served this long before a download rebuilds it
+EXPORT_TTL = timedelta(hours=1)
+# a build not done by then is assumed lost and started again
+BUILD_TIMEOUT = timedelta(minutes=30)
+
+AGENDA_FIELDS = ['name', 'speaker', 'typeOfSession', 'date', 'startTime',
+                 'duration', 'highlights', 'websafeKey']
+ATTENDEE_FIELDS = ['displayName', 'mainEmail', 'teeShirtSize']
+
+
+def _pages(query, keys_only=False):
+    """Yield the results of query in batches."""
+    cursor, more = None, True
+    while more:
+        results, cursor, more = query.fetch_page(
+            BATCH, start_cursor=cursor, keys_only=keys_only)
+        if results:
+            yield results
+
+
+def _csvChunk(rows):
+    out = StringIO.StringIO()
+    writer = csv.writer(out)
+    for row in rows:
+        writer.writerow([unicode(v).encode('utf-8') if v is not None else ''
+                         for v in row])
+    return out.getvalue()
+
+
+def _sessions(c_key):
+    return _pages(ConferenceSession.query(ancestor=c_key))
+
+
+def agendaCsv(conf):
+    """Yield a conference's sessions as CSV."""
+    yield _csvChunk([AGENDA_FIELDS])
+    for sessions in _sessions(conf.key):
+        yield _csvChunk([
+            cs.name, cs.speaker, cs.typeOfSession, cs.date, cs.startTime,
+            cs.duration, cs.highlights, cs.key.urlsafe()] for cs in sessions)
+
+
+def _icsText(value):
+    """Escape a TEXT value as RFC 5545 requires."""
+    value = unicode(value or '')
+    for char, escaped in (('\\', '\\\\'), (';', '\\;'), (',', '\\,'),
+                          ('\n', '\\n')):
+        value = value.replace(char, escaped)
+    return value
+
+
+def _icsLine(line):
+    """Fold a content line into 75 octet pieces and terminate it."""
+    line = line.encode('utf-8')
+    pieces = []
+    while len(line) > 75:
+        cut = 75 if not pieces else 74
+        # never split a UTF-8 sequence
+        while cut and (ord(line[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        pieces.append(line[:cut])
+        line = line[cut:]
+    pieces.append(line)
+    return '\r\n '.join(pieces) + '\r\n'
+
+
+def agendaIcs(conf):
+    """Yield a conference's sessions as an iCalendar file; sessions
+    whose start time can't be read are left out.
+    """
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    yield ''.join(_icsLine(l) for l in [
+        u'BEGIN:VCALENDAR', u'VERSION:2.0',
+        u'PRODID:-//Conference Central//Agenda//EN',
+        u'X-WR-CALNAME:' + _icsText(conf.name)])
+    for sessions in _sessions(conf.key):
+        lines = []
+        for cs in sessions:
+            span = tasks.sessionSpan(cs)
+            if not span:
+                continue
+            # floating times: sessions are in the conference's local time
+            lines += [
+                u'BEGIN:VEVENT',
+                u'UID:%s@conference-central' % cs.key.urlsafe(),
+                u'DTSTAMP:' + stamp,
+                u'DTSTART:' + span[0].strftime('%Y%m%dT%H%M%S'),
+                u'DTEND:' + span[1].strftime('%Y%m%dT%H%M%S'),
+                u'SUMMARY:' + _icsText(cs.name),
+                u'DESCRIPTION:' + _icsText(u'%s\n%s' % (
+                    cs.speaker, cs.highlights or '')),
+                u'CATEGORIES:' + _icsText(cs.typeOfSession),
+                u'LOCATION:' + _icsText(conf.city),
+                u'END:VEVENT']
+        yield ''.join(_icsLine(l) for l in lines)
+    yield _icsLine(u'END:VCALENDAR')
+
+
+def attendeesCsv(conf):
+    """Yield a conference's attendees as CSV."""
+    yield _csvChunk([ATTENDEE_FIELDS])
+    query = ConferenceAttendee.query(ancestor=conf.key)
+    for a_keys in _pages(query, keys_only=True):
+        # attendee key ids are the user ids
+        profiles = ndb.get_multi([ndb.Key(Profile, k.id()) for k in a_keys])
+        yield _csvChunk([p.displayName, p.mainEmail, p.teeShirtSize]
+                        for p in profiles if p)
+
+
+# file name: (generator, content type, kind counted for STREAM_LIMIT)
+FORMATS = {
+    'agenda.csv': (agendaCsv, 'text/csv; charset=utf-8', ConferenceSession),
+    'agenda.ics': (agendaIcs, 'text/calendar; charset=utf-8',
+                   ConferenceSession),
+    'attendees.csv': (attendeesCsv, 'text/csv; charset=utf-8',
+                      ConferenceAttendee),
+}
+
+
+def isLarge(conf, name):
+    """Tell whether an export has to be built by the task."""
+    kind = FORMATS[name][2]
+    return kind.query(ancestor=conf.key).count(
+        limit=STREAM_LIMIT + 1) > STREAM_LIMIT
+
+
+def _fileKey(conf, name):
+    return ndb.Key(ExportFile, '%s/%s' % (conf.key.urlsafe(), name))
+
+
+def _chunkKey(f_key, generation, n):
+    if generation is None:
+        return ndb.Key(ExportChunk, n, parent=f_key)
+    return ndb.Key(ExportChunk, '%d-%d' % (generation, n), parent=f_key)
+
+
+def _chunkGeneration(key):
+    """Return the generation of an ExportChunk key, or None."""
+    if not isinstance(key.id(), basestring):
+        return None
+    return int(key.id().split('-')[0])
+
+
+def builtFile(conf, name):
+    """Return the built ExportFile of a large export, making sure a
+    build is under way once it is stale; None until one is built.
+    """
+    f_key = _fileKey(conf, name)
+
+    @ndb.transactional
+    def check():
+        now = datetime.utcnow()
+        export = f_key.get()
+        if export and export.done and export.built > now - EXPORT_TTL:
+            return export
+        if (export and export.building is not None and
+                export.started > now - BUILD_TIMEOUT):
+            return export if export.done else None
+        export = export or ExportFile(key=f_key,
+                                      contentType=FORMATS[name][1])
+        # a new generation, even over a build assumed lost
+        export.building = max(export.generation or 0,
+                              export.building or 0) + 1
+        export.started = now
+        export.put()
+        taskqueue.add(params={'websafeConferenceKey': conf.key.urlsafe(),
+                              'name': name,
+                              'generation': export.building},
+                      url='/tasks/build_export', transactional=True)
+        return export if export.done else None
+    return check()
+
+
+def build(conf, name, generation):
+    """Write a generation of an export into ExportChunks and serve it;
+    run by the export task."""
+    f_key = _fileKey(conf, name)
+
+    chunks = 0
+    buf = []
+    size = 0
+    for data in FORMATS[name][0](conf):
+        buf.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            chunks += 1
+            ExportChunk(key=_chunkKey(f_key, generation, chunks),
+                        data=''.join(buf)).put()
+            buf, size = [], 0
+    if buf:
+        chunks += 1
+        ExportChunk(key=_chunkKey(f_key, generation, chunks),
+                    data=''.join(buf)).put()
+
+    @ndb.transactional
+    def switch():
+        export = f_key.get()
+        # superseded by a build started after this one was assumed lost
+        if not export or export.building != generation:
+            return False, None
+        served = export.generation
+        export.populate(chunks=chunks, done=True, built=datetime.utcnow(),
+                        generation=generation, building=None)
+        export.put()
+        return True, served
+    switched, served = switch()
+    if not switched:
+        ndb.delete_multi([_chunkKey(f_key, generation, n)
+                          for n in xrange(1, chunks + 1)])
+        return
+
+    def stale(key):
+        # the generation replaced stays, downloads may still be reading it
+        chunkGeneration = _chunkGeneration(key)
+        if chunkGeneration is None:
+            return served is not None
+        return chunkGeneration < generation and chunkGeneration != served
+    ndb.delete_multi([
+        key for key in ExportChunk.query(ancestor=f_key).iter(keys_only=True)
+        if stale(key)])
+
+
+def fileContent(export):
+    """Yield the content of a built ExportFile."""
+    for first in xrange(1, export.chunks + 1, 4):
+        for chunk in ndb.get_multi([
+                _chunkKey(export.key, export.generation, n)
+                for n in xrange(first, min(first + 4, export.chunks + 1))]):
+            if chunk:
+                yield chunk.data
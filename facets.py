@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+"""
+facets.py -- Conference Central facet counts for the conference browser
+
+$Id$
+
+Every conference falls in one cell: its city, its set of topics, its
+month and the bucket of its maxAttendees (MAX_ATTENDEES_BUCKETS). The
+buckets keep the number of cells well below the number of conferences.
+The number of conferences per cell is kept in FacetShard entities; a
+cell always lives in the same shard, picked by a hash of its name, so
+each shard and its memcache copy hold only a share of the cells.
+
+Any queryConferences filter on city, topics or month can be applied to
+the cells exactly, and so can a maxAttendees filter that doesn't split
+a bucket; the facet counts for the matching conferences then follow
+without reading a single Conference. counts() returns None for a filter
+that splits a bucket, and the caller counts the matching conferences
+with tally() instead.
+
+createConference and updateConference adjust the shards of the cells
+they leave and enter once their write commits. The nightly rebuild
+recounts from the conferences and settles any adjustment lost to a
+failed request; a shard adjusted while it counts is left for the next
+rebuild rather than overwritten.
+
+"""
+
+import bisect
+import json
+import logging
+import operator
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import FacetShard
+
+SHARDS = 10
+MEMCACHE_PREFIX = 'conference-facets-'
+BATCH = 500
+# lower bounds of the maxAttendees buckets; the last one is open ended
+MAX_ATTENDEES_BUCKETS = (0, 1, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                         10000)
+
+# queryConferences operators as Python comparisons
+COMPARISONS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+
+def _bucket(maxAttendees):
+    """Return the lower bound of the bucket holding maxAttendees."""
+    return MAX_ATTENDEES_BUCKETS[max(0, bisect.bisect_right(
+        MAX_ATTENDEES_BUCKETS, maxAttendees or 0) - 1)]
+
+
+def cell(conf):
+    """Return the cell of a conference as its JSON encoded key."""
+    return json.dumps([conf.city, sorted(conf.topics or []), conf.month or 0,
+                       _bucket(conf.maxAttendees)])
+
+
+def _shard(name):
+    """Return the shard id holding a cell."""
+    return (zlib.crc32(name) & 0xffffffff) % SHARDS
+
+
+def _shardKeys():
+    return [ndb.Key(FacetShard, i) for i in xrange(SHARDS)]
+
+
+@ndb.transactional(xg=True)
+def _add(counts):
+    keys = list(set(ndb.Key(FacetShard, _shard(name)) for name in counts))
+    entities = [entity or FacetShard(key=key, counts={})
+                for key, entity in zip(keys, ndb.get_multi(keys))]
+    shards = dict((entity.key.id(), entity) for entity in entities)
+    for name, delta in counts.iteritems():
+        entity = shards[_shard(name)]
+        count = entity.counts.get(name, 0) + delta
+        if count:
+            entity.counts[name] = count
+        else:
+            entity.counts.pop(name, None)
+    ndb.put_multi(entities)
+
+
+def adjust(old, new):
+    """Move a conference from cell old to cell new; either may be None
+    for a created or removed conference. Applied once the current
+    transaction, if any, commits.
+    """
+    if old == new:
+        return
+    counts = {}
+    if old:
+        counts[old] = -1
+    if new:
+        counts[new] = counts.get(new, 0) + 1
+
+    def apply():
+        _add(counts)
+        memcache.delete_multi(list(set(
+            str(_shard(name)) for name in counts)), key_prefix=MEMCACHE_PREFIX)
+    if ndb.in_transaction():
+        ndb.get_context().call_on_commit(apply)
+    else:
+        apply()
+
+
+@ndb.transactional
+def _replace(key, seen, counts):
+    """Overwrite a shard's counts unless they changed since seen; returns
+    True if written."""
+    entity = key.get()
+    if (entity.counts if entity else {}) != seen:
+        return False
+    FacetShard(key=key, counts=counts).put()
+    return True
+
+
+def rebuild():
+    """Recount every cell from the conferences; returns the ids of the
+    shards left alone because they were adjusted meanwhile."""
+    keys = _shardKeys()
+    seen = [entity.counts if entity else {}
+            for entity in ndb.get_multi(keys)]
+    counts = [{} for _ in keys]
+    query = Conference.query()
+    cursor, more = None, True
+    while more:
+        confs, cursor, more = query.fetch_page(BATCH, start_cursor=cursor)
+        for conf in confs:
+            name = cell(conf)
+            shard = counts[_shard(name)]
+            shard[name] = shard.get(name, 0) + 1
+    skipped = [key.id() for key, before, after in zip(keys, seen, counts)
+               if not _replace(key, before, after)]
+    if skipped:
+        logging.info('Facet shards %s changed during the rebuild', skipped)
+    memcache.delete_multi([str(i) for i in xrange(SHARDS)],
+                          key_prefix=MEMCACHE_PREFIX)
+    return skipped
+
+
+def _cells():
+    """Return [(city, topics, month, maxAttendees bucket, count)]."""
+    cached = memcache.get_multi([str(i) for i in xrange(SHARDS)],
+                                key_prefix=MEMCACHE_PREFIX)
+    missing = [i for i in xrange(SHARDS) if str(i) not in cached]
+    if missing:
+        fill = {}
+        for i, shard in zip(missing, ndb.get_multi(
+                [ndb.Key(FacetShard, i) for i in missing])):
+            fill[str(i)] = [
+                tuple(json.loads(name)) + (count,)
+                for name, count in (shard.counts if shard else {}).iteritems()
+                if count > 0]
+        memcache.set_multi(fill, key_prefix=MEMCACHE_PREFIX)
+        cached.update(fill)
+    return [c for cells in cached.itervalues() for c in cells]
+
+
+def _matches(values, filtr):
+    compare = COMPARISONS[filtr['operator']]
+    # a repeated property matches if any of its values does
+    return any(compare(v, filtr['value']) for v in values)
+
+
+def _bucketMatches(low, filtr):
+    """Return whether a filter matches every maxAttendees value in the
+    bucket starting at low, False if it matches none, None otherwise."""
+    i = MAX_ATTENDEES_BUCKETS.index(low)
+    high = (MAX_ATTENDEES_BUCKETS[i + 1] - 1
+            if i + 1 < len(MAX_ATTENDEES_BUCKETS) else float('inf'))
+    value = filtr['value']
+    if filtr['operator'] in ('=', '!='):
+        if not low <= value <= high:
+            return filtr['operator'] == '!='
+        if low == high:
+            return filtr['operator'] == '='
+        return None
+    compare = COMPARISONS[filtr['operator']]
+    matches = compare(low, value)
+    return matches if matches == compare(high, value) else None
+
+
+def _count(rows):
+    """Return (total, {city: n}, {topic: n}, {month: n}) over rows of
+    (city, topics, month, count)."""
+    total = 0
+    facets = ({}, {}, {})
+    for city, topics, month, count in rows:
+        total += count
+        for facet, keys in zip(facets, ([city], topics, [month])):
+            for key in keys:
+                facet[key] = facet.get(key, 0) + count
+    return (total,) + facets
+
+
+def counts(filters):
+    """Return (total, {city: n}, {topic: n}, {month: n}) over the
+    conferences matching formatted queryConferences filters, or None if
+    a maxAttendees filter splits a bucket.
+    """
+    bucketFilters = [f for f in filters if f['field'] == 'maxAttendees']
+    filters = [f for f in filters if f['field'] != 'maxAttendees']
+    rows = []
+    for city, topics, month, low, count in _cells():
+        values = {'city': [city], 'topics': topics, 'month': [month]}
+        if not all(_matches(values[f['field']], f) for f in filters):
+            continue
+        # cells stored before the buckets hold exact values until the
+        # next rebuild
+        if bucketFilters and _bucket(low) != low:
+            return None
+        matches = [_bucketMatches(low, f) for f in bucketFilters]
+        if None in matches:
+            return None
+        if all(matches):
+            rows.append((city, topics, month, count))
+    return _count(rows)
+
+
+def tally(confs):
+    """Like counts(), over the conferences of a query."""
+    return _count((conf.city, conf.topics or [], conf.month or 0, 1)
+                  for conf in confs)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+idempotency.py -- Conference Central idempotency keys for create endpoints
+
+$Id$
+
+A client may send an idempotencyKey with a create request and repeat
+the request with the same key when it timed out. The first request to
+complete stores its response in an IdempotencyRecord, written in the
+same transaction as the entities it created; repeats within TTL get the
+stored response back from memcache or the record and never reach the
+write path. Concurrent repeats are settled by that transaction: the
+loser finds the record on retry.
+
+"""
+
+import functools
+from datetime import datetime
+from datetime import timedelta
+
+import endpoints
+from protorpc import protojson
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import IdempotencyRecord
+from utils import getUserId
+
+TTL = timedelta(hours=24)
+MEMCACHE_PREFIX = 'idempotency-'
+PURGE_BATCH = 500
+
+
+def _recordId(user_id, scope, key):
+    return '%s|%s|%s' % (scope, user_id, key)
+
+
+def idempotent(response_type):
+    """Decorate an endpoint method whose request has an idempotencyKey
+    field; response_type is the method's response message class. The
+    method must enqueue its tasks with transactional=ndb.in_transaction().
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, request):
+            user = endpoints.get_current_user()
+            if not request.idempotencyKey or not user:
+                return method(self, request)
+
+            name = _recordId(getUserId(user), method.__name__,
+                             request.idempotencyKey)
+            encoded = memcache.get(MEMCACHE_PREFIX + name)
+            if encoded is None:
+                r_key = ndb.Key(IdempotencyRecord, name)
+                record = r_key.get()
+                if record and record.expires > datetime.utcnow():
+                    encoded = record.response
+                else:
+                    encoded = _runOnce(r_key, lambda: method(self, request))
+                memcache.set(MEMCACHE_PREFIX + name, encoded,
+                             time=int(TTL.total_seconds()))
+            return protojson.decode_message(response_type, encoded)
+        return wrapper
+    return decorator
+
+
+@ndb.transactional(xg=True)
+def _runOnce(r_key, create):
+    """Run create() unless a live record exists; returns the encoded
+    response, stored alongside create()'s writes."""
+    now = datetime.utcnow()
+    record = r_key.get()
+    if record and record.expires > now:
+        return record.response
+    encoded = protojson.encode_message(create())
+    IdempotencyRecord(key=r_key, response=encoded, expires=now + TTL).put()
+    return encoded
+
+
+def purgeExpired():
+    """Delete idempotency records past their TTL."""
+    query = IdempotencyRecord.query(
+        IdempotencyRecord.expires < datetime.utcnow())
+    cursor, more = None, True
+    while more:
+        keys, cursor, more = query.fetch_page(
+            PURGE_BATCH, start_cursor=cursor, keys_only=True)
+        ndb.delete_multi(keys)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+"""
+jobs.py -- Conference Central backfills and migrations, registered as
+    mapper.py jobs
+
+$Id$
+
+Start a job as an admin with POST /mapper/start?job=<name>[&shards=N]
+and follow it at /mapper/status?id=<job id>.
+
+"""
+
+import archive
+import mapper
+import recommendations
+import search
+import tasks
+from models import Conference
+from models import ConferenceAgenda
+from models import ConferenceAttendee
+from models import ConferenceSession
+from models import Profile
+from models import SessionWishlistItem
+from models import WaitlistEntry
+
+# writes each profile in transactions of its own
+mapper.register('migrate_attendance', Profile)(
+    tasks.migrateProfileAttendance)
+mapper.register('migrate_wishlists', SessionWishlistItem)(
+    tasks.migrateWishlists)
+mapper.register('archive_wishlists', SessionWishlistItem)(
+    archive.archiveWishlists)
+# a session archived meanwhile must not be written back
+mapper.register('migrate_schedule', ConferenceSession, transactional=True)(
+    tasks.migrateSessionSchedule)
+# started nightly by cron
+mapper.register('rebuild_recommendations', ConferenceSession)(
+    recommendations.rebuildRows)
+
+
+@mapper.register('index_search', Conference)
+def _indexSearch(confs):
+    """Backfill the search index."""
+    for conf in confs:
+        try:
+            search.indexConference(conf.key.urlsafe())
+        except search.IndexBusy:
+            search.indexLater(conf.key.urlsafe())
+    return [], []
+
+
+def _rewrite(entities):
+    """Write entities back unchanged, dropping the index rows of
+    properties since marked indexed=False; note that SyncedModels are
+    re-sent to sync clients and VersionedModels get new ETags.
+    """
+    return entities, []
+
+# transactional: a stale copy written back would undo registrations
+# (seatsAvailable, conferencesToAttend) or revive deleted attendees,
+# waitlist entries and wishlist items
+for _model in (Conference, ConferenceAgenda, ConferenceAttendee,
+               ConferenceSession, Profile, SessionWishlistItem,
+               WaitlistEntry):
+    mapper.register('reindex_' + _model.__name__, _model,
+                    transactional=True)(_rewrite)
@@ -12,19 +12,44 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
-from conference import ConferenceApi
+from google.appengine.api import users
+from google.appengine.ext import ndb
+import profiler
+import rpcstats
+from rpcstats import instrumented
+
+rpcstats.install()
+
+# task and cron handlers import what they run, mostly from tasks.py, so
+# an instance started for one doesn't build the Endpoints service in
+# conference.py; /_ah/warmup loads it ahead of user traffic
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Load the API modules and prime caches on a new instance."""
+        import conference  # loaded for the user traffic to come
+        import tasks
+        tasks.warmCaches()
+        self.response.set_status(200)
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
+    @instrumented
     def get(self):
         """Set Announcement in Memcache."""
-        ConferenceApi._cacheAnnouncement()
+        import tasks
+        tasks.cacheAnnouncement()
         self.response.set_status(204)
 
 
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
+    @instrumented
     def post(self):
         """Send email confirming Conference creation."""
         mail.send_mail(
@@ -38,12 +63,214 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 class UpdateFeaturedSpeakerHandler(webapp2.RequestHandler):
+    @instrumented
     def post(self):
         """Check if speaker has multiple sessions during this conference. If so, add them to featured speaker list."""
-        ConferenceApi._updateFeaturedSpeaker(self.request.get('speaker'), self.request.get('conferenceKey'))
+        import tasks
+        tasks.updateFeaturedSpeaker(self.request.get('speaker'), self.request.get('conferenceKey'))
+
+class RebuildAgendaHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Rebuild the materialized agenda of a conference."""
+        import tasks
+        tasks.rebuildAgenda(self.request.get('conferenceKey'))
+
+class PromoteWaitlistHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Promote waitlisted users into seats freed on a conference."""
+        import tasks
+        tasks.promoteWaitlist(
+            self.request.get('websafeConferenceKey'))
+
+class MapperStartHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Start a mapper job; responds with its status URL."""
+        import jobs
+        import mapper
+        name = self.request.get('job')
+        if name not in mapper.JOBS:
+            self.abort(404, detail='No mapper job named %s' % name)
+        job_id = mapper.start(name, int(self.request.get(
+            'shards') or mapper.DEFAULT_SHARDS))
+        self.response.set_status(202)
+        self.response.headers['Location'] = '/mapper/status?id=' + job_id
+        self.response.write(job_id)
+
+class MapperAbortHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Stop a running mapper job."""
+        import mapper
+        mapper.abort(self.request.get('id'))
+        self.response.set_status(204)
+
+class MapperStatusHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Report the progress of a mapper job, or list recent jobs."""
+        import mapper
+        job_id = self.request.get('id')
+        if job_id:
+            status = mapper.status(job_id)
+            if not status:
+                self.abort(404)
+        else:
+            status = {'jobs': mapper.recentJobs()}
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(status, sort_keys=True))
+
+class ProfilesHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Dump this instance's request profiles, aggregated per endpoint."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(
+            profiler.dump(self.request.get('endpoint') or None),
+            indent=2, sort_keys=True))
+
+class MapperTaskHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Process one slice of a mapper shard."""
+        import jobs
+        import mapper
+        mapper.runSlice(self.request.get('shard'),
+                        int(self.request.get('slice')))
+
+class IndexConferenceHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Update the search index entries of a conference."""
+        import search
+        try:
+            search.indexConference(self.request.get('websafeConferenceKey'))
+        except search.IndexBusy:
+            # retried by the task queue once the other task is done
+            self.response.set_status(503)
+
+class RebuildFacetsHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Recount the conference facets from the conferences."""
+        import facets
+        facets.rebuild()
+        self.response.set_status(204)
+
+class ArchiveConferencesHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Enqueue the archiving of the conferences that have ended."""
+        import archive
+        import jobs
+        archive.archiveLater()
+        self.response.set_status(204)
+
+class ArchiveConferenceHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Move a conference and its entity group to the archive."""
+        import archive
+        archive.archiveConference(self.request.get('websafeConferenceKey'))
+
+class ExportHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self, websafeConferenceKey, name):
+        """Download a conference export (organizer only)."""
+        import exports
+        from utils import getUserId
+        try:
+            conf = ndb.Key(urlsafe=websafeConferenceKey).get()
+        except Exception:
+            conf = None
+        if not conf:
+            self.abort(404)
+        if getUserId(users.get_current_user()) != conf.organizerUserId:
+            self.abort(403)
+
+        if exports.isLarge(conf, name):
+            export = exports.builtFile(conf, name)
+            if not export:
+                self.response.set_status(202)
+                self.response.headers['Retry-After'] = '30'
+                self.response.write('The export is being built; retry later.')
+                return
+            content = exports.fileContent(export)
+        else:
+            content = exports.FORMATS[name][0](conf)
+        self.response.headers['Content-Type'] = exports.FORMATS[name][1]
+        self.response.headers['Content-Disposition'] = (
+            'attachment; filename="%s"' % name)
+        self.response.app_iter = content
+
+class BuildExportHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Build a large conference export into the datastore."""
+        import exports
+        conf = ndb.Key(urlsafe=self.request.get('websafeConferenceKey')).get()
+        # tasks without a generation predate generations; the next
+        # download starts the build again
+        if conf and self.request.get('generation'):
+            exports.build(conf, self.request.get('name'),
+                          int(self.request.get('generation')))
+
+class PurgeTombstonesHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Drop sync tombstones past their retention period."""
+        import tasks
+        tasks.purgeTombstones()
+        self.response.set_status(204)
+
+class PurgeIdempotencyRecordsHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Drop idempotency records past their TTL."""
+        import idempotency
+        idempotency.purgeExpired()
+        self.response.set_status(204)
+
+class UpdateRecommendationsHandler(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Count the session pairs new wishlist items form."""
+        import recommendations
+        recommendations.recordWishlisted(self.request.get('userId'),
+                                         self.request.get_all('sessionKey'))
+
+class RebuildRecommendationsHandler(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Start the job recomputing session recommendations."""
+        import jobs
+        import mapper
+        mapper.start('rebuild_recommendations')
+        self.response.set_status(204)
 
-app = webapp2.WSGIApplication([
+app = profiler.middleware(webapp2.WSGIApplication([
+    ('/_ah/warmup', WarmupHandler),
+    ('/admin/profiles', ProfilesHandler),
+    ('/mapper/start', MapperStartHandler),
+    ('/mapper/abort', MapperAbortHandler),
+    ('/mapper/status', MapperStatusHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/purge_tombstones', PurgeTombstonesHandler),
+    ('/crons/purge_idempotency_records', PurgeIdempotencyRecordsHandler),
+    ('/crons/rebuild_recommendations', RebuildRecommendationsHandler),
+    ('/crons/rebuild_facets', RebuildFacetsHandler),
+    ('/crons/archive_conferences', ArchiveConferencesHandler),
+    (r'/exports/([^/]+)/(agenda\.csv|agenda\.ics|attendees\.csv)',
+     ExportHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/update_featured_speaker', UpdateFeaturedSpeakerHandler),
-], debug=True)
+    ('/tasks/rebuild_agenda', RebuildAgendaHandler),
+    ('/tasks/promote_waitlist', PromoteWaitlistHandler),
+    ('/tasks/mapper', MapperTaskHandler),
+    ('/tasks/update_recommendations', UpdateRecommendationsHandler),
+    ('/tasks/build_export', BuildExportHandler),
+    ('/tasks/index_conference', IndexConferenceHandler),
+    ('/tasks/archive_conference', ArchiveConferenceHandler),
+], debug=True))
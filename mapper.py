@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+"""
+mapper.py -- Conference Central sharded, resumable datastore mapper
+
+$Id$
+
+Backfills and migrations are registered as jobs:
+
+    @mapper.register('normalize_speakers', ConferenceSession)
+    def normalizeSpeakers(sessions):
+        ...
+        return changed, []
+
+The function gets a batch of entities and returns (entities to put, keys
+to delete); the mapper writes them with put_multi/delete_multi. A batch
+may be processed again after a failure, so job functions must be
+idempotent.
+
+Those writes could overwrite a request that committed since the batch
+was read. A job registered with transactional=True is applied to each
+entity on its own instead: an xg transaction reads the entity again,
+calls the function with [entity] and commits its writes, which must
+stay within 25 entity groups; an entity deleted meanwhile is skipped.
+
+start() splits the job's query into key ranges at __scatter__ sample
+keys, one MapperShard each, and enqueues a task per shard. A shard task
+works through batches for SLICE_SECONDS, then checkpoints its cursor and
+chains the next slice in one transaction; a failing slice is retried
+by the task queue from the last checkpoint. A slice task whose number
+doesn't match the shard's is a duplicate and does nothing. status()
+reports the progress of a job and its shards.
+
+A registered query with filters needs a composite index ending in
+__key__, as the shards add key range filters to it.
+
+"""
+
+import logging
+import time
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import MapperJob
+from models import MapperShard
+
+BATCH = 100
+SLICE_SECONDS = 30
+DEFAULT_SHARDS = 8
+# __scatter__ keys sampled per shard to find the split points
+OVERSAMPLE = 32
+TASK_URL = '/tasks/mapper'
+
+# name: (model, function, function returning the query or None,
+#        transactional)
+JOBS = {}
+
+
+def register(name, model, query=None, transactional=False):
+    """Register the decorated batch function as a mapper job over
+    model.query(), or over query() if given; see above for
+    transactional.
+    """
+    def decorator(function):
+        JOBS[name] = (model, function, query, transactional)
+        return function
+    return decorator
+
+
+def _query(name):
+    model, _, query, _ = JOBS[name]
+    return query() if query else model.query()
+
+
+@ndb.transactional(xg=True)
+def _mapEntity(function, key):
+    """Apply a job function to the current version of one entity."""
+    entity = key.get()
+    if entity is None:
+        return
+    puts, deletes = function([entity])
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+
+
+def _splitKeys(name, shards):
+    """Return up to shards - 1 keys splitting the job's kind evenly."""
+    model = JOBS[name][0]
+    # the datastore gives a random sample of entities a __scatter__ value
+    keys = model.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * OVERSAMPLE, keys_only=True)
+    keys.sort(key=lambda k: k.pairs())
+    splits = []
+    for i in xrange(1, shards):
+        key = keys[len(keys) * i // shards] if keys else None
+        if key and key not in splits:
+            splits.append(key)
+    return splits
+
+
+def start(name, shards=DEFAULT_SHARDS):
+    """Start a registered job; returns the job id."""
+    if name not in JOBS:
+        raise ValueError('No mapper job named %s' % name)
+    job_id = '%s-%s' % (name, datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+    bounds = [None] + _splitKeys(name, shards) + [None]
+    shard_entities = [
+        MapperShard(id='%s-%d' % (job_id, i), jobId=job_id, number=i,
+                    start=bounds[i], end=bounds[i + 1])
+        for i in xrange(len(bounds) - 1)]
+    ndb.put_multi(shard_entities + [
+        MapperJob(id=job_id, name=name, shards=len(shard_entities))])
+    for shard in shard_entities:
+        taskqueue.add(params={'shard': shard.key.id(), 'slice': 0},
+                      url=TASK_URL)
+    return job_id
+
+
+def abort(job_id):
+    """Stop a running job; its shards drop their next slice."""
+    job = MapperJob.get_by_id(job_id)
+    if job and job.status == 'running':
+        job.status = 'aborted'
+        job.finished = datetime.utcnow()
+        job.put()
+
+
+@ndb.transactional(xg=True)
+def _checkpoint(shard_id, slice_number, cursor, processed, done):
+    shard = MapperShard.get_by_id(shard_id)
+    if shard.slice != slice_number:
+        return
+    shard.slice += 1
+    shard.processed += processed
+    shard.cursor = cursor
+    shard.lastError = None
+    if done:
+        shard.done = True
+        job = MapperJob.get_by_id(shard.jobId)
+        job.shardsDone += 1
+        if job.shardsDone == job.shards and job.status == 'running':
+            job.status = 'done'
+            job.finished = datetime.utcnow()
+        job.put()
+    else:
+        taskqueue.add(params={'shard': shard_id, 'slice': shard.slice},
+                      url=TASK_URL, transactional=True)
+    shard.put()
+
+
+def runSlice(shard_id, slice_number):
+    """Process one slice of a shard; run by the mapper task."""
+    shard = MapperShard.get_by_id(shard_id)
+    if not shard or shard.done or shard.slice != slice_number:
+        return
+    job = MapperJob.get_by_id(shard.jobId)
+    if job.status != 'running':
+        return
+
+    model, function, _, transactional = JOBS[job.name]
+    query = _query(job.name)
+    if shard.start:
+        query = query.filter(model.key >= shard.start)
+    if shard.end:
+        query = query.filter(model.key < shard.end)
+    query = query.order(model.key)
+
+    cursor = ndb.Cursor(urlsafe=shard.cursor) if shard.cursor else None
+    processed, more = 0, True
+    deadline = time.time() + SLICE_SECONDS
+    try:
+        while more and time.time() < deadline:
+            entities, cursor, more = query.fetch_page(
+                BATCH, start_cursor=cursor, keys_only=transactional)
+            if transactional:
+                for key in entities:
+                    _mapEntity(function, key)
+            else:
+                puts, deletes = function(entities)
+                ndb.put_multi(puts)
+                ndb.delete_multi(deletes)
+            processed += len(entities)
+    except Exception as e:
+        # the task queue retries the slice from the last checkpoint
+        logging.exception('mapper shard %s slice %d failed',
+                          shard_id, slice_number)
+        shard.lastError = '%s: %s' % (type(e).__name__, e)
+        shard.retries += 1
+        shard.put()
+        raise
+    _checkpoint(shard_id, slice_number,
+                cursor.urlsafe() if cursor and more else None,
+                processed, not more)
+
+
+def status(job_id):
+    """Return a job's progress as a dict, or None for an unknown job."""
+    job = MapperJob.get_by_id(job_id)
+    if not job:
+        return None
+    shards = ndb.get_multi([ndb.Key(MapperShard, '%s-%d' % (job_id, i))
+                            for i in xrange(job.shards)])
+    return {
+        'id': job_id,
+        'name': job.name,
+        'status': job.status,
+        'started': job.started.isoformat(),
+        'finished': job.finished.isoformat() if job.finished else None,
+        'processed': sum(s.processed for s in shards if s),
+        'shardsDone': job.shardsDone,
+        'shards': [{
+            'number': s.number,
+            'processed': s.processed,
+            'slice': s.slice,
+            'done': s.done,
+            'retries': s.retries,
+            'lastError': s.lastError,
+        } for s in shards if s],
+    }
+
+
+def recentJobs(limit=20):
+    """Return the ids of the most recently started jobs."""
+    return [k.id() for k in MapperJob.query().order(
+        -MapperJob.started).fetch(limit, keys_only=True)]
@@ -17,6 +17,8 @@ import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
 
+import etags
+
 
 class ConflictException(endpoints.ServiceException):
 
@@ -24,13 +26,71 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
-class Profile(ndb.Model):
+class PreconditionFailedException(endpoints.ServiceException):
+
+    """PreconditionFailedException -- exception mapped to HTTP 412 response"""
+    http_status = httplib.PRECONDITION_FAILED
+
+
+class TooManyRequestsException(endpoints.ServiceException):
+
+    """TooManyRequestsException -- exception mapped to HTTP 503 response;
+    Endpoints v1 rewrites 429, like other unsupported 4xx codes, to 404"""
+    http_status = httplib.SERVICE_UNAVAILABLE
+
+
+class VersionedModel(ndb.Model):
+
+    """VersionedModel -- base for entities exposing a version; bumped on
+    every put and mirrored in memcache until deleted (see etags.py)"""
+    version = ndb.IntegerProperty(default=0, indexed=False)
+
+    def _pre_put_hook(self):
+        self.version = (self.version or 0) + 1
+
+    def _post_put_hook(self, future):
+        if not future.get_exception():
+            etags.publishVersion(self.key, self.version)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        # archiving deletes the live conference too
+        if not future.get_exception():
+            etags.forgetVersion(key)
+        super(VersionedModel, cls)._post_delete_hook(key, future)
+
+
+class SyncedModel(ndb.Model):
+
+    """SyncedModel -- base for entities delivered by syncChanges(); stamps
+    every put and leaves a Tombstone behind on delete"""
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def _tombstoneOwner(cls, key):
+        """Return the user id a deletion is reported to; '' for everyone."""
+        return ''
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        owner = cls._tombstoneOwner(key)
+        if owner is not None:
+            tombstone = Tombstone(id=key.urlsafe(), entityKind=key.kind(),
+                                  owner=owner)
+            ndb.get_context().call_on_commit(tombstone.put)
+
+
+class Profile(VersionedModel):
 
     """Profile -- User profile object"""
-    displayName = ndb.StringProperty()
-    mainEmail = ndb.StringProperty()
-    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
-    conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    displayName = ndb.StringProperty(indexed=False)
+    mainEmail = ndb.StringProperty(indexed=False)
+    teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED', indexed=False)
+    conferencesToAttend = ndb.KeyProperty(kind='Conference', repeated=True,
+                                          indexed=False)
+    # legacy urlsafe keys, moved into conferencesToAttend by the
+    # attendance migration task
+    conferenceKeysToAttend = ndb.StringProperty(repeated=True, indexed=False)
 
 
 class ProfileMiniForm(messages.Message):
@@ -47,6 +107,8 @@ class ProfileForm(messages.Message):
     mainEmail = messages.StringField(2)
     teeShirtSize = messages.EnumField('TeeShirtSize', 3)
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
+    etag = messages.StringField(5)
+    notModified = messages.BooleanField(6)
 
 
 class StringMessage(messages.Message):
@@ -61,19 +123,32 @@ class BooleanMessage(messages.Message):
     data = messages.BooleanField(1)
 
 
-class Conference(ndb.Model):
+class IntegerMessage(messages.Message):
+
+    """IntegerMessage-- outbound integer value message"""
+    data = messages.IntegerField(1)
+
+
+class Conference(VersionedModel, SyncedModel):
 
     """Conference -- Conference object"""
     name = ndb.StringProperty(required=True)
-    description = ndb.StringProperty()
-    organizerUserId = ndb.StringProperty()
+    description = ndb.StringProperty(indexed=False)
+    organizerUserId = ndb.StringProperty(indexed=False)
     topics = ndb.StringProperty(repeated=True)
     city = ndb.StringProperty()
     startDate = ndb.DateProperty()
     month = ndb.IntegerProperty()
-    endDate = ndb.DateProperty()
+    endDate = ndb.DateProperty(indexed=False)
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    waitlistSequence = ndb.IntegerProperty(default=0, indexed=False)
+    waitlistCount = ndb.IntegerProperty(default=0, indexed=False)
+
+    def _post_put_hook(self, future):
+        super(Conference, self)._post_put_hook(future)
+        # the organizer's getConferencesCreated() list changed too
+        etags.bumpStamp('conferences-' + self.key.parent().urlsafe())
 
 
 class ConferenceForm(messages.Message):
@@ -91,12 +166,30 @@ class ConferenceForm(messages.Message):
     endDate = messages.StringField(10)
     websafeKey = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag = messages.StringField(13)
+    notModified = messages.BooleanField(14)
+    idempotencyKey = messages.StringField(15)
 
 
 class ConferenceForms(messages.Message):
 
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+    nextPageToken = messages.StringField(4)
+
+
+class DashboardForm(messages.Message):
+
+    """DashboardForm -- what the client shows on load for a signed in user"""
+    profile = messages.MessageField(ProfileForm, 1)
+    conferencesToAttend = messages.MessageField(ConferenceForm, 2,
+                                                repeated=True)
+    conferencesCreated = messages.MessageField(ConferenceForm, 3,
+                                               repeated=True)
+    announcement = messages.StringField(4)
+    wishlistCount = messages.IntegerField(5)
 
 
 class TeeShirtSize(messages.Enum):
@@ -127,23 +220,45 @@ class ConferenceQueryForm(messages.Message):
     value = messages.StringField(3)
 
 
+class FacetCountForm(messages.Message):
+
+    """FacetCountForm -- number of conferences having a facet value"""
+    value = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class ConferenceFacetsForm(messages.Message):
+
+    """ConferenceFacetsForm -- facet counts of the conferences matching
+    a query, highest count first"""
+    total = messages.IntegerField(1)
+    cities = messages.MessageField(FacetCountForm, 2, repeated=True)
+    topics = messages.MessageField(FacetCountForm, 3, repeated=True)
+    months = messages.MessageField(FacetCountForm, 4, repeated=True)
+
+
 class ConferenceQueryForms(messages.Message):
 
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    includeArchived = messages.BooleanField(2)
 
 
-class ConferenceSession(ndb.Model):
+class ConferenceSession(SyncedModel):
 
     """ConferenceSession -- ConferenceSession object"""
-    name = ndb.StringProperty(required=True)
-    highlights = ndb.StringProperty()
+    name = ndb.StringProperty(required=True, indexed=False)
+    highlights = ndb.StringProperty(indexed=False)
     speaker = ndb.StringProperty(required=True)
-    duration = ndb.IntegerProperty(required=True)
+    duration = ndb.IntegerProperty(required=True, indexed=False)
     typeOfSession = ndb.StringProperty(required=True)
     date = ndb.DateProperty(required=True)
-    startTime = ndb.StringProperty(required=True)
-    createdTime = ndb.IntegerProperty(required=True)
+    startTime = ndb.StringProperty(required=True, indexed=False)
+    createdTime = ndb.IntegerProperty(required=True, indexed=False)
+    # normalized schedule, derived from date, startTime & duration
+    startDateTime = ndb.DateTimeProperty(indexed=False)
+    endDateTime = ndb.DateTimeProperty(indexed=False)
+    startMinute = ndb.IntegerProperty()
 
 
 class ConferenceSessionCreatedResponse(messages.Message):
@@ -172,20 +287,40 @@ class ConferenceSessionForm(messages.Message):
     date = messages.StringField(6, required=True)
     startTime = messages.StringField(7, required=True)
     sessionKey = messages.StringField(8, required=True)
+    conferenceKey = messages.StringField(9)
 
 
 class ConferenceSessionForms(messages.Message):
 
     """ConferenceSessionForms -- multiple sessions outbound form message"""
     items = messages.MessageField(ConferenceSessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 
-class SessionWishlistItem(ndb.Model):
+class SessionWishlistItem(SyncedModel):
 
-    """Class representing a wishlisted session."""
+    """Class representing a wishlisted session; keyed by the session's
+    websafe key under the user's Profile key (legacy items have generated
+    ids and no parent until the wishlist migration task re-keys them);
+    sessionKey is indexed for the archive."""
     userId = ndb.StringProperty(required=True)
     sessionKey = ndb.StringProperty(required=True)
 
+    @classmethod
+    def _tombstoneOwner(cls, key):
+        # only items keyed under their owner's Profile can be reported
+        parent = key.parent()
+        return parent.id() if parent and parent.kind() == 'Profile' else None
+
+
+class WishlistSize(ndb.Model):
+
+    """WishlistSize -- number of SessionWishlistItems under a Profile,
+    kept by modifyWishlist; deleted when items move in or out of the
+    Profile otherwise, and recounted by the next change"""
+    size = ndb.IntegerProperty(default=0, indexed=False)
+
 
 class GetFeaturedSpeakerResponse(messages.Message):
 
@@ -214,3 +349,190 @@ class GetConferenceSpeakersResponse(messages.Message):
 
     """Response class for getting conference speakers."""
     speakers = messages.StringField(1, repeated=True)
+
+
+class WaitlistEntry(ndb.Model):
+
+    """WaitlistEntry -- pending registration, child of a Conference and
+    keyed by the waiting user's id"""
+    userId = ndb.StringProperty(required=True, indexed=False)
+    sequence = ndb.IntegerProperty(required=True)
+
+
+class WaitlistPositionForm(messages.Message):
+
+    """WaitlistPositionForm -- outbound waitlist position message;
+    position is 0 when the user is not waitlisted"""
+    position = messages.IntegerField(1)
+    waitlistSize = messages.IntegerField(2)
+
+
+class ConferenceAttendee(ndb.Model):
+
+    """ConferenceAttendee -- attendee index entry, child of a Conference
+    and keyed by the registered user's id"""
+    userId = ndb.StringProperty(required=True, indexed=False)
+
+
+class AttendeeForm(messages.Message):
+
+    """AttendeeForm -- conference attendee outbound form message"""
+    displayName = messages.StringField(1)
+    mainEmail = messages.StringField(2)
+
+
+class AttendeeForms(messages.Message):
+
+    """AttendeeForms -- page of conference attendees outbound form message"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class SessionConflictForm(messages.Message):
+
+    """SessionConflictForm -- pair of overlapping sessions outbound message"""
+    first = messages.MessageField(ConferenceSessionForm, 1, required=True)
+    second = messages.MessageField(ConferenceSessionForm, 2, required=True)
+
+
+class SessionConflictForms(messages.Message):
+
+    """SessionConflictForms -- multiple session conflicts outbound message"""
+    items = messages.MessageField(SessionConflictForm, 1, repeated=True)
+
+
+class ConferenceAgenda(ndb.Model):
+
+    """ConferenceAgenda -- materialized agenda of a conference, keyed by
+    the conference's websafe key; holds a compressed, JSON encoded
+    ConferenceSessionForms message"""
+    data = ndb.BlobProperty(compressed=True)
+    builtTime = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    def _post_put_hook(self, future):
+        # getConferenceSessions() ETags follow the agenda's content
+        etags.bumpStamp('agenda-' + self.key.id())
+
+
+class SessionRecommendation(ndb.Model):
+
+    """SessionRecommendation -- sessions most often wishlisted together
+    with a session, keyed by the session's websafe key; neighbors holds
+    [websafe key, count] pairs, highest count first"""
+    neighbors = ndb.JsonProperty(compressed=True)
+    builtTime = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class ExportFile(ndb.Model):
+
+    """ExportFile -- conference export built by the export task, keyed
+    by '<websafe conference key>/<file name>'; the content of each build
+    is held by ExportChunk children keyed '<generation>-<n>', n from 1,
+    and generation is the build served"""
+    contentType = ndb.StringProperty(indexed=False)
+    chunks = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    built = ndb.DateTimeProperty(indexed=False)
+    # files built before generations have None and integer chunk ids
+    generation = ndb.IntegerProperty(indexed=False)
+    building = ndb.IntegerProperty(indexed=False)
+
+
+class ExportChunk(ndb.Model):
+
+    """ExportChunk -- consecutive bytes of an ExportFile"""
+    data = ndb.BlobProperty(compressed=True)
+
+
+class MapperJob(ndb.Model):
+
+    """MapperJob -- a run of a registered mapper.py job"""
+    name = ndb.StringProperty(indexed=False)
+    status = ndb.StringProperty(default='running', indexed=False)
+    shards = ndb.IntegerProperty(indexed=False)
+    shardsDone = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+
+class MapperShard(ndb.Model):
+
+    """MapperShard -- key range of a MapperJob and its checkpoint, keyed
+    by '<job id>-<shard number>'"""
+    jobId = ndb.StringProperty(indexed=False)
+    number = ndb.IntegerProperty(indexed=False)
+    start = ndb.KeyProperty(indexed=False)
+    end = ndb.KeyProperty(indexed=False)
+    cursor = ndb.TextProperty()
+    slice = ndb.IntegerProperty(default=0, indexed=False)
+    processed = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    retries = ndb.IntegerProperty(default=0, indexed=False)
+    lastError = ndb.TextProperty()
+
+
+class FacetShard(ndb.Model):
+
+    """FacetShard -- part of the conference facet counts, see facets.py;
+    counts maps JSON encoded cells to conference counts"""
+    counts = ndb.JsonProperty(compressed=True)
+
+
+class SearchPosting(ndb.Model):
+
+    """SearchPosting -- shard of a search term's posting list, keyed by
+    '<term>|<shard>'; postings maps websafe conference keys to scores"""
+    postings = ndb.JsonProperty(compressed=True)
+
+
+class SearchDocument(ndb.Model):
+
+    """SearchDocument -- indexed terms of a conference and their scores,
+    keyed by the conference's websafe key; leasedUntil is set while a
+    task reindexes it"""
+    terms = ndb.JsonProperty(compressed=True)
+    leasedUntil = ndb.DateTimeProperty(indexed=False)
+
+
+class Tombstone(ndb.Model):
+
+    """Tombstone -- marks a deleted SyncedModel entity for syncChanges(),
+    keyed by the deleted entity's websafe key"""
+    entityKind = ndb.StringProperty(indexed=False)
+    owner = ndb.StringProperty(default='')
+    deleted = ndb.DateTimeProperty(auto_now=True)
+
+
+class TombstoneForm(messages.Message):
+
+    """TombstoneForm -- deleted entity outbound form message"""
+    kind = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+
+
+class WishlistItemForm(messages.Message):
+
+    """WishlistItemForm -- wishlist entry outbound form message"""
+    websafeKey = messages.StringField(1)
+    sessionKey = messages.StringField(2)
+
+
+class SyncChangesForm(messages.Message):
+
+    """SyncChangesForm -- one page of changes since a sync checkpoint"""
+    deleted = messages.MessageField(TombstoneForm, 1, repeated=True)
+    conferences = messages.MessageField(ConferenceForm, 2, repeated=True)
+    sessions = messages.MessageField(ConferenceSessionForm, 3, repeated=True)
+    wishlist = messages.MessageField(WishlistItemForm, 4, repeated=True)
+    nextPageToken = messages.StringField(5)
+    checkpoint = messages.StringField(6)
+    fullSync = messages.BooleanField(7)
+
+
+class IdempotencyRecord(ndb.Model):
+
+    """IdempotencyRecord -- response of a create request, keyed by
+    endpoint, user and idempotency key (see idempotency.py)"""
+    response = ndb.TextProperty()
+    expires = ndb.DateTimeProperty()
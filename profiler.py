@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+profiler.py -- Conference Central sampled CPU profiling of requests
+
+$Id$
+
+middleware() wraps a WSGI application, the Endpoints API server or
+main.app, and runs cProfile on a PROFILE_SAMPLE_RATE share of its
+requests, including the streaming of their response bodies. Whether a
+request is slow is only known once it has run, so a request slower than
+PROFILE_SLOW_MS arms its endpoint instead: the next PROFILE_SLOW_CAPTURES
+requests to it are profiled whatever the sample rate.
+
+Each profiled request keeps its PROFILE_TOP functions with the most own
+time, with its endpoint and latency, in a ring buffer holding the last
+PROFILE_BUFFER profiles of the instance. dump() aggregates the buffer per
+endpoint for the admin-only /admin/profiles handler. Endpoints are named
+by request path, with key-like path segments replaced by '*'.
+
+"""
+
+import collections
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+from settings import PROFILE_BUFFER
+from settings import PROFILE_SAMPLE_RATE
+from settings import PROFILE_SLOW_CAPTURES
+from settings import PROFILE_SLOW_MS
+from settings import PROFILE_TOP
+
+ROOT = os.path.dirname(os.path.abspath(__file__)) + os.sep
+# path segments this long are ids, such as websafe keys
+ID_SEGMENT_RE = re.compile(r'^[\w-]{24,}$')
+
+_lock = threading.Lock()
+_profiles = collections.deque(maxlen=PROFILE_BUFFER)
+# endpoint: profiled requests still due after a slow request
+_armed = {}
+
+
+def _endpoint(environ):
+    return '/'.join('*' if ID_SEGMENT_RE.match(segment) else segment
+                    for segment in environ.get('PATH_INFO', '').split('/'))
+
+
+def _sampled(endpoint):
+    with _lock:
+        if _armed.get(endpoint):
+            _armed[endpoint] -= 1
+            return True
+    return random.random() < PROFILE_SAMPLE_RATE
+
+
+def _top(profile):
+    """Return the PROFILE_TOP functions of a finished profile with the
+    most own time, as [function, calls, own ms, cumulative ms] rows."""
+    rows = []
+    for func, (_, calls, own, cumulative, _) in pstats.Stats(
+            profile).stats.iteritems():
+        rows.append([pstats.func_std_string(func).replace(ROOT, ''), calls,
+                     round(own * 1000, 3), round(cumulative * 1000, 3)])
+    rows.sort(key=lambda row: -row[2])
+    return rows[:PROFILE_TOP]
+
+
+def _finish(endpoint, profile, elapsed):
+    ms = elapsed * 1000
+    slow = PROFILE_SLOW_MS is not None and ms > PROFILE_SLOW_MS
+    if profile:
+        entry = {'endpoint': endpoint, 'ms': round(ms, 2), 'slow': slow,
+                 'time': time.time(), 'top': _top(profile)}
+        with _lock:
+            _profiles.append(entry)
+    elif slow:
+        with _lock:
+            _armed[endpoint] = PROFILE_SLOW_CAPTURES
+
+
+class _Response(object):
+
+    """_Response -- response body of a timed, maybe profiled request; the
+    request is recorded when the server closes it"""
+
+    def __init__(self, endpoint, profile, started, body):
+        self.endpoint = endpoint
+        self.profile = profile
+        self.started = started
+        self.body = body
+
+    def __iter__(self):
+        chunks = iter(self.body)
+        while True:
+            if self.profile:
+                self.profile.enable()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                if self.profile:
+                    self.profile.disable()
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            _finish(self.endpoint, self.profile, time.time() - self.started)
+
+
+def middleware(app):
+    """Wrap a WSGI application with the profiler; returns app unchanged
+    if profiling is off."""
+    if not PROFILE_SAMPLE_RATE and PROFILE_SLOW_MS is None:
+        return app
+
+    def wrapper(environ, start_response):
+        endpoint = _endpoint(environ)
+        # cProfile only sees the thread that enables it
+        profile = cProfile.Profile() if _sampled(endpoint) else None
+        started = time.time()
+        if profile:
+            profile.enable()
+        try:
+            body = app(environ, start_response)
+        finally:
+            if profile:
+                profile.disable()
+        return _Response(endpoint, profile, started, body)
+    return wrapper
+
+
+def dump(endpoint=None):
+    """Return the buffered profiles, or those of one endpoint, as
+    {endpoint: summary}; a summary gives the profiled and slow requests,
+    their mean latency and the PROFILE_TOP functions by own time summed
+    over them."""
+    with _lock:
+        profiles = list(_profiles)
+    summaries = {}
+    for profile in profiles:
+        if endpoint and profile['endpoint'] != endpoint:
+            continue
+        summary = summaries.setdefault(profile['endpoint'], {
+            'requests': 0, 'slow': 0, 'ms': 0.0, 'functions': {}})
+        summary['requests'] += 1
+        summary['slow'] += profile['slow']
+        summary['ms'] += profile['ms']
+        for function, calls, own, cumulative in profile['top']:
+            row = summary['functions'].setdefault(function, [0, 0.0, 0.0])
+            row[0] += calls
+            row[1] += own
+            row[2] += cumulative
+
+    for summary in summaries.values():
+        summary['meanMs'] = round(summary.pop('ms') / summary['requests'], 2)
+        functions = sorted(summary['functions'].items(),
+                           key=lambda item: -item[1][1])
+        summary['functions'] = [
+            {'function': function, 'calls': calls, 'ownMs': round(own, 3),
+             'cumulativeMs': round(cumulative, 3)}
+            for function, (calls, own, cumulative)
+            in functions[:PROFILE_TOP]]
+    return summaries
+
+
+def reset():
+    """Forget the buffered profiles and armed endpoints."""
+    with _lock:
+        _profiles.clear()
+        _armed.clear()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+"""
+recommendations.py -- Conference Central "also wishlisted" sessions
+
+$Id$
+
+Two sessions co-occur once for every user who wishlisted both. Each
+session's row of that sparse co-occurrence matrix is kept, cut down to
+its CANDIDATES strongest entries, in one SessionRecommendation entity
+keyed by the session's websafe key, so recommendations are served with
+a single get.
+
+The rebuild_recommendations mapper job (see jobs.py), started nightly
+by cron, recomputes the rows of a batch of sessions at a time: it finds
+the users who wishlisted each session through the indexed sessionKey
+and counts over their wishlists. rebuild() does the same in one pass,
+which is quicker on small data sets such as the benchmarks'. Between
+rebuilds, wishlisting sessions bumps their rows and those of the user's
+other wishlisted sessions, in concurrent transactions. A bumped pair
+missing from a full row replaces the weakest entry and takes over its
+count (the Space-Saving scheme), so the counts of the strongest
+neighbors stay close to exact; any drift, and items removed from
+wishlists, are settled by the next rebuild.
+
+"""
+
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import SessionRecommendation
+from models import SessionWishlistItem
+
+# neighbors kept per session; recommendations come from the top of these
+CANDIDATES = 50
+RECOMMENDATIONS = 10
+BATCH = 500
+# longer wishlists are cut to this many sessions; their pair count grows
+# with the square of their length and adds little signal
+MAX_WISHLIST = 100
+
+
+def _bump(neighbors, sessionKey, count=1):
+    """Add count to sessionKey's entry of a [[key, count], ...] row."""
+    for entry in neighbors:
+        if entry[0] == sessionKey:
+            entry[1] += count
+            break
+    else:
+        if len(neighbors) < CANDIDATES:
+            neighbors.append([sessionKey, count])
+        else:
+            weakest = min(neighbors, key=lambda e: e[1])
+            weakest[0] = sessionKey
+            weakest[1] += count
+    neighbors.sort(key=lambda e: (-e[1], e[0]))
+
+
+def _countPairs(matrix, sessionKeys):
+    sessionKeys = sorted(set(sessionKeys))[:MAX_WISHLIST]
+    for i, first in enumerate(sessionKeys):
+        for second in sessionKeys[i + 1:]:
+            row = matrix.setdefault(first, {})
+            row[second] = row.get(second, 0) + 1
+            row = matrix.setdefault(second, {})
+            row[first] = row.get(first, 0) + 1
+
+
+def _wishlist(user_id):
+    """Return a future for the websafe session keys a user wishlisted."""
+    # items are keyed by their session under the user's Profile
+    return SessionWishlistItem.query(
+        ancestor=ndb.Key(Profile, user_id)).map_async(
+        lambda key: key.id(), keys_only=True)
+
+
+def _row(sessionKey, neighbors):
+    """Return the entity of a row, or None for an empty row."""
+    if not neighbors:
+        return None
+    neighbors = sorted(neighbors.iteritems(), key=lambda e: (-e[1], e[0]))
+    return SessionRecommendation(
+        id=sessionKey, neighbors=[list(e) for e in neighbors[:CANDIDATES]])
+
+
+def rebuildRows(sessions):
+    """Recompute the rows of a batch of ConferenceSessions; the
+    rebuild_recommendations mapper job."""
+    wssks = [cs.key.urlsafe() for cs in sessions]
+    wishlisters = [
+        SessionWishlistItem.query(
+            SessionWishlistItem.sessionKey == wssk).fetch_async(
+            keys_only=True) for wssk in wssks]
+    users = {}
+    for future in wishlisters:
+        for key in future.get_result():
+            # legacy items have no parent until migrate_wishlists ran
+            if key.parent() and key.parent().id() not in users:
+                users[key.parent().id()] = _wishlist(key.parent().id())
+
+    puts, deletes = [], []
+    for wssk, future in zip(wssks, wishlisters):
+        row = {}
+        for key in future.get_result():
+            if not key.parent():
+                continue
+            wishlist = sorted(set(
+                users[key.parent().id()].get_result()))[:MAX_WISHLIST]
+            # pairs of sessions cut from a long wishlist don't count
+            if wssk not in wishlist:
+                continue
+            for other in wishlist:
+                if other != wssk:
+                    row[other] = row.get(other, 0) + 1
+        rec = _row(wssk, row)
+        if rec:
+            puts.append(rec)
+        else:
+            deletes.append(ndb.Key(SessionRecommendation, wssk))
+    return puts, deletes
+
+
+def rebuild():
+    """Recompute every session's neighbors from the wishlists in one
+    pass."""
+    matrix = {}
+    query = SessionWishlistItem.query().order(SessionWishlistItem.userId)
+    user_id, sessionKeys = None, []
+    cursor, more = None, True
+    while more:
+        items, cursor, more = query.fetch_page(BATCH, start_cursor=cursor)
+        # items come grouped by user; a user may span pages
+        for item in items:
+            if item.userId != user_id:
+                _countPairs(matrix, sessionKeys)
+                user_id, sessionKeys = item.userId, []
+            sessionKeys.append(item.sessionKey)
+    _countPairs(matrix, sessionKeys)
+
+    recs = [_row(sessionKey, row) for sessionKey, row in matrix.iteritems()]
+    for i in xrange(0, len(recs), BATCH):
+        ndb.put_multi(recs[i:i + BATCH])
+
+    # sessions nobody wishlists together any more
+    stale = [k for k in SessionRecommendation.query().iter(keys_only=True)
+             if k.id() not in matrix]
+    for i in xrange(0, len(stale), BATCH):
+        ndb.delete_multi(stale[i:i + BATCH])
+
+
+@ndb.transactional_tasklet
+def _bumpRow(sessionKey, others):
+    rec = (yield SessionRecommendation.get_by_id_async(sessionKey)) or (
+        SessionRecommendation(id=sessionKey, neighbors=[]))
+    for other in others:
+        _bump(rec.neighbors, other)
+    yield rec.put_async()
+
+
+def recordWishlisted(user_id, sessionKeys):
+    """Count the pairs a user's new wishlist items form; run from the
+    task enqueued by wishlist changes.
+    """
+    sessionKeys = sorted(set(sessionKeys))[:MAX_WISHLIST]
+    others = set(_wishlist(user_id).get_result())
+    others = sorted(others - set(sessionKeys))[
+        :MAX_WISHLIST - len(sessionKeys)]
+    # every row is its own entity group; bump them side by side
+    futures = []
+    for sessionKey in sessionKeys:
+        pairs = [s for s in sessionKeys if s != sessionKey] + others
+        if pairs:
+            futures.append(_bumpRow(sessionKey, pairs))
+    for other in others:
+        futures.append(_bumpRow(other, sessionKeys))
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+
+
+def topSessions(sessionKey, limit=RECOMMENDATIONS):
+    """Return the websafe keys of the sessions most often wishlisted
+    together with sessionKey, strongest first.
+    """
+    rec = SessionRecommendation.get_by_id(sessionKey)
+    return [key for key, _ in rec.neighbors[:limit]] if rec else []
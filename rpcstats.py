@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+rpcstats.py -- Conference Central per-request datastore & memcache
+    RPC instrumentation
+
+$Id$
+
+Hooks the App Engine API proxy so every datastore_v3 and memcache RPC
+made while an @instrumented endpoint or handler runs is counted, timed
+and sized. The hooks go on the proxy in place when install() is called:
+main.py and conference.py call it at startup, a testbed after activating
+its stubs. Each request logs one structured summary line; totals per
+endpoint are kept in memory and, if RPC_STATS_FILE is set, written to
+that file for offline analysis on the dev server.
+
+"""
+
+import functools
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+
+from settings import RPC_STATS_FILE
+
+HOOK_KEY = 'rpcstats'
+SERVICES = ('datastore_v3', 'memcache')
+
+_local = threading.local()
+_lock = threading.Lock()
+_totals = {}
+
+
+def _byteSize(message):
+    """Return the serialized size of an RPC protocol buffer, 0 if unknown."""
+    try:
+        return message.ByteSize()
+    except Exception:
+        return 0
+
+
+class RequestStats(object):
+
+    """RequestStats -- RPC counters for a single request"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.elapsed = 0.0
+        # 'service.Call' -> [count, milliseconds, bytes sent,
+        #                    bytes received, errors]
+        self.calls = {}
+        self._pending = {}
+
+    def before(self, rpc):
+        self._pending[id(rpc)] = time.time()
+
+    def after(self, service, call, request, response, rpc, error):
+        started = self._pending.pop(id(rpc), None)
+        row = self.calls.setdefault('%s.%s' % (service, call),
+                                    [0, 0.0, 0, 0, 0])
+        row[0] += 1
+        if started is not None:
+            row[1] += (time.time() - started) * 1000
+        row[2] += _byteSize(request)
+        row[3] += _byteSize(response)
+        if error is not None:
+            row[4] += 1
+
+    def count(self, service=None):
+        """Return the number of RPCs made, optionally for one service."""
+        return sum(row[0] for name, row in self.calls.items()
+                   if service is None or name.startswith(service + '.'))
+
+    def summary(self):
+        """Return the request's stats as a JSON serializable dict."""
+        return {
+            'endpoint': self.name,
+            'ms': round(self.elapsed * 1000, 2),
+            'rpcs': dict(
+                (name, {'count': row[0], 'ms': round(row[1], 2),
+                        'bytesOut': row[2], 'bytesIn': row[3],
+                        'errors': row[4]})
+                for name, row in self.calls.items()),
+        }
+
+
+def _preCall(service, call, request, response, rpc):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.before(rpc)
+
+
+def _postCall(service, call, request, response, rpc, error):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.after(service, call, request, response, rpc, error)
+
+
+def install():
+    """Register the hooks on the current API proxy; safe to call more
+    than once."""
+    # looked up on each call: an activated testbed swaps in its own proxy
+    for service in SERVICES:
+        key = '%s-%s' % (HOOK_KEY, service)
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            key, _preCall, service)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            key, _postCall, service)
+
+
+def current():
+    """Return the RequestStats of the request running in this thread."""
+    return getattr(_local, 'stats', None)
+
+
+def totals():
+    """Return a copy of the aggregated per-endpoint stats."""
+    with _lock:
+        return json.loads(json.dumps(_totals))
+
+
+def reset():
+    """Forget all aggregated stats."""
+    with _lock:
+        _totals.clear()
+
+
+def _record(stats):
+    """Fold a finished request into the per-endpoint totals."""
+    with _lock:
+        total = _totals.setdefault(
+            stats.name, {'requests': 0, 'ms': 0.0, 'rpcs': {}})
+        total['requests'] += 1
+        total['ms'] += stats.elapsed * 1000
+        for name, row in stats.calls.items():
+            rpc = total['rpcs'].setdefault(
+                name, {'count': 0, 'ms': 0.0, 'bytesOut': 0, 'bytesIn': 0,
+                       'errors': 0})
+            rpc['count'] += row[0]
+            rpc['ms'] += row[1]
+            rpc['bytesOut'] += row[2]
+            rpc['bytesIn'] += row[3]
+            rpc['errors'] += row[4]
+
+        if RPC_STATS_FILE:
+            try:
+                with open(RPC_STATS_FILE, 'w') as f:
+                    json.dump(_totals, f, indent=2, sort_keys=True)
+            except IOError:
+                # the production filesystem is read-only
+                logging.warning('rpcstats: cannot write %s', RPC_STATS_FILE)
+
+
+def instrumented(func):
+    """Decorator recording the RPCs made by an endpoint or handler method.
+
+    Apply it below @endpoints.method so the endpoint keeps its name.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # only the outermost instrumented call owns the request stats
+        if current() is not None:
+            return func(*args, **kwargs)
+
+        name = func.__name__
+        if args:
+            name = '%s.%s' % (type(args[0]).__name__, name)
+        stats = _local.stats = RequestStats(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.stats = None
+            stats.elapsed = time.time() - stats.started
+            logging.info('rpcstats %s',
+                         json.dumps(stats.summary(), sort_keys=True))
+            _record(stats)
+    return wrapper
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""
+search.py -- Conference Central full-text conference search
+
+$Id$
+
+A conference's document is the text of its name and description and of
+its sessions' names, highlights and speakers. Documents are tokenized,
+stemmed and scored per term, each field with its own weight. The
+inverted index maps a term to postings {websafe conference key: score},
+split over POSTING_SHARDS SearchPosting entities per term by a hash of
+the conference key; each document's own term scores are kept in a
+SearchDocument so a reindex only touches the terms that changed.
+
+Writes of conferences and sessions enqueue an index task. Tasks of the
+same conference take turns: a task holds a lease on the SearchDocument
+while it reads the conference and writes the postings, and a task
+finding the lease taken is retried later. Tasks running side by side
+could otherwise both diff against the same old terms and leave stale
+postings behind. search()
+matches every query word as a prefix of indexed terms, ranks the
+conferences having all words by tf-idf, and caches posting lists and
+rankings in instance memory for CACHE_SECONDS.
+
+"""
+
+import math
+import re
+import threading
+import time
+import zlib
+from datetime import datetime
+from datetime import timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceSession
+from models import SearchDocument
+from models import SearchPosting
+
+POSTING_SHARDS = 8
+# indexed terms a query word's prefix may expand to
+PREFIX_EXPANSION = 20
+CACHE_SECONDS = 60
+CACHE_ENTRIES = 1000
+MAX_RESULTS = 500
+SEARCH_URL = '/tasks/index_conference'
+# as long as a task may run, so a lease never expires under its holder
+INDEX_LEASE = timedelta(minutes=10)
+
+# field: (entity, attribute, weight)
+FIELD_WEIGHTS = (
+    ('conference', 'name', 3.0),
+    ('conference', 'description', 1.0),
+    ('session', 'name', 2.0),
+    ('session', 'highlights', 1.0),
+    ('session', 'speaker', 2.0),
+)
+STOPWORDS = frozenset(
+    'a an and are as at be by for from has in is it of on or that the to '
+    'was were will with'.split())
+# longest first; stripped after plurals when the stem keeps three
+# characters
+SUFFIXES = ('ational', 'ization', 'fulness', 'iveness', 'ation', 'ment',
+            'ness', 'ing', 'ied', 'er', 'ed', 'ly')
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# longer words are cut; terms are part of datastore key names
+MAX_TERM_LENGTH = 64
+
+
+def stem(word):
+    """Strip the common English suffixes off a lowercase word."""
+    if word.endswith('sses'):
+        word = word[:-2]
+    elif word.endswith('ies') and len(word) > 4:
+        word = word[:-3] + 'y'
+    elif word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+        word = word[:-1]
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)] + ('y' if suffix == 'ied' else '')
+            break
+    # 'running' -> 'runn' -> 'run'
+    if len(word) > 3 and word[-1] == word[-2] and word[-1] not in 'aeioufslz':
+        word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """Return the stemmed terms of text."""
+    return [stem(w[:MAX_TERM_LENGTH])
+            for w in TOKEN_RE.findall((text or u'').lower())
+            if w not in STOPWORDS]
+
+
+def _terms(conf, sessions):
+    """Return {term: score} of a conference's document."""
+    scores = {}
+    for entity, attribute, weight in FIELD_WEIGHTS:
+        for item in ([conf] if entity == 'conference' else sessions):
+            for term in tokenize(getattr(item, attribute)):
+                scores[term] = scores.get(term, 0) + weight
+    # damp long documents: log-scaled term frequency
+    return dict((t, round(1 + math.log(s), 3)) for t, s in scores.items())
+
+
+def _postingKey(term, wsck):
+    shard = zlib.crc32(wsck.encode('utf-8')) % POSTING_SHARDS
+    return ndb.Key(SearchPosting, u'%s|%d' % (term, shard))
+
+
+@ndb.transactional
+def _updatePosting(p_key, wsck, score):
+    posting = p_key.get()
+    if not posting:
+        if not score:
+            return
+        posting = SearchPosting(key=p_key, postings={})
+    if score:
+        posting.postings[wsck] = score
+    else:
+        posting.postings.pop(wsck, None)
+    if posting.postings:
+        posting.put()
+    else:
+        p_key.delete()
+
+
+def indexLater(wsck):
+    """Enqueue reindexing of a conference, with the current transaction
+    if any."""
+    taskqueue.add(params={'websafeConferenceKey': wsck}, url=SEARCH_URL,
+                  transactional=ndb.in_transaction())
+
+
+class IndexBusy(Exception):
+
+    """IndexBusy -- another task holds the conference's index lease"""
+
+
+@ndb.transactional
+def _lease(wsck):
+    """Take the index lease of a conference; returns the terms its
+    postings were last written with."""
+    doc = SearchDocument.get_by_id(wsck)
+    now = datetime.utcnow()
+    if doc and doc.leasedUntil and doc.leasedUntil > now:
+        raise IndexBusy(wsck)
+    doc = doc or SearchDocument(id=wsck, terms={})
+    doc.leasedUntil = now + INDEX_LEASE
+    doc.put()
+    return doc.terms or {}
+
+
+@ndb.transactional
+def _release(wsck, terms):
+    """Record the terms the postings now hold and drop the lease."""
+    if terms:
+        SearchDocument(id=wsck, terms=terms).put()
+    else:
+        ndb.Key(SearchDocument, wsck).delete()
+
+
+def indexConference(wsck):
+    """Bring the index entries of a conference up to date; run by the
+    index task. A deleted conference is removed from the index. Raises
+    IndexBusy while another task indexes the same conference.
+    """
+    # the lease serializes tasks, so the conference is read after any
+    # earlier task's postings are written
+    old = _lease(wsck)
+    c_key = ndb.Key(urlsafe=wsck)
+    conf = c_key.get()
+    terms = {}
+    if conf:
+        terms = _terms(conf, ConferenceSession.query(ancestor=c_key).fetch())
+    for term in set(old) | set(terms):
+        if old.get(term) != terms.get(term):
+            _updatePosting(_postingKey(term, wsck), wsck, terms.get(term))
+    _release(wsck, terms)
+
+
+def rebuild():
+    """Recreate the whole index in one pass; quicker than the
+    index_search mapper job on small data sets, such as the benchmarks'.
+    """
+    sessions = {}
+    for cs in ConferenceSession.query():
+        sessions.setdefault(cs.key.parent(), []).append(cs)
+    postings = {}
+    docs = []
+    for conf in Conference.query():
+        wsck = conf.key.urlsafe()
+        terms = _terms(conf, sessions.get(conf.key, []))
+        docs.append(SearchDocument(id=wsck, terms=terms))
+        for term, score in terms.iteritems():
+            postings.setdefault(_postingKey(term, wsck), {})[wsck] = score
+    ndb.delete_multi(SearchPosting.query().fetch(keys_only=True) +
+                     SearchDocument.query().fetch(keys_only=True))
+    entities = docs + [SearchPosting(key=k, postings=p)
+                       for k, p in postings.iteritems()]
+    for i in xrange(0, len(entities), 500):
+        ndb.put_multi(entities[i:i + 500])
+
+
+class _Cache(object):
+
+    """_Cache -- small thread-safe TTL cache in instance memory"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def get(self, key, compute):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+        value = compute()
+        with self.lock:
+            if len(self.entries) >= CACHE_ENTRIES:
+                self.entries.clear()
+            self.entries[key] = (now + CACHE_SECONDS, value)
+        return value
+
+_cache = _Cache()
+
+
+def _expand(prefix):
+    """Return the indexed terms starting with prefix, prefix itself
+    first."""
+    def compute():
+        # posting keys sort by term, but '|' sorts after the longer terms
+        # sharing the prefix: the word itself is always looked up by
+        # _postings()' direct gets instead
+        keys = SearchPosting.query(
+            SearchPosting.key >= ndb.Key(SearchPosting, prefix),
+            SearchPosting.key < ndb.Key(SearchPosting, prefix + u'\ufffd')
+        ).fetch(PREFIX_EXPANSION * POSTING_SHARDS, keys_only=True)
+        terms = [prefix]
+        for k in keys:
+            term = k.id().rsplit(u'|', 1)[0]
+            if term not in terms:
+                terms.append(term)
+        return terms[:PREFIX_EXPANSION]
+    return _cache.get(('expand', prefix), compute)
+
+
+def _postings(term):
+    """Return {websafe conference key: score} of a term."""
+    def compute():
+        postings = {}
+        for posting in ndb.get_multi([
+                ndb.Key(SearchPosting, u'%s|%d' % (term, shard))
+                for shard in xrange(POSTING_SHARDS)]):
+            if posting:
+                postings.update(posting.postings)
+        return postings
+    return _cache.get(('postings', term), compute)
+
+
+def _documents():
+    return _cache.get(('documents',), lambda: max(
+        1, SearchDocument.query().count(keys_only=True)))
+
+
+def search(text):
+    """Return the websafe keys of the conferences matching every word
+    of text, best first; at most MAX_RESULTS.
+    """
+    words = []
+    for word in tokenize(text):
+        if word not in words:
+            words.append(word)
+    if not words:
+        return []
+
+    def compute():
+        documents = _documents()
+        scores = None
+        for word in words:
+            # a word scores a conference by its best matching term
+            best = {}
+            for term in _expand(word):
+                postings = _postings(term)
+                if not postings:
+                    continue
+                idf = math.log(1.0 + float(documents) / len(postings))
+                for wsck, score in postings.iteritems():
+                    best[wsck] = max(best.get(wsck, 0), score * idf)
+            if scores is None:
+                scores = best
+            else:
+                scores = dict((k, s + best[k])
+                              for k, s in scores.iteritems() if k in best)
+            if not scores:
+                return []
+        ranked = sorted(scores.iteritems(), key=lambda e: (-e[1], e[0]))
+        return [wsck for wsck, _ in ranked[:MAX_RESULTS]]
+    return _cache.get(('search', tuple(words)), compute)
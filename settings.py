@@ -16,3 +16,31 @@ WEB_CLIENT_ID = '101615539743-87da8v8i94rn5c5vjaben01otuek9rfl.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Local file that receives aggregated per-endpoint RPC stats (see
+# rpcstats.py); only writable on the dev server, so keep None when deployed.
+RPC_STATS_FILE = None
+
+# Token buckets of the write endpoints as (tokens per second, burst), one
+# per user and endpoint; see admission.py.
+RATE_LIMITS = {
+    'registerForConference': (0.5, 5),
+    'addSessionToWishlist': (2.0, 20),
+    'modifyWishlist': (1.0, 10),
+    'createSession': (0.5, 10),
+    'saveProfile': (0.2, 5),
+}
+# Bucket shared by everyone registering for the same conference; keeps
+# the transactions on its entity group to a rate it can commit.
+CONFERENCE_RATE_LIMIT = (5.0, 20)
+
+# Sampled cProfile profiling of requests, see profiler.py; both off by
+# default. Share of requests profiled at random:
+PROFILE_SAMPLE_RATE = 0.0
+# Requests slower than this (ms) get the next PROFILE_SLOW_CAPTURES
+# requests to their endpoint profiled; None turns it off.
+PROFILE_SLOW_MS = None
+PROFILE_SLOW_CAPTURES = 3
+# Profiles kept per instance, and functions kept per profile
+PROFILE_BUFFER = 200
+PROFILE_TOP = 20
@@ -130,3 +130,39 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+/**
+ * @ngdoc service
+ * @name etagCache
+ *
+ * @description
+ * Keeps the last result of the conditional GET endpoints with its ETag, so that a
+ * "not modified" response can be answered from memory.
+ *
+ */
+app.factory('etagCache', function () {
+    var entries = {};
+
+    return {
+        /**
+         * Returns the ETag to send as ifNoneMatch for the given cache key.
+         */
+        etag: function (key) {
+            return entries[key] ? entries[key].etag : undefined;
+        },
+
+        /**
+         * Returns the result to use for a successful response: the cached one if the
+         * response says not modified, otherwise the response's result, which is cached.
+         */
+        resolve: function (key, result) {
+            if (result.notModified && entries[key]) {
+                return entries[key].result;
+            }
+            if (result.etag) {
+                entries[key] = {etag: result.etag, result: result};
+            }
+            return result;
+        }
+    };
+});
@@ -213,6 +213,11 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
                 return;
             }
 
+            // Resubmitting after a failure reuses the key, so the server creates the conference once.
+            if (!$scope.conference.idempotencyKey) {
+                $scope.conference.idempotencyKey = Date.now().toString(36) + Math.random().toString(36).slice(2);
+            }
+
             $scope.loading = true;
             gapi.client.conference.createConference($scope.conference).
                 execute(function (resp) {
@@ -249,7 +254,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS, etagCache) {
 
     /**
      * Holds the status if the query is being executed.
@@ -293,6 +298,76 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Whether the queries cover archived (long past) conferences too.
+     * @type {boolean}
+     */
+    $scope.includeArchived = false;
+
+    /**
+     * The signed in user's profile, conferences to attend and created, announcement and
+     * wishlist size, loaded by one getDashboard call.
+     */
+    $scope.dashboard = null;
+
+    /**
+     * The dashboard lists already shown; they are only used for the first paint of a tab.
+     */
+    $scope.dashboardShown = {};
+
+    /**
+     * Invokes the conference.getDashboard method.
+     */
+    $scope.loadDashboard = function () {
+        gapi.client.conference.getDashboard().
+            execute(function (resp) {
+                $scope.$apply(function () {
+                    if (resp.error) {
+                        $log.error('Failed to get the dashboard : ' + (resp.error.message || ''));
+                    } else {
+                        $scope.dashboard = resp.result;
+                        $scope.dashboardShown = {};
+                    }
+                });
+            });
+    };
+
+    $scope.$watch(function () {
+        return oauth2Provider.signedIn;
+    }, function (signedIn) {
+        if (signedIn && !$scope.dashboard) {
+            $scope.loadDashboard();
+        } else if (!signedIn) {
+            $scope.dashboard = null;
+        }
+    });
+
+    /**
+     * Shows the conferences of the selected tab from the dashboard, if it has them and
+     * hasn't shown them before; returns false otherwise. Registrations and new conferences
+     * don't update the dashboard, so later visits to a tab query the lists again.
+     */
+    $scope.showFromDashboard = function () {
+        var list;
+        if (!$scope.dashboard) {
+            return false;
+        }
+        if ($scope.selectedTab == 'YOU_HAVE_CREATED' && !$scope.includeArchived) {
+            list = 'conferencesCreated';
+        } else if ($scope.selectedTab == 'YOU_WILL_ATTEND') {
+            list = 'conferencesToAttend';
+        } else {
+            return false;
+        }
+        if ($scope.dashboardShown[list]) {
+            return false;
+        }
+        $scope.dashboardShown[list] = true;
+        $scope.conferences = $scope.dashboard[list] || [];
+        $scope.submitted = true;
+        return true;
+    };
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -317,7 +392,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
             oauth2Provider.showLoginModal();
             return;
         }
-        $scope.queryConferences();
+        $scope.showFromDashboard() || $scope.queryConferences();
     };
 
     /**
@@ -329,7 +404,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
             oauth2Provider.showLoginModal();
             return;
         }
-        $scope.queryConferences();
+        $scope.showFromDashboard() || $scope.queryConferences();
     };
 
     /**
@@ -379,6 +454,27 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         return angular.element(event.target).hasClass('disabled');
     }
 
+    /**
+     * Conference counts per city, topic and month for the current filters.
+     */
+    $scope.facets = null;
+
+    /**
+     * Adds an equality filter for a facet value and runs the query.
+     */
+    $scope.addFacetFilter = function (enumValue, value) {
+        angular.forEach($scope.filtereableFields, function (field) {
+            if (field.enumValue == enumValue) {
+                $scope.filters.push({
+                    field: field,
+                    operator: $scope.operators[0],
+                    value: value
+                });
+            }
+        });
+        $scope.queryConferences();
+    };
+
     /**
      * Adds a filter and set the default value.
      */
@@ -428,7 +524,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
-            filters: []
+            filters: [],
+            includeArchived: $scope.includeArchived
         }
         for (var i = 0; i < $scope.filters.length; i++) {
             var filter = $scope.filters[i];
@@ -441,6 +538,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
             }
         }
         $scope.loading = true;
+        gapi.client.conference.getConferenceFacets(sendFilters).
+            execute(function (resp) {
+                $scope.$apply(function () {
+                    $scope.facets = resp.error ? null : resp;
+                });
+            });
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
                 $scope.$apply(function () {
@@ -473,7 +576,10 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesCreated = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
+        gapi.client.conference.getConferencesCreated({
+            ifNoneMatch: etagCache.etag('conferencesCreated'),
+            includeArchived: $scope.includeArchived
+        }).
             execute(function (resp) {
                 $scope.$apply(function () {
                     $scope.loading = false;
@@ -496,7 +602,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         $log.info($scope.messages);
 
                         $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
+                        var result = etagCache.resolve('conferencesCreated', resp.result);
+                        angular.forEach(result.items, function (conference) {
                             $scope.conferences.push(conference);
                         });
                     }
@@ -547,7 +654,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS, etagCache) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
@@ -559,8 +666,10 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
      */
     $scope.init = function () {
         $scope.loading = true;
+        var conferenceCacheKey = 'conference-' + $routeParams.websafeConferenceKey;
         gapi.client.conference.getConference({
-            websafeConferenceKey: $routeParams.websafeConferenceKey
+            websafeConferenceKey: $routeParams.websafeConferenceKey,
+            ifNoneMatch: etagCache.etag(conferenceCacheKey)
         }).execute(function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
@@ -574,20 +683,22 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     // The request has succeeded.
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
+                    $scope.conference = etagCache.resolve(conferenceCacheKey, resp.result);
                 }
             });
         });
 
         $scope.loading = true;
         // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
+        gapi.client.conference.getProfile({
+            ifNoneMatch: etagCache.etag('profile')
+        }).execute(function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
                     // Failed to get a user profile.
                 } else {
-                    var profile = resp.result;
+                    var profile = etagCache.resolve('profile', resp.result);
                     for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
                         if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
                             // The user is attending the conference.
@@ -624,12 +735,15 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                         return;
                     }
                 } else {
-                    if (resp.result) {
+                    if (resp.result && resp.result.data) {
                         // Register succeeded.
                         $scope.messages = 'Registered for the conference';
                         $scope.alertStatus = 'success';
                         $scope.isUserAttending = true;
                         $scope.conference.seatsAvailable = $scope.conference.seatsAvailable - 1;
+                    } else if (resp.result) {
+                        // The conference is full; the user has been put on the waitlist.
+                        $scope.getWaitlistPosition();
                     } else {
                         $scope.messages = 'Failed to register for the conference';
                         $scope.alertStatus = 'warning';
@@ -639,6 +753,23 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
         });
     };
 
+    /**
+     * Invokes the conference.getWaitlistPosition method and shows the user's place in the queue.
+     */
+    $scope.getWaitlistPosition = function () {
+        gapi.client.conference.getWaitlistPosition({
+            websafeConferenceKey: $routeParams.websafeConferenceKey
+        }).execute(function (resp) {
+            $scope.$apply(function () {
+                if (!resp.error && resp.result.position) {
+                    $scope.messages = 'The conference is full. You are number ' + resp.result.position +
+                        ' on the waitlist and will be registered automatically when a seat frees up.';
+                    $scope.alertStatus = 'info';
+                }
+            });
+        });
+    };
+
     /**
      * Invokes the conference.unregisterForConference method.
      */
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+
+"""
+tasks.py -- Conference Central work done outside API calls
+
+$Id$
+
+The bodies of the task, cron and warmup handlers in main.py and of the
+mapper jobs in jobs.py, along with the helpers ConferenceApi shares with
+them. Those handlers import this module instead of conference.py, so an
+instance started for a task or a cron doesn't build the Endpoints
+service and its request containers.
+
+"""
+
+from datetime import datetime
+from datetime import timedelta
+
+import endpoints
+from protorpc import protojson
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ConferenceAgenda
+from models import ConferenceAttendee
+from models import ConferenceSession
+from models import ConferenceSessionForm
+from models import ConferenceSessionForms
+from models import ConferenceSessionType
+from models import Profile
+from models import SessionWishlistItem
+from models import Tombstone
+from models import WaitlistEntry
+from models import WishlistSize
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
+                    'are nearly sold out: %s')
+FEATURED_SPEAKER_PREFIX = 'featuredSpeaker-'
+# a promotion batch touches the conference plus one profile per entry,
+# which must stay under the 25 entity group limit of xg transactions
+WAITLIST_PROMOTION_BATCH = 20
+MIGRATION_BATCH = 100
+# conferences indexed per transaction, next to the Profile's own group
+ATTENDANCE_BATCH = 24
+# upcoming conferences whose caches a new instance primes
+WARMUP_CONFERENCES = 20
+# tombstones are purged after this; older checkpoints get a full sync
+TOMBSTONE_RETENTION = timedelta(days=30)
+
+
+# - - - Profiles - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def upgradeProfile(prof):
+    """Move legacy urlsafe conference keys into conferencesToAttend;
+    returns True if the Profile needs to be written back.
+    """
+    if not prof.conferenceKeysToAttend:
+        return False
+    for wsck in prof.conferenceKeysToAttend:
+        c_key = ndb.Key(urlsafe=wsck)
+        if c_key not in prof.conferencesToAttend:
+            prof.conferencesToAttend.append(c_key)
+    prof.conferenceKeysToAttend = []
+    return True
+
+
+@ndb.transactional
+def upgradeStoredProfile(p_key):
+    """Read a Profile again and write it back upgraded if it holds legacy
+    keys; returns it, or None if it doesn't exist."""
+    prof = p_key.get()
+    if prof and upgradeProfile(prof):
+        prof.put()
+    return prof
+
+
+@ndb.transactional(xg=True)
+def _indexAttendance(p_key, c_keys):
+    """Write the attendee index entries of a Profile for those of the
+    conferences it still attends and that still exist."""
+    prof = p_key.get()
+    if not prof:
+        return
+    upgradeProfile(prof)
+    ndb.put_multi([
+        ConferenceAttendee(key=ndb.Key(ConferenceAttendee, p_key.id(),
+                                       parent=c_key),
+                           userId=p_key.id())
+        for c_key, conf in zip(c_keys, ndb.get_multi(c_keys))
+        if conf and c_key in prof.conferencesToAttend])
+
+
+def migrateProfileAttendance(profiles):
+    """Convert a batch of Profiles to key based attendance and fill in
+    the attendee index; the migrate_attendance mapper job. Writes in
+    transactions that read the Profile again, so a registration made
+    meanwhile is neither lost nor indexed twice.
+    """
+    for p in profiles:
+        prof = upgradeStoredProfile(p.key)
+        c_keys = prof.conferencesToAttend if prof else []
+        for i in xrange(0, len(c_keys), ATTENDANCE_BATCH):
+            _indexAttendance(p.key, c_keys[i:i + ATTENDANCE_BATCH])
+    return [], []
+
+
+# - - - Announcements - - - - - - - - - - - - - - - - - - - - - -
+
+def cacheAnnouncement():
+    """Create Announcement & assign to memcache; used by
+    memcache cron job & putAnnouncement().
+    """
+    confs = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= 5,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+
+    if confs:
+        # If there are almost sold out conferences,
+        # format announcement and set it in memcache
+        announcement = ANNOUNCEMENT_TPL % (
+            ', '.join(conf.name for conf in confs))
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+    else:
+        # If there are no sold out conferences,
+        # delete the memcache announcements entry
+        announcement = ""
+        memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+
+    return announcement
+
+
+# - - - Speakers - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def updateFeaturedSpeaker(speaker, conferenceKey):
+    """Updates the featured speaker in memcache."""
+
+    conf = ndb.Key(urlsafe=conferenceKey)
+    if conf.kind() != "Conference" or not conf.get():
+        raise endpoints.NotFoundException(
+            'No conference found with key: %s' % conferenceKey)
+
+    q = ConferenceSession.query(ancestor=ndb.Key(
+                                    urlsafe=conferenceKey))
+
+    q = q.filter(ConferenceSession.speaker == speaker)
+
+    _featureSpeaker(conferenceKey, speaker, [cs.name for cs in q])
+
+
+def _featureSpeaker(conferenceKey, speaker, names):
+    """Feature a speaker with more than one session at the conference."""
+    if len(names) > 1:
+        memcache.set(FEATURED_SPEAKER_PREFIX + conferenceKey,
+                     (speaker, names))
+
+
+# - - - Instance warmup - - - - - - - - - - - - - - - - - - - - -
+
+def warmCaches():
+    """Prime what the first requests of a new instance read: the
+    announcement, plus the organizer profiles, agendas and featured
+    speakers of the upcoming conferences.
+    """
+    if memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) is None:
+        cacheAnnouncement()
+
+    confs = Conference.query(
+        Conference.startDate >= datetime.utcnow().date()).order(
+        Conference.startDate).fetch(WARMUP_CONFERENCES)
+    wscks = [conf.key.urlsafe() for conf in confs]
+    # one batch for both; ndb keeps them in memcache for the API
+    entities = ndb.get_multi(
+        [ndb.Key(Profile, conf.organizerUserId) for conf in confs] +
+        [ndb.Key(ConferenceAgenda, wsck) for wsck in wscks])
+    agendas = entities[len(confs):]
+
+    cached = memcache.get_multi(wscks, key_prefix=FEATURED_SPEAKER_PREFIX)
+    for wsck, agenda in zip(wscks, agendas):
+        if agenda:
+            forms = protojson.decode_message(ConferenceSessionForms,
+                                             agenda.data)
+        else:
+            forms = rebuildAgenda(wsck)
+        if wsck in cached or not forms:
+            continue
+        # the speaker with the most sessions is the best candidate
+        sessions = {}
+        for form in forms.items:
+            if form.speaker:
+                sessions.setdefault(form.speaker, []).append(form.name)
+        if sessions:
+            speaker, names = max(sessions.items(),
+                                 key=lambda item: len(item[1]))
+            _featureSpeaker(wsck, speaker, names)
+
+
+# - - - Waitlist - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def promoteWaitlist(websafeConferenceKey):
+    """Move waitlisted users into free seats, oldest entries first;
+    used by the promote waitlist task.
+    """
+    c_key = ndb.Key(urlsafe=websafeConferenceKey)
+    wl_keys = WaitlistEntry.query(ancestor=c_key).order(
+        WaitlistEntry.sequence).fetch(
+        WAITLIST_PROMOTION_BATCH, keys_only=True)
+    if not wl_keys:
+        return
+
+    # keep going in further tasks while seats and entries remain
+    if _promoteWaitlistBatch(c_key, wl_keys):
+        taskqueue.add(params={'websafeConferenceKey': websafeConferenceKey},
+                      url='/tasks/promote_waitlist')
+
+
+@ndb.transactional(xg=True)
+def _promoteWaitlistBatch(c_key, wl_keys):
+    """Promote one batch of waitlist entries; returns True if there
+    may be more entries to promote.
+    """
+    conf = c_key.get()
+    if not conf or conf.seatsAvailable <= 0:
+        return False
+
+    # entries may have left the waitlist since the query ran
+    entries = [e for e in ndb.get_multi(wl_keys) if e]
+    entries = entries[:conf.seatsAvailable]
+    profiles = ndb.get_multi(
+        [ndb.Key(Profile, e.userId) for e in entries])
+
+    promoted = []
+    attendees = []
+    for prof in profiles:
+        if not prof:
+            continue
+        upgradeProfile(prof)
+        if c_key not in prof.conferencesToAttend:
+            prof.conferencesToAttend.append(c_key)
+            promoted.append(prof)
+            attendees.append(ConferenceAttendee(
+                key=ndb.Key(ConferenceAttendee, prof.key.id(),
+                            parent=c_key),
+                userId=prof.key.id()))
+
+    conf.seatsAvailable -= len(promoted)
+    conf.waitlistCount -= len(entries)
+    ndb.put_multi(promoted + attendees + [conf])
+    ndb.delete_multi([e.key for e in entries])
+    return conf.seatsAvailable > 0 and conf.waitlistCount > 0
+
+
+# - - - Sessions - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def getAgenda(conferenceKey):
+    """Return the conference's sessions as ConferenceSessionForms from
+    the materialized agenda, building it if it doesn't exist yet.
+    """
+    # ndb serves the agenda from memcache before going to datastore
+    agenda = ndb.Key(ConferenceAgenda, conferenceKey).get()
+    if agenda:
+        return protojson.decode_message(ConferenceSessionForms,
+                                        agenda.data)
+    forms = rebuildAgenda(conferenceKey)
+    if forms is None:
+        raise endpoints.NotFoundException(
+            'No conference found with key: %s' % conferenceKey)
+    return forms
+
+
+def rebuildAgenda(conferenceKey):
+    """Serialize the conference's sessions into its ConferenceAgenda;
+    used by the rebuild agenda task & getAgenda(). Returns None, and
+    drops any agenda left, if the conference doesn't exist.
+    """
+    c_key = ndb.Key(urlsafe=conferenceKey)
+    if c_key.kind() != 'Conference' or not c_key.get():
+        ndb.Key(ConferenceAgenda, conferenceKey).delete()
+        return None
+    q = ConferenceSession.query(ancestor=c_key)
+    forms = ConferenceSessionForms(
+        items=[copyConferenceSessionToForm(cs) for cs in q]
+    )
+    ConferenceAgenda(key=ndb.Key(ConferenceAgenda, conferenceKey),
+                     data=protojson.encode_message(forms)).put()
+    return forms
+
+
+def parseTimeOfDay(value):
+    """Return minutes after midnight for an HH:MM time string."""
+    try:
+        t = datetime.strptime(value.strip(), "%H:%M").time()
+    except ValueError:
+        raise endpoints.BadRequestException(
+            "Time '%s' must be formatted as HH:MM" % value)
+    return t.hour * 60 + t.minute
+
+
+def sessionSpan(cs):
+    """Return (start, end) datetimes of a session, deriving them for
+    sessions stored before the schedule fields existed; None if the
+    legacy startTime can't be parsed.
+    """
+    if cs.startDateTime and cs.endDateTime:
+        return cs.startDateTime, cs.endDateTime
+    try:
+        minute = parseTimeOfDay(cs.startTime)
+    except endpoints.BadRequestException:
+        return None
+    start = datetime.combine(cs.date, datetime.min.time()) + timedelta(
+        minutes=minute)
+    return start, start + timedelta(minutes=cs.duration)
+
+
+def migrateSessionSchedule(sessions):
+    """Fill in the schedule fields of sessions stored before they
+    existed; the migrate_schedule mapper job. Sessions without a date,
+    duration or parseable startTime are left as they are.
+    """
+    changed = []
+    for cs in sessions:
+        if (cs.startMinute is not None or not cs.startTime or
+                not cs.date or cs.duration is None):
+            continue
+        span = sessionSpan(cs)
+        if span:
+            cs.startDateTime, cs.endDateTime = span
+            cs.startMinute = span[0].hour * 60 + span[0].minute
+            cs.startTime = '%02d:%02d' % divmod(cs.startMinute, 60)
+            changed.append(cs)
+    return changed, []
+
+
+def copyConferenceSessionToForm(confSession):
+    """
+    Copy relevant fields from ConferenceSession to ConferenceSessionForm.
+    """
+
+    csf = ConferenceSessionForm()
+    for field in csf.all_fields():
+        if hasattr(confSession, field.name):
+            if field.name == "date":
+                setattr(
+                    csf, field.name, str(
+                        getattr(
+                            confSession, field.name)))
+            elif field.name == "typeOfSession":
+                setattr(
+                    csf,
+                    field.name,
+                    getattr(
+                        ConferenceSessionType,
+                        getattr(
+                            confSession,
+                            field.name)))
+            else:
+                setattr(csf, field.name, getattr(confSession, field.name))
+        elif field.name == "sessionKey":
+            setattr(csf, field.name, confSession.key.urlsafe())
+        elif field.name == "conferenceKey":
+            setattr(csf, field.name, confSession.key.parent().urlsafe())
+
+    csf.check_initialized()
+    return csf
+
+
+# - - - Wishlists - - - - - - - - - - - - - - - - - - - - - - - -
+
+def wishlistItemKey(user_id, sessionKey):
+    return ndb.Key(Profile, user_id, SessionWishlistItem, sessionKey)
+
+
+def wishlistSizeKey(user_id):
+    return ndb.Key(Profile, user_id, WishlistSize, 1)
+
+
+def migrateUserWishlist(user_id):
+    """Re-key a user's legacy wishlist items, ahead of the
+    migrate_wishlists job."""
+    puts, deletes = migrateWishlists(SessionWishlistItem.query(
+        SessionWishlistItem.userId == user_id).fetch())
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+
+
+def migrateWishlists(items):
+    """Re-key a batch of legacy wishlist items under their users'
+    Profiles; the migrate_wishlists mapper job. The users' wishlist
+    sizes are dropped, to be recounted.
+    """
+    legacy = [wl for wl in items if not wl.key.parent()]
+    new_keys = [wishlistItemKey(wl.userId, wl.sessionKey)
+                for wl in legacy]
+    # a session wishlisted again since lives under its new key already
+    rekeyed = [
+        SessionWishlistItem(key=k, userId=wl.userId,
+                            sessionKey=wl.sessionKey)
+        for wl, k, item in zip(legacy, new_keys, ndb.get_multi(new_keys))
+        if not item]
+    # parentless keys have no tombstone owner, so report the old
+    # items to their users here
+    tombstones = [
+        Tombstone(id=wl.key.urlsafe(), entityKind=wl.key.kind(),
+                  owner=wl.userId) for wl in legacy]
+    sizes = set(wishlistSizeKey(wl.userId) for wl in legacy)
+    return rekeyed + tombstones, [wl.key for wl in legacy] + list(sizes)
+
+
+# - - - Sync - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def purgeTombstones():
+    """Delete tombstones older than the sync retention period."""
+    cutoff = datetime.utcnow() - TOMBSTONE_RETENTION
+    query = Tombstone.query(Tombstone.deleted < cutoff)
+    cursor, more = None, True
+    while more:
+        keys, cursor, more = query.fetch_page(
+            MIGRATION_BATCH, start_cursor=cursor, keys_only=True)
+        ndb.delete_multi(keys)
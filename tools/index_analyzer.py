@@ -0,0 +1,660 @@
+#!/usr/bin/env python
+
+"""
+index_analyzer.py -- Conference Central datastore index cost analyzer
+
+$Id$
+
+Usage:
+    python tools/index_analyzer.py [--apply] [--prune-index]
+        [--models models.py] [--index index.yaml] [SOURCE.py ...]
+
+Statically extracts every ndb query shape -- kind, ancestor, equality
+and inequality filters, sort orders and projections -- from the app
+sources (all top-level modules by default), works out the index each
+shape needs and reports:
+
+  - the queries and the composite index serving each one,
+  - composite indexes in index.yaml no query needs,
+  - properties indexed in models.py but never filtered, sorted or
+    projected on,
+  - the index writes a new entity costs now and after the cleanup.
+
+--apply marks the unqueried properties indexed=False in models.py;
+--prune-index drops the unused composite indexes from index.yaml.
+Existing entities keep their old index rows until they are written
+again, and dropped composite indexes stay until vacuum_indexes runs.
+
+Queries whose filters are built at run time (queryConferences) are
+matched against the string values of the module-level dicts naming
+properties of the queried kind, such as conference.FIELDS.
+
+"""
+
+import argparse
+import ast
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# property classes that are never indexed
+UNINDEXED_TYPES = ('TextProperty', 'BlobProperty', 'JsonProperty',
+                   'PickleProperty', 'LocalStructuredProperty')
+# query methods that run the query
+TERMINALS = ('fetch', 'fetch_async', 'fetch_page', 'fetch_page_async',
+             'get', 'get_async', 'count', 'count_async', 'iter', 'map',
+             'map_async')
+INEQUALITY_OPS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.NotEq)
+
+
+# - - - models - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+class Prop(object):
+
+    """Prop -- an ndb property declared in models.py"""
+
+    def __init__(self, model, name, call):
+        self.model = model
+        self.name = name
+        self.call = call
+        self.type = _attrName(call.func)
+        self.indexed = self.type not in UNINDEXED_TYPES
+        self.repeated = False
+        for kw in call.keywords:
+            if kw.arg == 'indexed':
+                self.indexed = _literal(kw.value) is not False
+            elif kw.arg == 'repeated':
+                self.repeated = _literal(kw.value) is True
+
+
+def _attrName(node):
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def _literal(node):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return None
+
+
+def parseModels(path):
+    """Return ({kind: {property name: Prop}}, {kind: [base kinds]}) for
+    the ndb.Model subclasses in models.py; properties of model base
+    classes are included in each kind.
+    """
+    tree = ast.parse(open(path).read(), path)
+    own = {}
+    bases = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        names = [_attrName(b) for b in node.bases]
+        if 'Model' not in names and not any(n in own for n in names):
+            continue
+        bases[node.name] = [n for n in names if n in own]
+        own[node.name] = {}
+        for stmt in node.body:
+            if (isinstance(stmt, ast.Assign) and
+                    isinstance(stmt.value, ast.Call) and
+                    (_attrName(stmt.value.func) or '').endswith('Property')):
+                name = stmt.targets[0].id
+                own[node.name][name] = Prop(node.name, name, stmt.value)
+
+    def collect(kind):
+        props = {}
+        for base in bases[kind]:
+            props.update(collect(base))
+        props.update(own[kind])
+        return props
+    return dict((kind, collect(kind)) for kind in own), bases
+
+
+# - - - query shapes - - - - - - - - - - - - - - - - - - - - - - - -
+
+class Shape(object):
+
+    """Shape -- what an ndb query filters, sorts and projects on"""
+
+    def __init__(self, kind, where):
+        self.kind = kind
+        self.where = where
+        self.ancestor = False
+        self.equality = set()
+        self.inequality = set()
+        self.orders = []
+        self.projection = set()
+        self.dynamic = False
+
+    def copy(self):
+        other = Shape(self.kind, self.where)
+        other.ancestor = self.ancestor
+        other.equality = set(self.equality)
+        other.inequality = set(self.inequality)
+        other.orders = list(self.orders)
+        other.projection = set(self.projection)
+        other.dynamic = self.dynamic
+        return other
+
+    def properties(self):
+        return (self.equality | self.inequality | self.projection |
+                set(p for p, _ in self.orders))
+
+    def signature(self):
+        return (self.kind, self.ancestor, tuple(sorted(self.equality)),
+                tuple(sorted(self.inequality)), tuple(self.orders),
+                tuple(sorted(self.projection)), self.dynamic)
+
+    def describe(self):
+        parts = []
+        if self.ancestor:
+            parts.append('ancestor')
+        parts.extend('%s =' % p for p in sorted(self.equality))
+        parts.extend('%s <>' % p for p in sorted(self.inequality))
+        parts.extend('order %s%s' % ('-' if d == 'desc' else '', p)
+                     for p, d in self.orders)
+        if self.projection:
+            parts.append('project %s' % ', '.join(sorted(self.projection)))
+        if self.dynamic:
+            parts.append('+ run-time filters')
+        return '%s(%s)' % (self.kind, '; '.join(parts))
+
+    def neededIndex(self):
+        """Return the composite index as (kind, ancestor, [(property,
+        direction)]), or None when built-in indexes serve the query.
+        """
+        if self.dynamic:
+            return None
+        orders = list(self.orders)
+        if self.inequality and (
+                not orders or orders[0][0] not in self.inequality):
+            orders.insert(0, (sorted(self.inequality)[0], 'asc'))
+        # equality filters alone merge-join the built-in indexes; one
+        # inequality or sort on a single property uses its own index
+        if not orders and not self.projection:
+            return None
+        if (not self.ancestor and not self.equality and len(orders) == 1 and
+                self.projection <= set([orders[0][0]])):
+            return None
+        if (not self.ancestor and not self.equality and not orders and
+                len(self.projection) == 1):
+            return None
+        props = [(p, 'asc') for p in sorted(self.equality)] + orders
+        used = set(p for p, _ in props)
+        props += [(p, 'asc') for p in sorted(self.projection - used)]
+        return (self.kind, self.ancestor, props)
+
+
+class QueryExtractor(object):
+
+    """QueryExtractor -- collects the query shapes of one module by
+    following query values through assignments, branches and chained
+    filter()/order() calls inside each function
+    """
+
+    def __init__(self, path, kinds):
+        self.path = os.path.relpath(path, ROOT)
+        self.kinds = kinds
+        self.shapes = []
+        self.tree = ast.parse(open(path).read(), path)
+        self.dictValues = set()
+        for node in self.tree.body:
+            if (isinstance(node, ast.Assign) and
+                    isinstance(node.value, ast.Dict)):
+                for value in node.value.values:
+                    if isinstance(value, ast.Str):
+                        self.dictValues.add(value.s)
+
+    def run(self):
+        for node in ast.walk(self.tree):
+            if isinstance(node, (ast.FunctionDef, ast.Lambda)):
+                body = node.body if isinstance(node.body, list) else [
+                    ast.Expr(value=node.body)]
+                self.block(body, {})
+        unique = {}
+        for shape in self.shapes:
+            unique.setdefault(shape.signature(), shape)
+        return unique.values()
+
+    def record(self, shapes):
+        for shape in shapes:
+            self.shapes.append(shape)
+
+    # statements
+
+    def block(self, body, env):
+        for stmt in body:
+            self.statement(stmt, env)
+        return env
+
+    def statement(self, stmt, env):
+        if isinstance(stmt, (ast.FunctionDef, ast.ClassDef)):
+            return
+        if isinstance(stmt, ast.Assign):
+            shapes = self.expr(stmt.value, env)
+            for target in stmt.targets:
+                if isinstance(target, ast.Name):
+                    if shapes:
+                        env[target.id] = shapes
+                    else:
+                        env.pop(target.id, None)
+                else:
+                    self.record(shapes)
+                    self.expr(target, env)
+        elif isinstance(stmt, ast.If):
+            self.record(self.expr(stmt.test, env))
+            self.merge(env, self.block(stmt.body, dict(env)),
+                       self.block(stmt.orelse, dict(env)))
+        elif isinstance(stmt, (ast.For, ast.While)):
+            self.record(self.expr(
+                stmt.iter if isinstance(stmt, ast.For) else stmt.test, env))
+            self.merge(env, dict(env), self.block(stmt.body, dict(env)))
+            self.block(stmt.orelse, env)
+        else:
+            # returns, expressions, with/try bodies: any query value used
+            # as a whole is run somewhere
+            for field, value in ast.iter_fields(stmt):
+                values = value if isinstance(value, list) else [value]
+                for item in values:
+                    if isinstance(item, ast.stmt):
+                        self.statement(item, env)
+                    elif isinstance(item, ast.AST):
+                        self.record(self.expr(item, env))
+
+    def merge(self, env, first, second):
+        env.clear()
+        for name in set(first) | set(second):
+            env[name] = first.get(name, []) + [
+                s for s in second.get(name, []) if s not in first.get(name, [])]
+
+    # expressions
+
+    def expr(self, node, env):
+        """Evaluate node; return the query shapes it may hold."""
+        if isinstance(node, ast.Name):
+            return list(env.get(node.id, []))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            method = node.func.attr
+            owner = node.func.value
+            if (method == 'query' and isinstance(owner, ast.Name) and
+                    owner.id in self.kinds):
+                shape = Shape(owner.id, '%s:%d' % (self.path, node.lineno))
+                for arg in node.args:
+                    self.filter(shape, arg)
+                for kw in node.keywords:
+                    if kw.arg == 'ancestor':
+                        shape.ancestor = True
+                    elif kw.arg == 'projection':
+                        self.project(shape, kw.value)
+                self.visitArgs(node, env)
+                return [shape]
+            if method in ('filter', 'order') or method in TERMINALS:
+                shapes = self.expr(owner, env)
+                if shapes:
+                    self.visitArgs(node, env)
+                    result = []
+                    for shape in shapes:
+                        shape = shape.copy()
+                        if method == 'filter':
+                            for arg in node.args:
+                                self.filter(shape, arg)
+                        elif method == 'order':
+                            for arg in node.args:
+                                self.order(shape, arg)
+                        else:
+                            for kw in node.keywords:
+                                if kw.arg == 'projection':
+                                    self.project(shape, kw.value)
+                        result.append(shape)
+                    if method in TERMINALS:
+                        self.record(result)
+                        return []
+                    return result
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.AST) and not isinstance(
+                    child, (ast.expr_context, ast.operator, ast.cmpop,
+                            ast.unaryop, ast.boolop)):
+                self.record(self.expr(child, env)
+                            if isinstance(child, ast.expr) else
+                            self.comprehension(child, env))
+        return []
+
+    def comprehension(self, node, env):
+        if isinstance(node, ast.comprehension):
+            return self.expr(node.iter, env)
+        if isinstance(node, ast.keyword):
+            return self.expr(node.value, env)
+        return []
+
+    def visitArgs(self, node, env):
+        for arg in node.args:
+            self.record(self.expr(arg, env))
+        for kw in node.keywords:
+            self.record(self.expr(kw.value, env))
+
+    def prop(self, shape, node):
+        """Return the property named by a Model.prop expression."""
+        if (isinstance(node, ast.Attribute) and
+                isinstance(node.value, ast.Name) and
+                node.value.id == shape.kind):
+            return node.attr
+        if isinstance(node, ast.Call) and _attrName(node.func) in (
+                'GenericProperty', 'StringProperty', 'IntegerProperty'):
+            if node.args and isinstance(node.args[0], ast.Str):
+                return node.args[0].s
+        return None
+
+    def filter(self, shape, node):
+        if isinstance(node, ast.Call) and _attrName(node.func) in (
+                'AND', 'OR', 'ConjunctionNode', 'DisjunctionNode'):
+            for arg in node.args:
+                self.filter(shape, arg)
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1:
+            name = self.prop(shape, node.left)
+            if name is None:
+                shape.dynamic = True
+            elif isinstance(node.ops[0], INEQUALITY_OPS):
+                shape.inequality.add(name)
+            else:
+                shape.equality.add(name)
+        elif (isinstance(node, ast.Call) and
+              isinstance(node.func, ast.Attribute) and
+              node.func.attr == 'IN'):
+            name = self.prop(shape, node.func.value)
+            if name is None:
+                shape.dynamic = True
+            else:
+                shape.equality.add(name)
+        elif isinstance(node, ast.Call) and _attrName(
+                node.func) == 'FilterNode' and all(
+                isinstance(a, ast.Str) for a in node.args[:2]):
+            name, op = node.args[0].s, node.args[1].s
+            (shape.equality if op in ('=', 'in') else
+             shape.inequality).add(name)
+        else:
+            shape.dynamic = True
+
+    def order(self, shape, node):
+        direction = 'asc'
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            direction, node = 'desc', node.operand
+        name = self.prop(shape, node)
+        if name is None:
+            shape.dynamic = True
+        else:
+            shape.orders.append((name, direction))
+
+    def project(self, shape, node):
+        if isinstance(node, (ast.List, ast.Tuple)):
+            for element in node.elts:
+                if isinstance(element, ast.Str):
+                    shape.projection.add(element.s)
+                else:
+                    name = self.prop(shape, element)
+                    if name:
+                        shape.projection.add(name)
+
+
+# - - - index.yaml - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def parseIndexYaml(text):
+    """Return [(kind, ancestor, [(property, direction)], first line,
+    last line)] for the index.yaml layout dev_appserver writes.
+    """
+    indexes = []
+    lines = text.splitlines()
+    current = None
+    for number, line in enumerate(lines):
+        stripped = line.strip()
+        match = re.match(r'- kind:\s*(\S+)', stripped)
+        if match:
+            current = [match.group(1), False, [], number, number]
+            indexes.append(current)
+            continue
+        if current is None or not stripped or stripped.startswith('#'):
+            continue
+        if not line.startswith(' '):
+            current = None
+            continue
+        current[4] = number
+        if stripped.startswith('ancestor:'):
+            current[1] = stripped.split(':', 1)[1].strip() in ('yes', 'true')
+        elif stripped.startswith('- name:'):
+            current[2].append((stripped.split(':', 1)[1].strip(), 'asc'))
+        elif stripped.startswith('direction:') and current[2]:
+            current[2][-1] = (current[2][-1][0],
+                              stripped.split(':', 1)[1].strip())
+    return [tuple(i) for i in indexes]
+
+
+def serves(index, shape, dynamicFields):
+    """Tell whether a composite index of index.yaml serves a shape."""
+    kind, ancestor, props = index[:3]
+    if kind != shape.kind or ancestor != shape.ancestor:
+        return False
+    if shape.dynamic:
+        # run-time filters: any index over the static properties, plus
+        # properties the module lets clients filter on, that ends with
+        # the static sort orders
+        names = [p for p, _ in props]
+        static = shape.properties()
+        if not static <= set(names):
+            return False
+        if not set(names) - static <= dynamicFields:
+            return False
+        tail = [p for p, _ in shape.orders if p not in dynamicFields]
+        return not tail or names[-len(tail):] == tail
+    needed = shape.neededIndex()
+    if needed is None:
+        return False
+    wanted = needed[2]
+    if len(props) != len(wanted):
+        return False
+    eq = len(shape.equality)
+    ordered = len(wanted) - len(shape.projection - set(
+        p for p, _ in wanted[:len(wanted) - len(shape.projection)]))
+    return (set(props[:eq]) == set(wanted[:eq]) and
+            props[eq:ordered] == wanted[eq:ordered] and
+            set(props[ordered:]) == set(wanted[ordered:]))
+
+
+# - - - report - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def newEntityWrites(indexedProps, composites):
+    """Index writes of putting a new entity with one value per property:
+    2 for the entity, 2 per indexed property value (ascending and
+    descending rows) and 1 per composite index row.
+    """
+    return 2 + 2 * indexedProps + composites
+
+
+def analyze(models, sources, index):
+    kinds, bases = parseModels(models)
+    shapes = []
+    dynamicFields = {}
+    for path in sources:
+        extractor = QueryExtractor(path, kinds)
+        found = extractor.run()
+        shapes.extend(found)
+        for shape in found:
+            if shape.dynamic:
+                dynamicFields.setdefault(shape.kind, set()).update(
+                    f for f in extractor.dictValues if f in kinds[shape.kind])
+    shapes.sort(key=lambda s: s.where)
+
+    indexes = parseIndexYaml(open(index).read()) if os.path.exists(
+        index) else []
+    used = set()
+    missing = []
+    for shape in shapes:
+        serving = [i for i, ix in enumerate(indexes)
+                   if serves(ix, shape, dynamicFields.get(shape.kind, set()))]
+        used.update(serving)
+        if shape.neededIndex() and not serving:
+            missing.append(shape)
+    unused = [ix for i, ix in enumerate(indexes) if i not in used]
+
+    queried = {}
+    for shape in shapes:
+        queried.setdefault(shape.kind, set()).update(shape.properties())
+        if shape.dynamic:
+            queried[shape.kind].update(dynamicFields.get(shape.kind, ()))
+    for i in used:
+        kind = indexes[i][0]
+        queried.setdefault(kind, set()).update(p for p, _ in indexes[i][2])
+
+    # a property is only unindexed where it is declared, so one declared
+    # on a base model must be unqueried in every kind inheriting it
+    unqueried = {}
+    for kind, props in sorted(kinds.items()):
+        for name, prop in sorted(props.items()):
+            if prop.indexed and name not in queried.get(kind, set()):
+                unqueried.setdefault(prop.model, {}).setdefault(
+                    name, set()).add(kind)
+    inheritors = dict((kind, set(k for k in kinds if _inherits(
+        k, kind, bases))) for kind in kinds)
+    cleanup = []
+    for model, props in sorted(unqueried.items()):
+        for name, where in sorted(props.items()):
+            if where >= inheritors[model]:
+                cleanup.append(kinds[model][name])
+
+    return {
+        'kinds': kinds, 'shapes': shapes, 'indexes': indexes,
+        'used': used, 'unused': unused, 'missing': missing,
+        'cleanup': cleanup, 'inheritors': inheritors,
+    }
+
+
+def _inherits(kind, base, bases):
+    return kind == base or any(_inherits(b, base, bases)
+                               for b in bases.get(kind, []))
+
+
+def report(result):
+    kinds = result['kinds']
+    indexes = result['indexes']
+    print 'Query shapes (%d)' % len(result['shapes'])
+    for shape in result['shapes']:
+        needed = shape.neededIndex()
+        how = 'built-in'
+        if shape.dynamic:
+            how = 'run-time filters'
+        elif needed:
+            how = 'composite ' + ', '.join(
+                '%s%s' % ('-' if d == 'desc' else '', p)
+                for p, d in needed[2])
+        print '  %-26s %s\n  %-26s -> %s' % (
+            shape.where, shape.describe(), '', how)
+
+    for shape in result['shapes']:
+        unknown = shape.properties() - set(kinds[shape.kind])
+        if unknown:
+            print '  warning: %s: %s has no property %s' % (
+                shape.where, shape.kind, ', '.join(sorted(unknown)))
+
+    print '\nComposite indexes missing from index.yaml (%d)' % len(
+        result['missing'])
+    for shape in result['missing']:
+        print '  %s  %s' % (shape.where, shape.describe())
+
+    print '\nUnused composite indexes in index.yaml (%d)' % len(
+        result['unused'])
+    for kind, ancestor, props, _, _ in result['unused']:
+        print '  %s%s(%s)' % (kind, ' ancestor' if ancestor else '',
+                              ', '.join(p for p, _ in props))
+
+    cleanup = result['cleanup']
+    print '\nIndexed but never queried (%d)' % len(cleanup)
+    for prop in cleanup:
+        print '  %s.%s' % (prop.model, prop.name)
+
+    print '\nIndex writes per new entity (one value per property)'
+    print '  %-22s %7s %7s' % ('kind', 'now', 'after')
+    removed = set((p.model, p.name) for p in cleanup)
+    for kind, props in sorted(kinds.items()):
+        if result['inheritors'][kind] - set([kind]):
+            continue
+        indexed = [p for p in props.values() if p.indexed]
+        after = [p for p in indexed if (p.model, p.name) not in removed]
+        composites = [i for i, ix in enumerate(indexes) if ix[0] == kind]
+        kept = [i for i in composites if i in result['used']]
+        now = newEntityWrites(len(indexed), len(composites))
+        later = newEntityWrites(len(after), len(kept))
+        print '  %-22s %7d %7d' % (kind, now, later)
+
+
+# - - - migration - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def applyUnindexed(path, props):
+    """Add indexed=False to the declarations of props in models.py."""
+    lines = open(path).read().split('\n')
+    for prop in sorted(props, key=lambda p: -p.call.lineno):
+        row = prop.call.lineno - 1
+        line = lines[row]
+        if not line.rstrip().endswith(')'):
+            raise ValueError('%s:%d: declaration spans lines' % (
+                path, prop.call.lineno))
+        head = line.rstrip()[:-1]
+        separator = '' if head.endswith('(') else ', '
+        line = head + separator + 'indexed=False)'
+        if len(line) > 79:
+            # continue the arguments under the opening parenthesis
+            indent = ' ' * (line.index('(') + 1)
+            cut = line.rindex(', ', 0, 79)
+            line = line[:cut + 1] + '\n' + indent + line[cut + 2:]
+        lines[row] = line
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+def pruneIndexYaml(path, unused):
+    """Drop the unused composite index entries from index.yaml."""
+    with open(path, 'rb') as f:
+        lines = f.read().splitlines(True)
+    drop = set()
+    for _, _, _, first, last in unused:
+        drop.update(xrange(first, last + 1))
+        # with the blank line that separated the entry
+        if last + 1 < len(lines) and not lines[last + 1].strip():
+            drop.add(last + 1)
+    with open(path, 'wb') as f:
+        f.write(''.join(l for i, l in enumerate(lines) if i not in drop))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('sources', nargs='*')
+    parser.add_argument('--models', default=os.path.join(ROOT, 'models.py'))
+    parser.add_argument('--index', default=os.path.join(ROOT, 'index.yaml'))
+    parser.add_argument('--apply', action='store_true',
+                        help='mark unqueried properties indexed=False')
+    parser.add_argument('--prune-index', action='store_true',
+                        help='drop unused composite indexes')
+    args = parser.parse_args(argv)
+
+    sources = args.sources or sorted(
+        os.path.join(ROOT, name) for name in os.listdir(ROOT)
+        if name.endswith('.py') and name != os.path.basename(args.models))
+    result = analyze(args.models, sources, args.index)
+    report(result)
+
+    if args.apply and result['cleanup']:
+        applyUnindexed(args.models, result['cleanup'])
+        print '\nmarked %d properties indexed=False in %s' % (
+            len(result['cleanup']), args.models)
+    if args.prune_index and result['unused']:
+        pruneIndexYaml(args.index, result['unused'])
+        print 'dropped %d indexes from %s; run appcfg.py vacuum_indexes' % (
+            len(result['unused']), args.index)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())